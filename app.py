@@ -1,123 +1,873 @@
 import xml.etree.ElementTree as ET
 from fpdf import FPDF
+from fpdf.fpdf import ImageInfo
+from fpdf.image_parsing import get_img_info
+from fpdf.output import OutputProducer
+import argparse
+import collections
+import contextlib
+import functools
+import hashlib
+import logging
 import os
+import sys
+import time
+import zlib
+
+from modelo import ESCALA_CANTIDAD, ESCALA_MONTO, Factura, Items, Nota, Parte, a_entero, crear_item, texto_cantidad, texto_monto
+from qr import matriz_qr, preparar_versiones, rectangulos
+from metricas import REGISTRO, MetricasTicket, configurar_log_json, perfilar, registrar_ticket
+
+LOG = logging.getLogger("tickets")
+
+# Namespaces comunes en facturas electrónicas (en la forma "{uri}" que
+# entrega el parser)
+CBC = '{urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2}'
+CAC = '{urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2}'
+DS = '{http://www.w3.org/2000/09/xmldsig#}'
+
+# Tamaño de los bloques que se leen del archivo y se pasan al parser
+TAMANO_BLOQUE = 64 * 1024
+
+# Campos del emisor y del cliente: (etiqueta, etiqueta del padre o None, atributo de Parte)
+CAMPOS_EMISOR = (
+    (CBC + 'Name', None, 'nombre'),
+    (CBC + 'ID', None, 'id'),
+    (CBC + 'Line', CAC + 'AddressLine', 'direccion'),
+    (CBC + 'District', None, 'distrito'),
+    (CBC + 'CityName', None, 'departamento'),
+    (CBC + 'ElectronicMail', None, 'correo'),
+)
+CAMPOS_CLIENTE = (
+    (CBC + 'RegistrationName', None, 'nombre'),
+    (CBC + 'ID', None, 'id'),
+    (CBC + 'Line', CAC + 'AddressLine', 'direccion'),
+    (CBC + 'District', None, 'distrito'),
+    (CBC + 'CityName', None, 'departamento'),
+)
+# Campos de cada item, en el orden de Items.agregar:
+# (etiqueta, etiqueta del padre o None, clave, valor por defecto)
+CAMPOS_ITEM = (
+    (CBC + 'ID', CAC + 'SellersItemIdentification', 'codigo', 'N/A'),
+    (CBC + 'Note', None, 'unidad', 'N/A'),
+    (CBC + 'Description', None, 'descripcion', 'N/A'),
+    (CBC + 'InvoicedQuantity', None, 'cantidad', '0'),
+    (CBC + 'PriceAmount', CAC + 'Price', 'precio', '0.00'),
+    (CBC + 'LineExtensionAmount', None, 'total', '0.00'),
+)
+# Campos del documento: (etiqueta, etiqueta del padre o None, atributo de Factura, valor por defecto)
+CAMPOS_DOCUMENTO = (
+    (CBC + 'ID', None, 'numero', 'N/A'),
+    (CBC + 'IssueDate', None, 'fecha_emision', 'N/A'),
+    (CBC + 'IssueTime', None, 'hora_emision', 'N/A'),
+    (CBC + 'InvoiceTypeCode', None, 'codigo_tipo', ''),
+    (CBC + 'ID', CAC + 'DespatchDocumentReference', 'guia', 'N/A'),
+    (CBC + 'TaxableAmount', CAC + 'TaxSubtotal', 'total_venta', '0.00'),
+    (CBC + 'TaxAmount', CAC + 'TaxTotal', 'total_igv', '0.00'),
+    (CBC + 'PayableAmount', CAC + 'LegalMonetaryTotal', 'total_pagar', '0.00'),
+)
+
+
+def indexar_campos(campos):
+    """Agrupar una tabla de campos por etiqueta: {etiqueta: ((padre, clave), ...)}"""
+    indice = {}
+    for campo in campos:
+        indice.setdefault(campo[0], []).append((campo[1], campo[2]))
+    return {etiqueta: tuple(opciones) for etiqueta, opciones in indice.items()}
+
+
+INDICE_EMISOR = indexar_campos(CAMPOS_EMISOR)
+INDICE_CLIENTE = indexar_campos(CAMPOS_CLIENTE)
+INDICE_ITEM = indexar_campos(CAMPOS_ITEM)
+INDICE_DOCUMENTO = indexar_campos(CAMPOS_DOCUMENTO)
+
+# Etiquetas cuyo texto hay que conservar; el de las demás se descarta
+ETIQUETAS_TEXTO = frozenset(INDICE_EMISOR) | frozenset(INDICE_CLIENTE) | \
+    frozenset(INDICE_ITEM) | frozenset(INDICE_DOCUMENTO) | {CBC + 'Note'}
+
+
+class LectorUBL:
+    """Target para XMLParser que extrae los datos de la factura en una sola pasada
+
+    No construye el árbol: solo guarda el texto de los elementos que interesan.
+    Todo lo que está dentro de ds:Signature (firma y certificado en base64,
+    la mayor parte del archivo) se descarta sin acumular nada, salvo el
+    primer ds:DigestValue (el valor resumen que va en el QR). Para cada campo
+    se toma la primera coincidencia en orden de documento, igual que hacía
+    `find('.//...')` sobre el árbol completo.
+
+    Si se pasa `al_item`, cada línea se entrega a al_item(lector, Item) en
+    cuanto se cierra su cac:InvoiceLine, en lugar de guardarse.
+    """
+
+    def __init__(self, al_item=None):
+        self.al_item = al_item
+        self.pila = []          # Etiquetas abiertas
+        self.textos = []        # Texto de cada elemento abierto (None si no interesa)
+        self.omitir = 0         # Profundidad dentro de ds:Signature
+        self.resumen = None     # Texto de ds:DigestValue (lista mientras se lee)
+        self.documento = {}
+        self.notas = []
+        self.emisor = None
+        self.cliente = None
+        self.item = None
+        self.items = Items()
+        # Profundidad de la cac:Party del emisor/cliente y de la cac:InvoiceLine actual
+        self.nivel_emisor = None
+        self.nivel_cliente = None
+        self.nivel_item = None
+
+    def start(self, tag, attrib):
+        if self.omitir or tag == DS + 'Signature':
+            self.omitir += 1
+            if tag == DS + 'DigestValue' and self.resumen is None:
+                self.resumen = []
+            return
+
+        pila = self.pila
+        textos = self.textos
+        # Igual que ElementTree, el texto de un elemento es solo el que
+        # aparece antes de su primer hijo
+        if textos and textos[-1].__class__ is list:
+            textos[-1] = ''.join(textos[-1])
+
+        padre = pila[-1] if pila else None
+        pila.append(tag)
+
+        if tag in ETIQUETAS_TEXTO:
+            textos.append([])
+            if tag == CBC + 'ID' and self.nivel_cliente is not None and 'tipo_documento' not in self.cliente:
+                # El primer cbc:ID del cliente es su documento; schemeID dice de qué tipo
+                self.cliente['tipo_documento'] = attrib.get('schemeID', '')
+            elif tag == CBC + 'Note':
+                self.notas.append([attrib.get('languageLocaleID'), attrib.get('languageID'), None])
+            return
+
+        textos.append(None)
+        if tag == CAC + 'Party':
+            if padre == CAC + 'AccountingSupplierParty' and self.emisor is None:
+                self.emisor = {}
+                self.nivel_emisor = len(pila)
+            elif padre == CAC + 'AccountingCustomerParty' and self.cliente is None:
+                self.cliente = {}
+                self.nivel_cliente = len(pila)
+        elif tag == CAC + 'InvoiceLine' and self.item is None:
+            self.item = {}
+            self.nivel_item = len(pila)
+
+    def data(self, texto):
+        if not self.omitir:
+            actual = self.textos[-1]
+            if actual.__class__ is list:
+                actual.append(texto)
+        elif self.resumen.__class__ is list:
+            self.resumen.append(texto)
+
+    def end(self, tag):
+        if self.omitir:
+            self.omitir -= 1
+            if tag == DS + 'DigestValue' and self.resumen.__class__ is list:
+                self.resumen = ''.join(self.resumen).strip()
+            return
+
+        texto = self.textos.pop()
+        nivel = len(self.pila)
+        self.pila.pop()
+
+        if texto is None:
+            if nivel == self.nivel_emisor:
+                self.nivel_emisor = None
+            elif nivel == self.nivel_cliente:
+                self.nivel_cliente = None
+            elif nivel == self.nivel_item:
+                textos = [self.item.get(clave) or defecto for _, _, clave, defecto in CAMPOS_ITEM]
+                if self.al_item is None:
+                    self.items.agregar(*textos)
+                else:
+                    self.al_item(self, crear_item(*textos))
+                self.item = None
+                self.nivel_item = None
+            return
+
+        if texto.__class__ is list:
+            texto = ''.join(texto)
+        texto = texto or None
+        padre = self.pila[-1] if self.pila else None
+
+        if tag == CBC + 'Note':
+            # La nota se registró en start() para conservar el orden
+            self.notas[-1][2] = texto
+        self.asignar(self.documento, INDICE_DOCUMENTO.get(tag), padre, texto)
+        if self.nivel_emisor is not None:
+            self.asignar(self.emisor, INDICE_EMISOR.get(tag), padre, texto)
+        if self.nivel_cliente is not None:
+            self.asignar(self.cliente, INDICE_CLIENTE.get(tag), padre, texto)
+        if self.item is not None:
+            self.asignar(self.item, INDICE_ITEM.get(tag), padre, texto)
+
+    def close(self):
+        return self.resultado()
+
+    @staticmethod
+    def asignar(destino, opciones, padre, texto):
+        """Guardar el texto en la primera clave libre cuyo padre coincida"""
+        if opciones:
+            for padre_campo, clave in opciones:
+                if (padre_campo is None or padre_campo == padre) and clave not in destino:
+                    destino[clave] = texto
+
+    def resultado(self):
+        """Armar la Factura con los datos extraídos"""
+        factura = Factura(items=self.items)
+
+        for language_locale, language_id, note_text in self.notas:
+            note_text = note_text or ''
+            if language_locale == "1000":
+                factura.monto_letras = note_text
+            elif language_id == "L":
+                factura.forma_pago = note_text
+            else:
+                # Guardar notes no identificados
+                factura.otras_notas.append(Nota(note_text, language_locale, language_id))
+
+        documento = {clave: self.documento.get(clave, defecto)
+                     for _, _, clave, defecto in CAMPOS_DOCUMENTO}
+
+        factura.numero = documento['numero']
+        factura.fecha_emision = documento['fecha_emision']
+        factura.hora_emision = documento['hora_emision']
+        factura.guia = documento['guia']
+        factura.codigo_tipo = documento['codigo_tipo']
+        if self.resumen.__class__ is str:
+            factura.valor_resumen = self.resumen
+
+        # DETECTAR TIPO DE DOCUMENTO AUTOMÁTICAMENTE
+        numero = factura.numero
+        if numero and numero[0].upper() == 'F':
+            factura.tipo_documento = "FACTURA"
+        else:
+            factura.tipo_documento = "BOLETA DE VENTA"
+
+        if self.emisor is not None:
+            factura.emisor = Parte(**self.emisor)
+        if self.cliente is not None:
+            factura.cliente = Parte(**self.cliente)
+
+        for clave in ('total_venta', 'total_igv', 'total_pagar'):
+            setattr(factura, clave, a_entero(documento[clave], ESCALA_MONTO))
+        return factura
+
+
+def recorrer_arbol(elemento, lector):
+    """Pasar a `lector` los eventos de un árbol ya parseado, como lo haría XMLParser"""
+    lector.start(elemento.tag, elemento.attrib)
+    if elemento.text:
+        lector.data(elemento.text)
+    for hijo in elemento:
+        recorrer_arbol(hijo, lector)
+        if hijo.tail:
+            lector.data(hijo.tail)
+    lector.end(elemento.tag)
+
+
+def parsear_ubl(fuente, metricas=None, lector=None):
+    """Extraer los datos de una factura UBL (como Factura) leyendo el XML en bloques
+
+    `fuente` puede ser una ruta, un archivo abierto en modo binario, un
+    objeto con método abrir() (como comprimidos.MiembroZip), el XML en
+    memoria (bytes, bytearray o memoryview) o un árbol ya parseado
+    (ElementTree o Element). Si se pasa `metricas` (MetricasTicket), la
+    lectura del archivo y el parseo se miden por separado. `lector` permite
+    usar un LectorUBL propio (por ejemplo con al_item).
+    """
+    if metricas is None:
+        etapa = lambda nombre: contextlib.nullcontext()
+    else:
+        etapa = metricas.etapa
+    lector = lector or LectorUBL()
+
+    if isinstance(fuente, (ET.ElementTree, ET.Element)):
+        with etapa('parseo'):
+            recorrer_arbol(fuente.getroot() if isinstance(fuente, ET.ElementTree) else fuente, lector)
+            return lector.close()
+
+    parser = ET.XMLParser(target=lector)
+    if isinstance(fuente, (bytes, bytearray, memoryview)):
+        if metricas is not None:
+            metricas.contar('bytes_xml', len(fuente))
+        with etapa('parseo'):
+            parser.feed(fuente)
+            return parser.close()
+
+    with contextlib.ExitStack() as pila:
+        with etapa('lectura_xml'):
+            if hasattr(fuente, 'read'):
+                archivo = fuente
+            elif hasattr(fuente, 'abrir'):
+                archivo = pila.enter_context(fuente.abrir())
+            else:
+                archivo = pila.enter_context(open(fuente, 'rb'))
+        while True:
+            with etapa('lectura_xml'):
+                bloque = archivo.read(TAMANO_BLOQUE)
+            if not bloque:
+                break
+            if metricas is not None:
+                metricas.contar('bytes_xml', len(bloque))
+            with etapa('parseo'):
+                parser.feed(bloque)
+    with etapa('parseo'):
+        return parser.close()
+
+
+MARGEN = 2            # Márgenes izquierdo, superior y derecho (mm)
+MARGEN_CELDA = 1      # Margen interior que FPDF deja a cada lado del texto (mm)
+ALTO_MAXIMO = 800     # Alto máximo de cada página; el resto sigue en páginas nuevas (mm)
+LADO_QR = 20          # Lado del QR del pie (mm); SUNAT pide al menos 2 cm
+PUNTOS_POR_MM = 8     # Resolución de la impresora térmica (203 dpi)
+
+# Tamaño máximo de las caches de medición (entradas por proceso)
+TAMANO_CACHE_ANCHOS = 65536
+TAMANO_CACHE_LINEAS = 16384
+TAMANO_CACHE_PLANTILLAS = 1024
+TAMANO_CACHE_QR = 4096
+
+_medidor = None
+
+
+def pdf_medicion():
+    """FPDF del proceso que solo se usa para medir textos (nunca se dibuja)"""
+    global _medidor
+    if _medidor is None:
+        _medidor = FPDF(orientation='P', unit='mm')
+    return _medidor
+
+
+@functools.lru_cache(maxsize=TAMANO_CACHE_ANCHOS)
+def ancho_texto(familia, estilo, tamano, texto):
+    """Ancho en mm de `texto` con la fuente indicada
+
+    Los nombres de productos, unidades y datos del emisor se repiten en miles
+    de tickets, así que el resultado se guarda en una cache del proceso.
+    """
+    medidor = pdf_medicion()
+    medidor.set_font(familia, estilo, tamano)
+    return medidor.get_string_width(texto)
+
+
+@functools.lru_cache(maxsize=TAMANO_CACHE_LINEAS)
+def envolver_texto(familia, estilo, tamano, texto, ancho):
+    """Partir el texto en líneas que entren en `ancho` (por palabras, como FPDF)"""
+    def medir(cadena):
+        return ancho_texto(familia, estilo, tamano, cadena)
+
+    lineas = []
+    for parrafo in texto.split('\n'):
+        actual = ''
+        for palabra in parrafo.split(' '):
+            prueba = f"{actual} {palabra}" if actual else palabra
+            if medir(prueba) <= ancho:
+                actual = prueba
+                continue
+            if actual:
+                lineas.append(actual)
+            # Palabra más larga que la línea: cortarla por caracteres
+            while len(palabra) > 1 and medir(palabra) > ancho:
+                corte = len(palabra) - 1
+                while corte > 1 and medir(palabra[:corte]) > ancho:
+                    corte -= 1
+                lineas.append(palabra[:corte])
+                palabra = palabra[corte:]
+            actual = palabra
+        lineas.append(actual)
+    return tuple(lineas)
+
+
+@functools.lru_cache(maxsize=TAMANO_CACHE_QR)
+def trazado_qr(texto):
+    """(módulos por lado, rectángulos del QR de `texto` en operadores PDF)
+
+    Los rectángulos están en coordenadas de módulo; dibujar_qr los escala y
+    ubica con una matriz. Los reintentos y reimpresiones del mismo
+    comprobante reutilizan el trazado.
+    """
+    tamano, filas = matriz_qr(texto)
+    return tamano, " ".join(f"{x} {y} {ancho} {alto} re" for x, y, ancho, alto in rectangulos(filas))
+
+
+@functools.lru_cache(maxsize=TAMANO_CACHE_QR)
+def mascara_qr(texto):
+    """(módulos por lado, filas del QR de `texto` en hexadecimal) para el PDF compacto
+
+    Cada fila ocupa bytes enteros, con la columna de la izquierda en el bit
+    más alto.
+    """
+    tamano, filas = matriz_qr(texto)
+    relleno = -tamano % 8
+    digitos = (tamano + relleno) // 4
+    # El bit x de la fila es la columna x: se invierte el orden de los bits
+    return tamano, "".join(format(int(format(fila, f"0{tamano}b")[::-1], 2) << relleno, f"0{digitos}x")
+                           for fila in filas)
+
+
+def dibujar_qr(pdf, texto, x, y, lado):
+    """Dibujar el QR como vectores (un solo relleno) con la esquina superior izquierda en (x, y)
+
+    En un PDFCompacto va como máscara de 1 bit en línea dentro del
+    contenido: ocupa menos que los rectángulos y no agrega objetos al PDF.
+    """
+    if isinstance(pdf, PDFCompacto):
+        tamano, modulos = mascara_qr(texto)
+        lado_puntos = lado * pdf.k
+        pdf._out(f"q 0 g {lado_puntos:.2f} 0 0 {lado_puntos:.2f} {x * pdf.k:.2f} {(pdf.h - y - lado) * pdf.k:.2f} cm "
+                 f"BI /W {tamano} /H {tamano} /IM true /D [1 0] /F /AHx ID {modulos}> EI Q")
+        return
+    tamano, trazado = trazado_qr(texto)
+    escala = lado * pdf.k / tamano
+    # La matriz invierte el eje y: las filas del QR crecen hacia abajo como en el ticket
+    pdf._out(f"q 0 g {escala:.4f} 0 0 {-escala:.4f} {x * pdf.k:.2f} {(pdf.h - y) * pdf.k:.2f} cm "
+             f"{trazado} f Q")
+
+
+def estadisticas_cache():
+    """Aciertos y fallos de las caches de medición de este proceso"""
+    estadisticas = {}
+    for nombre, funcion in (('anchos', ancho_texto), ('lineas', envolver_texto),
+                            ('plantillas', plantilla_emisor), ('qr', trazado_qr),
+                            ('qr_compacto', mascara_qr)):
+        info = funcion.cache_info()
+        estadisticas[nombre] = {'aciertos': info.hits, 'fallos': info.misses,
+                                'entradas': info.currsize, 'maximo': info.maxsize}
+    return estadisticas
+
+
+# Cada cuántos segundos se vuelve a revisar el mtime de una imagen registrada
+INTERVALO_REVISION_IMAGENES = 5.0
+
+
+class RegistroImagenes:
+    """Imágenes decodificadas una sola vez por proceso, listas para insertar en FPDF
+
+    El logo es el mismo en todos los tickets de un lote. Cada archivo se
+    decodifica una vez (get_img_info de fpdf2) y se vuelve a leer solo si
+    cambia su mtime; el mtime se revisa como máximo cada
+    INTERVALO_REVISION_IMAGENES segundos.
+    """
+
+    def __init__(self):
+        self.entradas = {}  # ruta -> [mtime o None, info decodificada o None, última revisión]
+
+    def entrada(self, ruta):
+        ahora = time.monotonic()
+        entrada = self.entradas.get(ruta)
+        if entrada is not None and ahora - entrada[2] < INTERVALO_REVISION_IMAGENES:
+            return entrada
+
+        try:
+            mtime = os.stat(ruta).st_mtime_ns
+        except OSError:
+            mtime = None
+        if entrada is None or entrada[0] != mtime:
+            entrada = [mtime, None, ahora]
+            self.entradas[ruta] = entrada
+        else:
+            entrada[2] = ahora
+        return entrada
+
+    def existe(self, ruta):
+        return self.entrada(ruta)[0] is not None
+
+    def info(self, ruta):
+        """Datos de la imagen ya decodificados (sin los campos propios de cada PDF)"""
+        entrada = self.entrada(ruta)
+        if entrada[0] is None:
+            raise FileNotFoundError(ruta)
+        if entrada[1] is None:
+            entrada[1] = get_img_info(ruta)
+        return entrada[1]
+
+    def info_compacta(self, ruta, ancho_puntos):
+        """Datos de la imagen en 1 bit y `ancho_puntos` de ancho, para el PDF compacto"""
+        mtime = self.entrada(ruta)[0]
+        if mtime is None:
+            raise FileNotFoundError(ruta)
+        return imagen_compacta(ruta, mtime, ancho_puntos)
+
+    def insertar(self, pdf, ruta, x, y, w):
+        """Dibujar la imagen en `pdf` sin que fpdf2 vuelva a decodificarla
+
+        En un PDFCompacto va la versión de 1 bit a la resolución de la
+        impresora térmica, con su propia clave en pdf.images.
+        """
+        ancho_puntos = round(w * PUNTOS_POR_MM) if isinstance(pdf, PDFCompacto) else None
+        clave = f"{ruta}#{ancho_puntos}" if ancho_puntos else ruta
+        if clave not in pdf.images:
+            # Misma preparación que FPDF.preload_image, pero con los datos ya decodificados
+            info = ImageInfo(self.info_compacta(ruta, ancho_puntos) if ancho_puntos else self.info(ruta))
+            info["i"] = len(pdf.images) + 1
+            info["usages"] = 0
+            info["iccp_i"] = None
+            iccp = info.get("iccp")
+            if iccp:
+                if iccp not in pdf.icc_profiles:
+                    pdf.icc_profiles[iccp] = len(pdf.icc_profiles)
+                info["iccp_i"] = pdf.icc_profiles[iccp]
+                info["iccp"] = None
+            pdf.images[clave] = info
+        pdf.image(clave, x=x, y=y, w=w)
+
+
+IMAGENES = RegistroImagenes()
+# Tabla para invertir los bits de cada byte (1 = punto negro de la impresora -> 0 = negro en DeviceGray)
+INVERTIR_BITS = bytes(range(255, -1, -1))
+
+
+@functools.lru_cache(maxsize=64)
+def imagen_compacta(ruta, mtime, ancho_puntos):
+    """Imagen para el PDF compacto: la misma conversión a 1 bit de la salida ESC/POS, comprimida
+
+    Se convierte y comprime una vez por versión del archivo y ancho.
+    """
+    from escpos import imagen_1bit
+
+    alto_puntos, bits = imagen_1bit(ruta, mtime, ancho_puntos)
+    return {'w': ancho_puntos, 'h': alto_puntos, 'cs': 'DeviceGray', 'bpc': 1, 'f': 'FlateDecode', 'dp': '',
+            'data': zlib.compress(bits.translate(INVERTIR_BITS), 9)}
+
+
+class Pagina:
+    """Una página maquetada: lista de dibujo y alto exacto"""
+
+    def __init__(self, comandos, alto):
+        self.comandos = comandos
+        self.alto = alto
+
+    def dibujar(self, pdf, metricas=None):
+        """Reproducir la lista de dibujo sobre la página actual de `pdf`
+
+        Con `metricas`, el tiempo de carga e inserción de imágenes se suma a
+        la etapa "imagenes" y el de los códigos QR a la etapa "qr".
+        """
+        for comando in self.comandos:
+            tipo = comando[0]
+            if tipo == 'celda':
+                _, x, y, w, h, texto, borde, align = comando
+                pdf.set_xy(x, y)
+                pdf.cell(w, h, texto, borde, align=align)
+            elif tipo == 'fuente':
+                pdf.set_font(*comando[1:])
+            elif tipo == 'imagen':
+                _, ruta, x, y, w = comando
+                try:
+                    if metricas is None:
+                        IMAGENES.insertar(pdf, ruta, x, y, w)
+                    else:
+                        with metricas.etapa('imagenes'):
+                            IMAGENES.insertar(pdf, ruta, x, y, w)
+                except Exception as e:
+                    LOG.error("Error al cargar imagen %s: %s", ruta, e)
+            elif tipo == 'qr':
+                if metricas is None:
+                    dibujar_qr(pdf, *comando[1:])
+                else:
+                    with metricas.etapa('qr'):
+                        dibujar_qr(pdf, *comando[1:])
+
+
+class Maquetacion:
+    """Resultado de maquetar un ticket: una o más páginas de alto exacto"""
+
+    def __init__(self, paginas):
+        self.paginas = paginas
+
+    @property
+    def alto(self):
+        """Alto total del ticket (suma de sus páginas)"""
+        return sum(pagina.alto for pagina in self.paginas)
+
+
+class Maquetador:
+    """Cursor con la misma interfaz básica que FPDF (cell, multi_cell, ln, image)
+
+    En lugar de dibujar, mide cada texto una sola vez y guarda el elemento con
+    su posición absoluta en una lista de dibujo. Al terminar, la posición final
+    del cursor da el alto exacto de la página.
+
+    Si el contenido no entra en `alto_maximo`, se continúa en una página
+    nueva (como el salto automático de FPDF, pero solo al inicio de una
+    línea). Con `al_cerrar_pagina`, cada página terminada se entrega a esa
+    función en lugar de guardarse, para dibujarla y liberarla enseguida.
+    """
+
+    def __init__(self, ancho, alto_maximo=ALTO_MAXIMO, al_cerrar_pagina=None):
+        self.ancho = ancho
+        self.alto_maximo = alto_maximo
+        self.al_cerrar_pagina = al_cerrar_pagina
+        self.x = MARGEN
+        self.y = MARGEN
+        self.comandos = []
+        self.paginas = []
+        self.fuente = None
+
+    def set_font(self, familia, estilo='', tamano=8):
+        self.fuente = (familia, estilo, tamano)
+        self.comandos.append(('fuente', familia, estilo, tamano))
+
+    def get_string_width(self, texto):
+        return ancho_texto(*self.fuente, texto)
+
+    def get_x(self):
+        return self.x
+
+    def get_y(self):
+        return self.y
+
+    def set_xy(self, x, y):
+        self.x = x
+        self.y = y
+
+    def set_y(self, y):
+        self.x = MARGEN
+        self.y = y
+
+    def ln(self, h):
+        self.x = MARGEN
+        self.y += h
+
+    def asegurar(self, alto):
+        """Pasar a una página nueva si `alto` no entra en la actual
+
+        Devuelve True si hubo salto de página. Una página vacía nunca se
+        salta: un elemento más alto que la página la hace crecer.
+        """
+        if self.alto_maximo is None or self.y + alto + MARGEN <= self.alto_maximo or self.y <= MARGEN:
+            return False
+        self.nueva_pagina()
+        return True
+
+    def nueva_pagina(self):
+        self.cerrar_pagina()
+        self.x = MARGEN
+        self.y = MARGEN
+        if self.fuente:
+            self.comandos.append(('fuente', *self.fuente))
+
+    def cerrar_pagina(self):
+        pagina = Pagina(self.comandos, self.y + MARGEN)
+        self.comandos = []
+        if self.al_cerrar_pagina is None:
+            self.paginas.append(pagina)
+        else:
+            self.al_cerrar_pagina(pagina)
+
+    def cell(self, w, h, txt='', border=0, ln=0, align='L'):
+        if self.x == MARGEN:
+            self.asegurar(h)
+        if w == 0:
+            w = self.ancho - MARGEN - self.x
+        self.comandos.append(('celda', self.x, self.y, w, h, txt, border, align.upper()))
+        if ln:
+            self.ln(h)
+        else:
+            self.x += w
+
+    def lineas(self, w, txt):
+        """Líneas en que multi_cell partiría `txt` con ancho `w`"""
+        if w == 0:
+            w = self.ancho - MARGEN - self.x
+        return envolver_texto(*self.fuente, txt, w - 2 * MARGEN_CELDA)
+
+    def multi_cell(self, w, h, txt, border=0, align='L'):
+        """Texto en varias líneas; el cursor queda al inicio de la línea siguiente"""
+        if w == 0:
+            w = self.ancho - MARGEN - self.x
+        align = align.upper()
+        if align == 'J':
+            # cell() no puede justificar una línea suelta
+            align = 'L'
+
+        lineas = self.lineas(w, txt)
+        if self.x == MARGEN:
+            # El párrafo no se parte entre páginas
+            self.asegurar(h * len(lineas))
+        for i, linea in enumerate(lineas):
+            self.comandos.append(('celda', self.x, self.y + i * h, w, h, linea, 0, align))
+        if border:
+            self.comandos.append(('celda', self.x, self.y, w, h * len(lineas), '', border, 'L'))
+        self.ln(h * len(lineas))
+
+    def image(self, ruta, x, y, w):
+        self.comandos.append(('imagen', ruta, x, y, w))
+
+    def qr(self, texto, x, y, lado):
+        """Código QR de `texto`, cuadrado de `lado` mm con la esquina superior izquierda en (x, y)"""
+        self.comandos.append(('qr', texto, x, y, lado))
+
+    def estampar(self, plantilla):
+        """Copiar un bloque ya maquetado desde el inicio de la página (ver plantilla_emisor)"""
+        comandos, y, fuente = plantilla
+        self.comandos.extend(comandos)
+        self.x = MARGEN
+        self.y = y
+        self.fuente = fuente
+
+    def terminar(self):
+        self.cerrar_pagina()
+        return Maquetacion(self.paginas)
+
+
+@functools.lru_cache(maxsize=TAMANO_CACHE_PLANTILLAS)
+def plantilla_emisor(ancho, logo, version_logo, *, ruc, nombre, direccion, distrito, departamento, correo):
+    """Bloque superior del ticket (logo, emisor y separador) ya maquetado
+
+    Es el mismo para todos los tickets de un emisor, así que se maqueta una
+    vez por RUC y datos del emisor que se dibujan (y versión del logo: su
+    mtime, o None si no existe) y cada ticket lo estampa con
+    Maquetador.estampar(). Los datos van por nombre, así la clave del cache
+    no depende de los campos de Parte. Devuelve (comandos, y final, fuente
+    final).
+    """
+    m = Maquetador(ancho, alto_maximo=None)
+
+    # AGREGAR IMAGEN EN EL ENCABEZADO CON MÁS OPCIONES
+    image_x = 20  # Posición X (centrada para 80mm: (80-40)/2 = 20)
+    image_y = 5   # Posición Y desde arriba
+    image_width = 40  # Ancho de la imagen (60mm para dejar márgenes)
+
+    if version_logo is not None:
+        # Insertar imagen centrada
+        m.image(logo, x=image_x, y=image_y, w=image_width)
+
+        # Calcular altura de la imagen para ajustar el espacio
+        # (asumiendo relación de aspecto 3:1 para logos)
+        image_height = image_width / 3
+        m.ln(image_height + 2)  # Espacio después de la imagen
+    else:
+        m.ln(5)
+    m.ln(5)  # Espacio normal si no hay imagen
+
+    # Configuración de fuentes
+    m.set_font("Arial", 'B', 8)
+
+    # Emisor nombre (centrado)
+    if len(nombre) > 35:
+        m.multi_cell(0, 4, nombre, 0, 'C')
+    else:
+        m.cell(0, 4, nombre, 0, 1, 'C')
+
+    # RUC (centrado, sin texto "RUC:")
+    m.set_font("Arial", '', 8)
+    m.cell(0, 4, f"RUC: {ruc}", 0, 1, 'C')
+
+    # Dirección completa (centrada, sin texto "Dirección:")
+    direccion_completa = f"{direccion}"
+    if distrito:
+        direccion_completa += f" - {distrito}"
+    if departamento:
+        direccion_completa += f" - {departamento}"
+
+    if len(direccion_completa) > 35:
+        m.multi_cell(0, 4, direccion_completa, 0, 'C')
+    else:
+        m.cell(0, 4, direccion_completa, 0, 1, 'C')
+
+    m.ln(1)
+    m.cell(0, 4, correo, 0, 1, 'C')
+    m.ln(1)
+
+    # Línea separadora
+    m.cell(0, 1, "", "T", 1)
+    m.ln(2)
+
+    return tuple(m.comandos), m.y, m.fuente
+
+
+# Columnas de la tabla de items (mm): COD, CANT, UNID, DESC, V.UNIT, V.VENTA
+ANCHURAS_TABLA = (6, 16, 8, 20, 10, 16)
+ENCABEZADOS_TABLA = ("COD", "CANT.", "UNID.", "DESCRIPCION", "V.UNIT", "V.VENTA")
+
+
+class SalidaCompacta(OutputProducer):
+    """Serializador de PDFCompacto: el catálogo sin acción de apertura"""
+
+    def _finalize_catalog(self, catalog_obj, **kwargs):
+        super()._finalize_catalog(catalog_obj, **kwargs)
+        catalog_obj.open_action = None
+
+
+class PDFCompacto(FPDF):
+    """FPDF del perfil compacto (--formato compacto), para archivar y transmitir tickets
+
+    El logo va en 1 bit a la resolución de la impresora térmica
+    (RegistroImagenes.insertar) y el QR como máscara en línea (dibujar_qr);
+    el texto usa las fuentes estándar de PDF, que no se incrustan. Sin
+    fecha de creación, /ID ni preferencias de visualización, el mismo
+    comprobante produce siempre los mismos bytes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.creation_date = None
+        self.page_layout = None
+
+    def file_id(self):
+        return None
+
+    def output(self, *args, **kwargs):
+        kwargs.setdefault('output_producer_class', SalidaCompacta)
+        return super().output(*args, **kwargs)
+
+
+def crear_pdf(ancho, alto, compacto=False):
+    """FPDF vacío con la configuración de los tickets (márgenes mínimos, sin salto automático)
+
+    Con `compacto`, un PDFCompacto.
+    """
+    pdf = (PDFCompacto if compacto else FPDF)(orientation='P', unit='mm', format=(ancho, alto))
+    pdf.set_margins(left=MARGEN, top=MARGEN, right=MARGEN)  # Márgenes mínimos
+    pdf.set_auto_page_break(auto=False)  # Desactivar auto page break
+    return pdf
+
+
+class XMLInvalido(ValueError):
+    """El XML del comprobante no se pudo leer"""
+
 
 class FacturaXMLtoPDF:
     def __init__(self, xml_path, output_path):
         self.xml_path = xml_path
         self.output_path = output_path
-        self.data = {}
+        self.factura = None  # Factura (modelo.py) que produce parse_xml
+        self.maquetacion = None
+        self.metricas = MetricasTicket()
+        self.error = None  # Mensaje del último error de parseo
+        self.causa = None  # Excepción que lo produjo (un OSError es un fallo transitorio)
         self.line_height = 4
+        self.alto_pagina = ALTO_MAXIMO  # None: una sola página sin límite (rollo continuo)
+        self.streaming = False  # True si se convirtió en streaming (self.factura queda sin items)
         self.page_width = 80  # Ancho para impresora de 80mm
         
     def parse_xml(self):
         """Parsear el archivo XML de la factura"""
         try:
-            tree = ET.parse(self.xml_path)
-            root = tree.getroot()
-            
-            # Namespaces comunes en facturas electrónicas
-            namespaces = {
-                'cbc': 'urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2',
-                'cac': 'urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2'
-            }
-
-            # Inicializar datos
-            self.data['monto_letras'] = ''
-            self.data['forma_pago'] = ''
-            self.data['otras_notes'] = []
-            
-            # Extraer todos los notes
-            notes = root.findall('.//cbc:Note', namespaces)
-            for note in notes:
-                note_text = note.text or ''
-                language_locale = note.get('languageLocaleID')
-                language_id = note.get('languageID')
-                
-                if language_locale == "1000":
-                    self.data['monto_letras'] = note_text
-                elif language_id == "L":
-                    self.data['forma_pago'] = note_text
-                else:
-                    # Guardar notes no identificados
-                    self.data['otras_notes'].append({
-                        'texto': note_text,
-                        'languageLocaleID': language_locale,
-                        'languageID': language_id
-                    })
-
-        
-            # Extraer datos básicos
-            self.data['numero_factura'] = self.get_text(root, './/cbc:ID', namespaces)
-            self.data['fecha_emision'] = self.get_text(root, './/cbc:IssueDate', namespaces)
-            self.data['hora_emision'] = self.get_text(root, './/cbc:IssueTime', namespaces)
-            
-            # DETECTAR TIPO DE DOCUMENTO AUTOMÁTICAMENTE
-            numero = self.data.get('numero_factura', '')
-            if numero and numero[0].upper() == 'F':
-                self.data['tipo_documento'] = "FACTURA"
-            else:
-                self.data['tipo_documento'] = "BOLETA DE VENTA"
-
-            
-
-            
-            # Datos del emisor
-            emisor = root.find('.//cac:AccountingSupplierParty/cac:Party', namespaces)
-            if emisor is not None:
-                self.data['emisor_nombre'] = self.get_text(emisor, './/cbc:Name', namespaces)
-                self.data['emisor_ruc'] = self.get_text(emisor, './/cbc:ID', namespaces)
-                self.data['emisor_direccion'] = self.get_text(emisor, './/cac:AddressLine/cbc:Line', namespaces)
-                self.data['emisor_distrito'] = self.get_text(emisor, './/cbc:District', namespaces)
-                self.data['emisor_departamento'] = self.get_text(emisor, './/cbc:CityName', namespaces)
-                self.data['correo_emisor'] = self.get_text(emisor, './/cbc:ElectronicMail', namespaces)
-            
-            # Datos del cliente
-            cliente = root.find('.//cac:AccountingCustomerParty/cac:Party', namespaces)
-            if cliente is not None:
-                self.data['cliente_nombre'] = self.get_text(cliente, './/cbc:RegistrationName', namespaces)
-                self.data['cliente_ID'] = self.get_text(cliente, './/cbc:ID', namespaces)
-                self.data['cliente_direccion'] = self.get_text(cliente, './/cac:AddressLine/cbc:Line', namespaces)
-                self.data['cliente_distrito'] = self.get_text(cliente, './/cbc:District', namespaces)
-                self.data['cliente_departamento'] = self.get_text(cliente, './/cbc:CityName', namespaces)
-
-            self.data['cliente_guia'] = self.get_text(root, './/cac:DespatchDocumentReference/cbc:ID', namespaces)
-            
-            # Totales
-            self.data['total_venta'] = self.get_text(root, './/cac:TaxSubtotal/cbc:TaxableAmount', namespaces, '0.00')
-            self.data['total_igv'] = self.get_text(root, './/cac:TaxTotal/cbc:TaxAmount', namespaces, '0.00')
-            self.data['total_pagar'] = self.get_text(root, './/cac:LegalMonetaryTotal/cbc:PayableAmount', namespaces, '0.00')
-            
-            # Items de la factura
-            self.data['items'] = []
-            for item in root.findall('.//cac:InvoiceLine', namespaces):
-                item_data = {}
-                item_data['id'] = self.get_text(item, './/cac:SellersItemIdentification/cbc:ID', namespaces)
-                item_data['unidad'] = self.get_text(item, './/cbc:Note', namespaces)
-                item_data['descripcion'] = self.get_text(item, './/cbc:Description', namespaces)
-                item_data['cantidad'] = self.get_text(item, './/cbc:InvoicedQuantity', namespaces, '0')
-                item_data['precio_unitario'] = self.get_text(item, './/cac:Price/cbc:PriceAmount', namespaces, '0.00')
-                item_data['total'] = self.get_text(item, './/cbc:LineExtensionAmount', namespaces, '0.00')
-                
-                self.data['items'].append(item_data)
-                
+            self.factura = parsear_ubl(self.xml_path, self.metricas)
+            self.metricas.contar('items', len(self.factura.items))
             return True
             
         except Exception as e:
-            print(f"Error al parsear XML: {e}")
+            self.error = f"Error al parsear XML: {e}"
+            self.causa = e
+            LOG.error(self.error)
             return False
     
-    def get_text(self, element, xpath, namespaces, default='N/A'):
-        """Helper para obtener texto de elementos XML de forma segura"""
-        result = element.find(xpath, namespaces)
-        return result.text if result is not None else default
-    
-    def format_currency(self, amount):
-        """Formatear montos monetarios"""
-        try:
-            return f"S/. {float(amount):.2f}"
-        except:
-            return f"S/. 0.00"
+    @property
+    def data(self):
+        """Los datos en el diccionario de textos de versiones anteriores"""
+        return self.factura.como_dict() if self.factura is not None else {}
+
+    def format_currency(self, centimos):
+        """Formatear montos monetarios (en céntimos)"""
+        return f"S/. {texto_monto(centimos)}"
         
     def calcular_lineas_texto(self, texto, ancho_maximo, font_size=6):
         #"""Calcular cuántas líneas ocupa un texto"""
@@ -128,388 +878,678 @@ class FacturaXMLtoPDF:
         return max(1, (len(texto) // caracteres_por_linea) + 1)
     
     def calculate_total_height(self):
-        """Calcular la altura total necesaria para el PDF simulando el renderizado"""
-        # Crear PDF temporal para medición
-        pdf_temp = FPDF(orientation='P', unit='mm', format=(self.page_width, 300))
-        pdf_temp.set_margins(left=2, top=2, right=2)
-        pdf_temp.add_page()
-        pdf_temp.set_font("Arial", '', 8)
-        
-        # Variables para tracking de altura
-        y_position = 2  # Comenzar desde el margen superior
-        
-        # 1. Logo (si existe)
-        try:
-            if os.path.exists("images/logo_manchester.png"):
-                y_position += 25 + 2  # 25mm de imagen + 2mm de espacio
-        except:
-            pass
-        
-        # 2. Datos del emisor
-        emisor_nombre = self.data.get('emisor_nombre', 'N/A')
-        y_position += pdf_temp.get_string_width(emisor_nombre) > 70 and 8 or 4
-        
-        ruc = self.data.get('emisor_ruc', 'N/A')
-        y_position += 4
-        
-        direccion = f"{self.data.get('emisor_direccion', '')} - {self.data.get('emisor_distrito', '')} - {self.data.get('emisor_departamento', '')}"
-        y_position += pdf_temp.get_string_width(direccion) > 70 and 8 or 4
-        
-        correo = self.data.get('correo_emisor', 'N/A')
-        y_position += pdf_temp.get_string_width(correo) > 70 and 8 or 4
-        
-        y_position += 6  # Espacio después de datos emisor
-        
-        # 3. Encabezado (tipo documento y número)
-        y_position += 10
-        
-        # 4. Datos del cliente
-        cliente_nombre = self.data.get('cliente_nombre', 'N/A')
-        y_position += pdf_temp.get_string_width(cliente_nombre) > 35 and 8 or 4
-        
-        cliente_dir = f"{self.data.get('cliente_direccion', '')} - {self.data.get('cliente_distrito', '')} - {self.data.get('cliente_departamento', '')}"
-        if cliente_dir.strip() not in ['', ' -  - ']:
-            y_position += pdf_temp.get_string_width(cliente_dir) > 35 and 8 or 4
-        
-        y_position += 6  # Espacio después de datos cliente
-        
-        # 5. Forma de pago
-        forma_pago = self.data.get('forma_pago', '')
-        y_position += 4 if forma_pago else 0
-        
-        y_position += 4  # Espacio extra
-        
-        # 6. Items de la factura (calculado de manera precisa)
-        pdf_temp.set_font("Arial", '', 6)
-        for item in self.data.get('items', []):
-            descripcion = str(item.get('descripcion', ''))
-            # Calcular líneas exactas que ocupará la descripción
-            lineas = 1
-            if descripcion:
-                ancho_disponible = 20  # Ancho de la columna descripción
-                palabras = descripcion.split()
-                linea_actual = ""
-                
-                for palabra in palabras:
-                    prueba_linea = f"{linea_actual} {palabra}".strip()
-                    if pdf_temp.get_string_width(prueba_linea) <= ancho_disponible:
-                        linea_actual = prueba_linea
-                    else:
-                        lineas += 1
-                        linea_actual = palabra
-                
-            y_position += max(lineas, 1) * 4  # 4mm por línea
-        
-        y_position += 8  # Espacio después de items
-        
-        # 7. Totales
-        y_position += 15
-        
-        # 8. Monto en letras
-        monto_letras = self.data.get('monto_letras', '')
-        if monto_letras:
-            lineas_monto = max(1, int(pdf_temp.get_string_width(monto_letras) / 70) + 1)
-            y_position += lineas_monto * 4
-        
-        # 10. Imagen del pie
-        y_position += 50  # Espacio para imagen
-        
-        # Limitar entre mínimo y máximo razonable
-        return max(100, min(800, y_position))
+        """Calcular la altura total necesaria para el PDF
 
+        La altura sale de la maquetación real del ticket (la misma que se
+        dibuja después), así que no hay estimaciones que se desvíen.
+        """
+        return self.layout().alto
 
-    def generate_pdf(self):
-        """Generar PDF para impresora de 80mm con alto automático"""
-        # Calcular alto automático
-        page_height = self.calculate_total_height()
-        
-        # Crear PDF con márgenes mínimos
-        pdf = FPDF(orientation='P', unit='mm', format=(self.page_width, page_height))
-        pdf.set_margins(left=2, top=2, right=2)  # Márgenes mínimos
-        pdf.set_auto_page_break(auto=False)  # Desactivar auto page break
-        
-        pdf.add_page()
-    
-        # AGREGAR IMAGEN EN EL ENCABEZADO CON MÁS OPCIONES
-        image_path = "images/logo_manchester.png"
-        image_x = 20  # Posición X (centrada para 80mm: (80-40)/2 = 20)
-        image_y = 5   # Posición Y desde arriba
-        image_width = 40  # Ancho de la imagen (60mm para dejar márgenes)
-        
-        try:
-            if os.path.exists(image_path):
-                # Insertar imagen centrada
-                pdf.image(image_path, x=image_x, y=image_y, w=image_width)
-                
-                # Calcular altura de la imagen para ajustar el espacio
-                # (asumiendo relación de aspecto 3:1 para logos)
-                image_height = image_width / 3
-                pdf.ln(image_height + 2)  # Espacio después de la imagen
-            else:
-                print(f"Advertencia: No se encontró {image_path}")
-                # Crear directorio si no existe
-                os.makedirs("images", exist_ok=True)
-                pdf.ln(5)
-        except Exception as e:
-            print(f"Error al cargar imagen {image_path}: {e}")
-        pdf.ln(5)  # Espacio normal si no hay imagen
-        
-        # Configuración de fuentes
-        pdf.set_font("Arial", 'B', 8)
+    def layout(self):
+        """Maquetar el ticket una sola vez y guardar la lista de dibujo en self.maquetacion"""
+        if self.maquetacion is not None:
+            return self.maquetacion
 
-        # Emisor nombre (centrado)
-        emisor_nombre = self.data.get('emisor_nombre', 'N/A')
-        if len(emisor_nombre) > 35:
-            pdf.multi_cell(0, 4, emisor_nombre, 0, 'C')
-        else:
-            pdf.cell(0, 4, emisor_nombre, 0, 1, 'C')
-
-        # RUC (centrado, sin texto "RUC:")
-        pdf.set_font("Arial", '', 8)
-        pdf.cell(0, 4, f"RUC: {self.data.get('emisor_ruc', 'N/A')}", 0, 1, 'C')
-
-        # Dirección completa (centrada, sin texto "Dirección:")
-        emisor_dir = self.data.get('emisor_direccion', '')
-        emisor_dis = self.data.get('emisor_distrito', '')
-        emisor_dep = self.data.get('emisor_departamento', '')
-
-        # Formatear la dirección correctamente
-        direccion_completa = f"{emisor_dir}"
-        if emisor_dis:
-            direccion_completa += f" - {emisor_dis}"
-        if emisor_dep:
-            direccion_completa += f" - {emisor_dep}"
-
-        if len(direccion_completa) > 35:
-            pdf.multi_cell(0, 4, direccion_completa, 0, 'C')
-        else:
-            pdf.cell(0, 4, direccion_completa, 0, 1, 'C')
-        
-        pdf.ln(1)
-        pdf.cell(0, 4, self.data.get('correo_emisor', 'N/A'), 0, 1, 'C')        
-        pdf.ln(1)
-        
-        # Línea separadora
-        pdf.cell(0, 1, "", "T", 1)
-        pdf.ln(2)
+        antes = estadisticas_cache()
+        with self.metricas.etapa('maquetacion'):
+            self.maquetacion = self.maquetar()
+        self.contar_cache(antes)
+        return self.maquetacion
+
+    def contar_cache(self, antes):
+        """Sumar a las métricas los aciertos y fallos de cache desde `antes`"""
+        despues = estadisticas_cache()
+        for nombre in despues:
+            self.metricas.contar('cache_aciertos', despues[nombre]['aciertos'] - antes[nombre]['aciertos'])
+            self.metricas.contar('cache_fallos', despues[nombre]['fallos'] - antes[nombre]['fallos'])
+
+    def maquetar(self):
+        """Armar la lista de dibujo del ticket (usar layout(), que la guarda)"""
+        m = Maquetador(self.page_width, self.alto_pagina)
+        f = self.factura or Factura()
+        self.maquetar_encabezado(m, f)
+        with self.metricas.etapa('tabla'):
+            for item in f.items:
+                self.maquetar_item(m, item)
+        self.maquetar_pie(m, f)
+        return m.terminar()
+
+    def maquetar_encabezado(self, m, f):
+        """Logo, emisor, documento y cliente, hasta el encabezado de la tabla de items"""
+        # Sin cac:Party en el XML, la dirección y el ID del cliente quedan vacíos
+        emisor = f.emisor or Parte(direccion='', distrito='', departamento='')
+        cliente = f.cliente or Parte(id='', direccion='', distrito='', departamento='')
+
+        # Logo y datos del emisor: iguales en todos los tickets del mismo RUC
+        logo = "images/logo_manchester.png"
+        version_logo = IMAGENES.entrada(logo)[0]
+        if version_logo is None:
+            LOG.warning("Advertencia: No se encontró %s", logo)
+            # Crear directorio si no existe
+            os.makedirs("images", exist_ok=True)
+        m.estampar(plantilla_emisor(self.page_width, logo, version_logo, ruc=emisor.id, nombre=emisor.nombre,
+                                    direccion=emisor.direccion, distrito=emisor.distrito,
+                                    departamento=emisor.departamento, correo=emisor.correo))
 
         # Encabezado - CENTRADO
-        pdf.set_font("Arial", 'B', 10)
-        pdf.cell(0, 5, f"{self.data.get('tipo_documento', 'COMPROBANTE')} ELECTRÓNICA", 0, 1, 'C')
-        pdf.set_font("Arial", '', 8)
-        pdf.cell(0, 4, self.data.get('numero_factura', 'N/A'), 0, 1, 'C')
-        pdf.ln(2)
+        m.set_font("Arial", 'B', 10)
+        m.cell(0, 5, f"{f.tipo_documento} ELECTRÓNICA", 0, 1, 'C')
+        m.set_font("Arial", '', 8)
+        m.cell(0, 4, f.numero, 0, 1, 'C')
+        m.ln(2)
 
         # Línea separadora
-        pdf.cell(0, 1, "", "T", 1)
-        pdf.ln(2)
-        
+        m.cell(0, 1, "", "T", 1)
+        m.ln(2)
+
         # Información del cliente
-        pdf.set_font("Arial", '', 8)
+        m.set_font("Arial", '', 8)
         # Obtener el ID del cliente
-        cliente_id = self.data.get('cliente_ID', '')
+        cliente_id = cliente.id
 
         # Determinar el tipo de documento según la longitud
         if len(cliente_id) == 11:  # RUC tiene 11 dígitos
-            pdf.cell(0, 4, f"RUC: {cliente_id}", 0, 1)
+            m.cell(0, 4, f"RUC: {cliente_id}", 0, 1)
         elif len(cliente_id) == 8:  # DNI tiene 8 dígitos
-            pdf.cell(0, 4, f"DNI: {cliente_id}", 0, 1)
+            m.cell(0, 4, f"DNI: {cliente_id}", 0, 1)
         elif cliente_id:  # Si tiene ID pero no es 8 ni 11 caracteres
-            pdf.cell(0, 4, f"CE: {cliente_id}", 0, 1)
+            m.cell(0, 4, f"CE: {cliente_id}", 0, 1)
         else:
             # Si no hay ID, no mostrar nada
             pass
-        
-        pdf.ln(1)
 
-        cliente_nombre = self.data.get('cliente_nombre', 'N/A')
+        m.ln(1)
+
+        cliente_nombre = cliente.nombre
         if len(cliente_nombre) > 35:
-            pdf.multi_cell(0, 4, f"CLIENTE: {cliente_nombre}", 0)
+            m.multi_cell(0, 4, f"CLIENTE: {cliente_nombre}", 0)
         else:
-            pdf.cell(0, 4, f"CLIENTE: {cliente_nombre}", 0, 1)
+            m.cell(0, 4, f"CLIENTE: {cliente_nombre}", 0, 1)
 
-        pdf.ln(1)
+        m.ln(1)
         # Dirección del cliente - solo mostrar si hay datos válidos
-        cliente_dir = self.data.get('cliente_direccion', '')
-        cliente_dis = self.data.get('cliente_distrito', '')
-        cliente_dep = self.data.get('cliente_departamento', '')
+        cliente_dir = cliente.direccion
+        cliente_dis = cliente.distrito
+        cliente_dep = cliente.departamento
 
         # Filtrar valores no válidos
         valores_invalidos = ['', 'N/A', 'n/a', '-', '--', '---']
-        partes_validas = [parte for parte in [cliente_dir, cliente_dis, cliente_dep] 
+        partes_validas = [parte for parte in [cliente_dir, cliente_dis, cliente_dep]
                         if parte and parte not in valores_invalidos]
 
         if partes_validas:
             # Construir la dirección completa
             direccion_completa = " - ".join(partes_validas)
             texto_direccion = f"DIRECCIÓN: {direccion_completa}"
-            
+
             # Verificar si necesita multi_cell
             if len(texto_direccion) > 35:
-                pdf.multi_cell(0, 4, texto_direccion, 0)
+                m.multi_cell(0, 4, texto_direccion, 0)
             else:
-                pdf.cell(0, 4, texto_direccion, 0, 1)
+                m.cell(0, 4, texto_direccion, 0, 1)
 
-        pdf.ln(1)
+        m.ln(1)
 
-        #GUIAS 
+        #GUIAS
 
-        guia = self.data.get('cliente_guia', '')
+        guia = f.guia
         if guia and guia != 'N/A' and guia.strip():
-            pdf.cell(0, 4, f"GUIA DE REMISIÓN: N° {guia}", 0, 1)
-        pdf.ln(2)
+            m.cell(0, 4, f"GUIA DE REMISIÓN: N° {guia}", 0, 1)
+        m.ln(2)
 
         # Línea separadora
-        pdf.cell(0, 1, "", "T", 1)
-        pdf.ln(2)
-        pdf.set_font("Arial", '', 8)
-        pdf.cell(0, 4, f"FORMA DE PAGO: {self.data.get('forma_pago')}", 0, 1)
-        pdf.ln(2)
-        # Encabezados de la tabla - MEJOR AJUSTE
-        pdf.set_font("Arial", 'B', 5)
-
-        # Definir anchuras de columnas (las mismas para encabezado y contenido)
-        anchuras = [6, 16, 8, 20, 10, 16]  # COD, CANT, UNID, DESC, V.UNIT, V.VENTA
-        total_anchura = sum(anchuras)  # Debe ser 80mm
-
-        # Encabezados de la tabla - CON LAS MISMAS ANCHURAS
-        pdf.set_font("Arial", 'B', 5)
-        encabezados = ["COD", "CANT.", "UNID.", "DESCRIPCION", "V.UNIT", "V.VENTA"]
-
-        for i, encabezado in enumerate(encabezados):
-            pdf.cell(anchuras[i], 5, encabezado, 1, 0, 'C')
-        pdf.ln(5)  # Salto de línea después del encabezado
+        m.cell(0, 1, "", "T", 1)
+        m.ln(2)
+        m.set_font("Arial", '', 8)
+        m.cell(0, 4, f"FORMA DE PAGO: {f.forma_pago}", 0, 1)
+        m.ln(2)
+
+        self.encabezado_tabla(m)
+
+    def encabezado_tabla(self, m):
+        """Encabezado de la tabla de items (se repite en cada página de continuación)"""
+        # Encabezados de la tabla - CON LAS MISMAS ANCHURAS que el contenido
+        m.set_font("Arial", 'B', 5)
+        for anchura, encabezado in zip(ANCHURAS_TABLA, ENCABEZADOS_TABLA):
+            m.cell(anchura, 5, encabezado, 1, 0, 'C')
+        m.ln(5)  # Salto de línea después del encabezado
 
         # Contenido de la tabla - MISMAS ANCHURAS
-        pdf.set_font("Arial", '', 7)
-
-        for item in self.data.get('items', []):
-            # Preparar datos
-            codigo = str(item.get('id', 'N/A'))[:20]
-            cantidad = str(item.get('cantidad', '0'))[:6]
-            unidad = str(item.get('unidad', 'UND'))[:4]
-            descripcion = str(item.get('descripcion', 'N/A'))
-            precio_unitario = str(item.get('precio_unitario', '0.00'))[:5]
-            total = str(item.get('total', '0.00'))
-            
-            # Guardar posición inicial
-            x_start = pdf.get_x()
-            y_start = pdf.get_y()
-            
-            # Dibujar celdas fijas (COD, CANT, UNID)
-            pdf.cell(anchuras[0], 4, codigo, 1, 0, 'C')
-            pdf.cell(anchuras[1], 4, cantidad, 1, 0, 'C')
-            pdf.cell(anchuras[2], 4, unidad, 1, 0, 'C')
-            
-            # Celda de descripción con multi_cell
-            x_desc = pdf.get_x()
-            y_desc = pdf.get_y()
-            
-            # Usar multi_cell para la descripción (misma anchura)
-            pdf.multi_cell(anchuras[3], 4, descripcion, 1, 'c')  # 'L' para alineación izquierda
-            
-            # Calcular la altura que ocupó la descripción
-            desc_height = pdf.get_y() - y_desc
-            
-            # Posicionar para las celdas restantes
-            pdf.set_xy(x_desc + anchuras[3], y_desc)
-            
-            # Dibujar celdas de precio y total (misma altura que la descripción)
-            pdf.cell(anchuras[4], desc_height, precio_unitario, 1, 0, 'c')  # 'R' para números
-            pdf.cell(anchuras[5], desc_height, total, 1, 1, 'c')  # 'R' para números
-            
-            # Ajustar la posición Y para la siguiente fila
-            pdf.set_xy(x_start, pdf.get_y())
+        m.set_font("Arial", '', 7)
+
+    def maquetar_item(self, m, item):
+        """Una fila de la tabla; si no entra en la página sigue en la próxima"""
+        anchuras = ANCHURAS_TABLA
+
+        # Preparar datos
+        codigo = item.codigo[:20]
+        cantidad = texto_cantidad(item.cantidad)
+        unidad = item.unidad[:4]
+        descripcion = item.descripcion
+        # Precio redondeado a céntimos (antes se cortaba el texto a 5 caracteres)
+        precio_unitario = texto_monto(item.precio, ESCALA_CANTIDAD)
+        total = texto_monto(item.total)
+
+        # La fila es tan alta como su descripción y no se parte entre páginas
+        if m.asegurar(4 * len(m.lineas(anchuras[3], descripcion))):
+            self.encabezado_tabla(m)
+
+        # Guardar posición inicial
+        x_start = m.get_x()
+
+        # Dibujar celdas fijas (COD, CANT, UNID)
+        m.cell(anchuras[0], 4, codigo, 1, 0, 'C')
+        m.cell(anchuras[1], 4, cantidad, 1, 0, 'C')
+        m.cell(anchuras[2], 4, unidad, 1, 0, 'C')
+
+        # Celda de descripción con multi_cell
+        x_desc = m.get_x()
+        y_desc = m.get_y()
+
+        # Usar multi_cell para la descripción (misma anchura)
+        m.multi_cell(anchuras[3], 4, descripcion, 1, 'C')
+
+        # Calcular la altura que ocupó la descripción
+        desc_height = m.get_y() - y_desc
+
+        # Posicionar para las celdas restantes
+        m.set_xy(x_desc + anchuras[3], y_desc)
+
+        # Dibujar celdas de precio y total (misma altura que la descripción)
+        m.cell(anchuras[4], desc_height, precio_unitario, 1, 0, 'C')
+        m.cell(anchuras[5], desc_height, total, 1, 1, 'C')
+
+        # Ajustar la posición Y para la siguiente fila
+        m.set_xy(x_start, m.get_y())
+
+    def maquetar_pie(self, m, f):
+        """Totales, monto en letras, fecha, QR y textos finales"""
+        m.ln(2)
+
 
-        pdf.ln(2)
-        
-        
         # Totales - FUENTE NORMAL
-        pdf.set_font("Arial", '', 8)
-        pdf.cell(50, 5, "OP. GRAVADA:", 0, 0)
-        pdf.cell(25, 5, self.format_currency(self.data.get('total_venta', '0.00')), 0, 1, 'R')
-        
-        pdf.cell(50, 5, "IGV:", 0, 0)
-        pdf.cell(25, 5, self.format_currency(self.data.get('total_igv', '0.00')), 0, 1, 'R')
-        
-        pdf.set_font("Arial", 'B', 10)
-        pdf.cell(50, 6, "TOTAL:", 0, 0)
-        pdf.cell(25, 6, self.format_currency(self.data.get('total_pagar', '0.00')), 0, 1, 'R')
+        m.set_font("Arial", '', 8)
+        m.cell(50, 5, "OP. GRAVADA:", 0, 0)
+        m.cell(25, 5, self.format_currency(f.total_venta), 0, 1, 'R')
+
+        m.cell(50, 5, "IGV:", 0, 0)
+        m.cell(25, 5, self.format_currency(f.total_igv), 0, 1, 'R')
+
+        m.set_font("Arial", 'B', 10)
+        m.cell(50, 6, "TOTAL:", 0, 0)
+        m.cell(25, 6, self.format_currency(f.total_pagar), 0, 1, 'R')
 
-        pdf.ln(2)
+        m.ln(2)
 
-        pdf.set_font("Arial", '', 8)
-        monto_l = self.data.get('monto_letras')
+        m.set_font("Arial", '', 8)
+        monto_l = f.monto_letras
         if len(monto_l) > 35:
-                pdf.multi_cell(0, 4, f"SON: {monto_l}", 0)
+                m.multi_cell(0, 4, f"SON: {monto_l}", 0)
         else:
-                pdf.cell(0, 4, f"SON: {monto_l}", 0, 1)
+                m.cell(0, 4, f"SON: {monto_l}", 0, 1)
 
 
 
-        pdf.ln(2)
-        pdf.set_font("Arial", '', 8)
+        m.ln(2)
+        m.set_font("Arial", '', 8)
         # Unir fecha y hora en un solo formato
-        fecha = self.data.get('fecha_emision', 'N/A')
-        hora = self.data.get('hora_emision', 'N/A')
+        fecha = f.fecha_emision
+        hora = f.hora_emision
 
         if fecha != 'N/A' and hora != 'N/A':
             # Formatear como "24-08-2025 19:11:20"
             fecha_hora = f"{fecha} {hora}"
-            pdf.cell(0, 4, f"Fecha: {fecha_hora}", 0, 1, 'C')
+            m.cell(0, 4, f"Fecha: {fecha_hora}", 0, 1, 'C')
         else:
             # Si falta alguno, mostrar por separado
-            pdf.cell(0, 4, f"Fecha: {fecha}", 0, 1, 'C')
+            m.cell(0, 4, f"Fecha: {fecha}", 0, 1, 'C')
             if hora != 'N/A':
-                pdf.cell(0, 4, f"Hora: {hora}", 0, 1, 'C')
+                m.cell(0, 4, f"Hora: {hora}", 0, 1, 'C')
 
-
-        # Obtener la posición Y actual después de todo el contenido
-        current_y = pdf.get_y()
-        
-        # Calcular posición Y para la imagen (dejando espacio para los textos finales)
-        image_y = current_y + 2  # 5mm de espacio después del contenido
-        
-        # Añadir la imagen en el pie del ticket según RUC del emisor
-        ruc_emisor = self.data.get('emisor_ruc', '')
+        # QR con los datos del comprobante (formato de la representación impresa de SUNAT)
+        ruc_emisor = f.emisor.id if f.emisor else ''
         if ruc_emisor and ruc_emisor != 'N/A':
-            image_path = f"images/{ruc_emisor}.png"
-            
-            # Verificar si existe la imagen del RUC específico
-            if not os.path.exists(image_path):
-                # Si no existe, usar una imagen por defecto
-                image_path = "images/qr_default.png"
-                
-            image_width = 50  # Ancho de la imagen
-            image_x = (self.page_width - image_width) / 2  # Centrar horizontalmente
-
-            try:
-                if os.path.exists(image_path):
-                    # Insertar imagen centrada en el pie
-                    pdf.image(image_path, x=image_x, y=pdf.get_y(), w=image_width)
-                    
-                    # Calcular altura de la imagen para ajustar el espacio
-                    image_height = image_width / 3  # Asumiendo relación de aspecto 3:1
-                    
-                    # Actualizar posición Y después de la imagen
-                    pdf.set_y(pdf.get_y() + image_height + 5)
-                else:
-                    print(f"Advertencia: No se encontró {image_path}")
-            except Exception as e:
-                print(f"Error al cargar imagen {image_path}: {e}")
+            m.asegurar(LADO_QR + 7)
+            m.ln(2)  # Zona en blanco sobre el QR (la norma pide 4 módulos)
+            m.qr(f.texto_qr(), x=(self.page_width - LADO_QR) / 2, y=m.get_y(), lado=LADO_QR)
+            m.set_y(m.get_y() + LADO_QR + 5)
         else:
-            print("Advertencia: No hay RUC del emisor para cargar QR")
+            LOG.warning("Advertencia: No hay RUC del emisor para generar el QR")
 
-        # Textos finales después de la imagen
-        pdf.cell(0, 4, "Representación impresa del comprobante de pago", 0, 1, 'C')
-        pdf.set_font("Arial", 'I', 8)
-        pdf.cell(0, 4, "¡Gracias por su compra!", 0, 1, 'C')
-        
-        # Guardar PDF
-        pdf.output(self.output_path)
-        print(f"PDF generado: {self.output_path} (Alto calculado: {page_height}mm)")
+        # Textos finales después del QR
+        m.cell(0, 4, "Representación impresa del comprobante de pago", 0, 1, 'C')
+        m.set_font("Arial", 'I', 8)
+        m.cell(0, 4, "¡Gracias por su compra!", 0, 1, 'C')
+
+    def generate_pdf(self, compacto=False):
+        """Generar PDF para impresora de 80mm con alto automático
+
+        Devuelve los bytes del PDF; se escriben en output_path si está definido.
+        Con `compacto`, en el perfil compacto (ver PDFCompacto).
+        """
+        # Maquetar una sola vez: la lista de dibujo define el alto de la página
+        maquetacion = self.layout()
+        page_height = maquetacion.alto
+
+        pdf = crear_pdf(self.page_width, maquetacion.paginas[0].alto, compacto)
+        self.render_page(pdf)
+        return self.guardar_pdf(pdf, page_height)
+
+    def guardar_pdf(self, pdf, alto):
+        """Serializar `pdf`, escribirlo en output_path (si hay) y devolver los bytes (bytearray)"""
+        with self.metricas.etapa('serializacion'):
+            datos = pdf.output()
+            if self.output_path:
+                with open(self.output_path, 'wb') as f:
+                    f.write(datos)
+        self.metricas.contar('bytes_salida', len(datos))
+        if self.output_path and pdf.page > 1:
+            LOG.info("PDF generado: %s (%d bytes, Alto calculado: %.1fmm en %d páginas)", self.output_path,
+                     len(datos), alto, pdf.page)
+        elif self.output_path:
+            LOG.info("PDF generado: %s (%d bytes, Alto calculado: %.1fmm)", self.output_path, len(datos), alto)
+        return datos
+
+    def generate_pdf_streaming(self, compacto=False):
+        """Parsear y dibujar en una sola pasada, para facturas muy largas
+
+        Reemplaza a parse_xml() + generate_pdf(). Los items pasan del parser
+        al maquetador uno por uno sin guardarse y cada página se dibuja en
+        cuanto se llena, así la memoria del modelo y de la maquetación no
+        depende de la cantidad de líneas (fpdf2 sí conserva el contenido ya
+        comprimido de cada página hasta escribir el archivo). Necesita que
+        las cac:InvoiceLine vengan al final, como exige el esquema UBL.
+        Devuelve los bytes del PDF, o None si el XML no se pudo parsear.
+        """
+        self.streaming = True
+        pdf = crear_pdf(self.page_width, self.alto_pagina or ALTO_MAXIMO, compacto)
+        alto_total = 0.0
+
+        def al_cerrar_pagina(pagina):
+            nonlocal alto_total
+            alto_total += pagina.alto
+            self.dibujar_pagina(pdf, pagina)
+
+        m = Maquetador(self.page_width, self.alto_pagina, al_cerrar_pagina)
+
+        def al_item(lector, item):
+            if self.factura is None:
+                # Al llegar la primera línea ya se leyó todo lo que va antes de la tabla
+                self.factura = lector.resultado()
+                self.maquetar_encabezado(m, self.factura)
+            with self.metricas.etapa('tabla'):
+                self.maquetar_item(m, item)
+            self.metricas.contar('items')
+
+        antes = estadisticas_cache()
+        try:
+            factura = parsear_ubl(self.xml_path, self.metricas, LectorUBL(al_item))
+        except Exception as e:
+            self.error = f"Error al parsear XML: {e}"
+            self.causa = e
+            LOG.error(self.error)
+            return None
+
+        if self.factura is None:
+            self.maquetar_encabezado(m, factura)
+        self.factura = factura
+        self.maquetar_pie(m, factura)
+        m.terminar()
+        self.contar_cache(antes)
+        return self.guardar_pdf(pdf, alto_total)
+
+    def render_page(self, pdf, marcador=None):
+        """Agregar el ticket a `pdf` en páginas nuevas de su alto exacto
+
+        Si se pasa `marcador`, la primera página queda como una entrada del
+        índice (outline) del PDF.
+        """
+        for i, pagina in enumerate(self.layout().paginas):
+            self.dibujar_pagina(pdf, pagina, marcador if i == 0 else None)
+
+    def dibujar_pagina(self, pdf, pagina, marcador=None):
+        pdf.add_page(format=(self.page_width, pagina.alto))
+        if marcador:
+            pdf.start_section(marcador)
+        with self.metricas.etapa('dibujo'):
+            pagina.dibujar(pdf, self.metricas)
+
+    def generate_escpos(self):
+        """Generar los bytes ESC/POS del ticket para la impresora térmica, sin pasar por PDF"""
+        from escpos import generar_escpos
+
+        if self.maquetacion is None:
+            # El rollo es continuo: una sola página, sin repetir el encabezado de la tabla
+            self.alto_pagina = None
+        maquetacion = self.layout()
+        with self.metricas.etapa('serializacion'):
+            datos = generar_escpos(maquetacion, self.page_width)
+            if self.output_path:
+                with open(self.output_path, 'wb') as f:
+                    f.write(datos)
+        self.metricas.contar('bytes_salida', len(datos))
+        if self.output_path:
+            LOG.info("ESC/POS generado: %s (%d bytes)", self.output_path, len(datos))
+        return datos
+
+    def renderizar(self, destino=None, formato='pdf'):
+        """Parsear (si hace falta) y generar el ticket en `formato`
+
+        Devuelve los bytes generados (el bytearray de fpdf2, sin copiarlo),
+        que además se escriben en output_path si está definido y en
+        `destino` (cualquier objeto con write()) si se pasa. Las facturas
+        grandes se convierten en streaming. Lanza XMLInvalido si el XML no
+        se puede leer y ValueError si `formato` no está en EXTENSIONES.
+        """
+        if formato not in EXTENSIONES:
+            raise ValueError(f"formato desconocido: {formato!r} (se acepta {', '.join(EXTENSIONES)})")
+        tamano = tamano_fuente(self.xml_path)
+        compacto = formato == 'compacto'
+        if self.factura is None and formato != 'escpos' and tamano is not None and tamano >= UMBRAL_STREAMING:
+            datos = self.generate_pdf_streaming(compacto)
+            if datos is None:
+                raise XMLInvalido(self.error) from self.causa
+        elif self.factura is None and not self.parse_xml():
+            raise XMLInvalido(self.error) from self.causa
+        elif formato == 'escpos':
+            datos = self.generate_escpos()
+        else:
+            datos = self.generate_pdf(compacto)
+
+        if destino is not None:
+            destino.write(datos)
+        return datos
+
+    def resumen_metricas(self):
+        """Métricas del ticket con sus datos de identificación, para el log JSON"""
+        f = self.factura
+        return {'numero': f and f.numero, 'emisor_ruc': f and f.emisor and f.emisor.id,
+                **self.metricas.como_dict()}
+
+# Extensión del archivo de salida para cada formato
+EXTENSIONES = {'pdf': '.pdf', 'compacto': '.pdf', 'escpos': '.prn'}
+# Los XML de este tamaño o más (facturas con muchas líneas) se convierten a
+# PDF en una sola pasada con generate_pdf_streaming()
+UMBRAL_STREAMING = 1024 * 1024
+
+
+# Resultado de convertir un archivo; `metricas` es el resumen del ticket (o None),
+# `datos` los bytes generados cuando no se escribieron en un archivo e `indice`
+# la fila para el índice de comprobantes (indice.py) cuando se usa --indice.
+# `transitorio` marca los errores de E/S, que vale la pena reintentar
+Resultado = collections.namedtuple('Resultado', ['nombre', 'ok', 'mensaje', 'metricas', 'datos', 'indice',
+                                                 'transitorio'],
+                                   defaults=[None, None, None, False])
+
+
+def nombre_fuente(fuente):
+    """Nombre del XML de una ruta o de un miembro de ZIP"""
+    return getattr(fuente, 'nombre', None) or os.path.basename(fuente)
+
+
+def tamano_fuente(fuente):
+    """Bytes del XML, o None si no se conocen sin leerlo (archivo abierto o árbol)
+
+    Una ruta que no se puede leer también da None: el error lo informa el
+    parseo, como XMLInvalido.
+    """
+    if isinstance(fuente, (bytes, bytearray, memoryview)):
+        return len(fuente)
+    if hasattr(fuente, 'tamano'):
+        return fuente.tamano
+    if isinstance(fuente, (str, os.PathLike)):
+        try:
+            return os.path.getsize(fuente)
+        except OSError:
+            return None
+    return None
+
+
+def huella_fuente(fuente):
+    """SHA-256 del XML de una ruta, un miembro de ZIP o un buffer"""
+    h = hashlib.sha256()
+    if isinstance(fuente, (bytes, bytearray, memoryview)):
+        h.update(fuente)
+        return h.hexdigest()
+    with fuente.abrir() if hasattr(fuente, 'abrir') else open(fuente, 'rb') as f:
+        for bloque in iter(lambda: f.read(TAMANO_BLOQUE), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def renderizar(xml, destino=None, formato='pdf'):
+    """Convertir un comprobante en memoria, sin archivos temporales
+
+    `xml` puede ser el XML en bytes (o cualquier buffer), un archivo binario
+    abierto, un árbol ya parseado (ElementTree o Element) o una ruta. Sin
+    `destino` devuelve un memoryview de los bytes generados; con `destino`
+    (cualquier objeto con write()) los escribe ahí y devuelve cuántos
+    fueron. `formato` es una clave de EXTENSIONES: 'pdf', 'compacto' (PDF
+    mínimo para archivar y transmitir) o 'escpos'. Lanza XMLInvalido si el
+    XML no se puede leer y ValueError si el formato no existe.
+    """
+    datos = FacturaXMLtoPDF(xml, None).renderizar(destino, formato)
+    return memoryview(datos) if destino is None else len(datos)
+
+
+def listar_entradas(input_dir):
+    """XML sueltos y XML dentro de los ZIP de `input_dir`, en orden de nombre"""
+    entradas = []
+    for archivo in sorted(os.listdir(input_dir)):
+        ruta = os.path.join(input_dir, archivo)
+        if archivo.endswith('.xml'):
+            entradas.append(ruta)
+        elif archivo.lower().endswith('.zip'):
+            from comprimidos import miembros_zip
+            entradas.extend(miembros_zip(ruta))
+    return entradas
+
+
+def separar_duplicados(entradas):
+    """(entradas, Resultado con error de las que repiten el nombre de una anterior)
+
+    Dos fuentes con el mismo nombre (un XML suelto y uno dentro de un ZIP,
+    miembros de dos ZIP o de carpetas distintas de un mismo ZIP) irían al
+    mismo archivo de salida y la segunda pisaría a la primera: solo se
+    convierte la primera.
+    """
+    primeras = {}
+    unicas = []
+    duplicadas = []
+    for fuente in entradas:
+        nombre = nombre_fuente(fuente)
+        if nombre in primeras:
+            duplicadas.append(Resultado(nombre, False, f"{fuente} tiene el mismo nombre que {primeras[nombre]}; "
+                                                       f"se convirtió solo el primero"))
+        else:
+            primeras[nombre] = fuente
+            unicas.append(fuente)
+    return unicas, duplicadas
+
+
+def silenciar_logs():
+    """Inicializador de los procesos del pool: los errores se informan en el resumen"""
+    LOG.setLevel(logging.CRITICAL)
+
+
+def calentar(formatos=('pdf',)):
+    """Dejar cargado en este proceso lo que usa el primer ticket
+
+    Inicializador de los procesos del pool del servidor y arranque del modo
+    trabajador. Dibuja un ticket de prueba armado en memoria (sin XML) en
+    cada uno de `formatos`: así quedan cargados las fuentes, el logo, las
+    tablas del QR, los módulos que se importan al usarse y el código de
+    maquetación y dibujo.
+    """
+    silenciar_logs()
+    factura = Factura(numero='F001-00000000', fecha_emision='2000-01-01', hora_emision='00:00:00',
+                      tipo_documento='FACTURA', codigo_tipo='01',
+                      emisor=Parte(id='00000000000', nombre='CALENTAMIENTO'),
+                      cliente=Parte(id='00000000000', nombre='CALENTAMIENTO', tipo_documento='6'))
+    factura.items.agregar('0', 'NIU', 'CALENTAMIENTO', '1', '1', '1')
+    for formato in formatos:
+        ticket = FacturaXMLtoPDF(None, None)
+        ticket.factura = factura
+        ticket.renderizar(formato=formato)
+    preparar_versiones()
+
+
+def convertir_archivo(xml_path, output_path, formato='pdf', perfilado=None, indice=None):
+    """Convertir un solo XML a PDF o ESC/POS (se ejecuta dentro de los procesos del pool)
+
+    `xml_path` también puede ser un MiembroZip. Devuelve un Resultado con
+    las métricas del ticket; si `output_path` es None, los bytes generados
+    vuelven en Resultado.datos. `perfilado` es una tupla (carpeta para los
+    .prof de cProfile o None, medir memoria) para perfilar cada ticket por
+    separado. Con `indice` (ruta del índice SQLite) un XML ya indexado se
+    dibuja desde el modelo guardado sin parsearlo, y Resultado.indice trae
+    la fila que el proceso principal debe registrar.
+    """
+    nombre = nombre_fuente(xml_path)
+    factura = FacturaXMLtoPDF(xml_path, output_path)
+    try:
+        huella = None
+        if indice:
+            from indice import modelo_guardado
+            huella = huella_fuente(xml_path)
+            factura.factura = modelo_guardado(indice, huella)
+            if factura.factura is not None:
+                factura.metricas.contar('modelos_indice')
+        guardar_modelo = factura.factura is None
+
+        carpeta, memoria = perfilado or (None, False)
+        archivo_perfil = os.path.join(carpeta, nombre.replace('.xml', '.prof')) if carpeta else None
+        with perfilar(factura.metricas, archivo_perfil, memoria):
+            datos = factura.renderizar(formato=formato)
+
+        fila = None
+        if indice:
+            from indice import fila_indice
+            fila = fila_indice(factura.factura, huella, nombre, guardar_modelo and not factura.streaming)
+        if output_path:
+            return Resultado(nombre, True, output_path, factura.resumen_metricas(), indice=fila)
+        return Resultado(nombre, True, nombre, factura.resumen_metricas(), datos, fila)
+    except XMLInvalido as e:
+        return Resultado(nombre, False, str(e), factura.resumen_metricas(),
+                         transitorio=isinstance(e.__cause__, OSError))
+    except Exception as e:
+        return Resultado(nombre, False, f"{type(e).__name__}: {e}", factura.resumen_metricas(),
+                         transitorio=isinstance(e, OSError))
+
+
+def registrar_resultados(resultados):
+    """Acumular las métricas de los resultados y escribirlas en el log JSON"""
+    for resultado in resultados:
+        registrar_ticket(resultado.metricas, resultado.ok, archivo=resultado.nombre)
+
+
+def imprimir_resumen(resultados, segundos):
+    """Mostrar el resumen de un procesamiento por lotes"""
+    errores = [(r.nombre, r.mensaje) for r in resultados if not r.ok]
+    convertidos = len(resultados) - len(errores)
+    velocidad = len(resultados) / segundos if segundos > 0 else 0
+
+    print(f"\nResumen: {convertidos} convertidos, {len(errores)} con error "
+          f"({segundos:.2f}s, {velocidad:.1f} archivos/s)")
+    bytes_salida = sum(r.metricas['contadores'].get('bytes_salida', 0) for r in resultados if r.ok and r.metricas)
+    if bytes_salida:
+        print(f"Salida: {bytes_salida} bytes ({bytes_salida // convertidos} bytes por ticket)")
+    for nombre, mensaje in errores:
+        print(f"✗ {nombre}: {mensaje}")
+
+
+def buscar_en_indice(indice, args):
+    """Mostrar los comprobantes del índice que cumplen los filtros de la línea de comandos"""
+    filas = indice.buscar(args.numero, args.emisor, args.cliente, args.desde, args.hasta, args.limite)
+    for fila in filas:
+        print(f"{fila['emisor_ruc']}-{fila['numero']}\t{fila['fecha_emision']} {fila['hora_emision']}\t"
+              f"{fila['cliente_id']}\t{fila['cliente_nombre']}\tS/. {texto_monto(fila['total_pagar'])}\t"
+              f"{fila['salida']}")
+    print(f"{len(filas)} comprobantes")
+
+
+def reimprimir_desde_indice(indice, clave, output_dir, formato):
+    """Generar en `output_dir` el ticket del comprobante RUC-NUMERO desde el modelo guardado"""
+    emisor, _, numero = clave.partition('-')
+    filas = indice.buscar(numero=numero, emisor=emisor, limite=1)
+    if not filas:
+        print(f"✗ El comprobante {clave} no está en el índice")
+        return
+    output_path = os.path.join(output_dir, filas[0]['archivo'].replace('.xml', EXTENSIONES[formato]))
+    try:
+        indice.reimprimir(emisor, numero, output_path, formato)
+    except LookupError as e:
+        print(f"✗ {e}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convertir facturas XML (UBL) a tickets PDF de 80mm")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Procesos para convertir en paralelo (0 = todos los núcleos)")
+    parser.add_argument("--formato", choices=sorted(EXTENSIONES), default="pdf",
+                        help="pdf, compacto (PDF mínimo para archivar y transmitir) o escpos "
+                             "(bytes listos para la impresora térmica)")
+    parser.add_argument("--bundle", metavar="NOMBRE",
+                        help="Generar un solo PDF (por volúmenes) con todos los tickets e índice NOMBRE.json")
+    parser.add_argument("--bundle-tamano", type=int, default=1000, metavar="N",
+                        help="Tickets por volumen con --bundle")
+    parser.add_argument("--servidor", type=int, metavar="PUERTO",
+                        help="Levantar el servicio HTTP local de renderizado en PUERTO")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Dirección donde escucha el servidor (con --servidor)")
+    parser.add_argument("--trabajador", nargs="?", const="", metavar="SOCKET",
+                        help="Quedar vivo y atender trabajos con prefijo de largo por stdin/stdout o, "
+                             "si se indica, por el socket Unix SOCKET (ver trabajador.py)")
+    parser.add_argument("--watch", action="store_true",
+                        help="Quedarse vigilando 'input' y convertir solo los XML nuevos o modificados "
+                             "(con --servidor, como trabajos de lote detrás de las peticiones)")
+    parser.add_argument("--intervalo", type=float, default=2.0,
+                        help="Segundos entre revisiones de la carpeta si no hay inotify (con --watch)")
+    parser.add_argument("--reintentos", type=int, default=2, metavar="N",
+                        help="Reintentos con espera de un archivo que falla por un error de E/S "
+                             "(lotes con --workers y --watch)")
+    parser.add_argument("--cuarentena", nargs="?", const=os.path.join("input", "cuarentena"), metavar="CARPETA",
+                        help="Apartar en CARPETA (por defecto input/cuarentena) los XML que siguen "
+                             "fallando después de los reintentos")
+    parser.add_argument("--metricas-log", metavar="ARCHIVO",
+                        help="Agregar a ARCHIVO una línea JSON por ticket con tiempos por etapa y contadores")
+    parser.add_argument("--metricas-prom", metavar="ARCHIVO",
+                        help="Escribir las métricas acumuladas en formato Prometheus (textfile collector)")
+    parser.add_argument("--perfilar", metavar="CARPETA",
+                        help="Guardar un perfil de cProfile por ticket en CARPETA")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Medir el pico de memoria de cada ticket (más lento)")
+    parser.add_argument("--zip-salida", metavar="NOMBRE",
+                        help="Escribir los tickets dentro de output/NOMBRE.zip en lugar de archivos sueltos")
+    parser.add_argument("--indice", nargs="?", const="", metavar="ARCHIVO",
+                        help="Registrar cada comprobante en el índice SQLite ARCHIVO (por defecto "
+                             "output/indice.sqlite) y no volver a parsear los XML que no cambiaron")
+    parser.add_argument("--buscar", action="store_true",
+                        help="Listar los comprobantes del índice que cumplen los filtros --numero, "
+                             "--emisor, --cliente, --desde y --hasta")
+    parser.add_argument("--reimprimir", metavar="RUC-NUMERO",
+                        help="Generar de nuevo en 'output' el ticket de un comprobante desde el índice, sin el XML")
+    parser.add_argument("--numero", help="Número del comprobante (con --buscar)")
+    parser.add_argument("--emisor", metavar="RUC", help="RUC del emisor (con --buscar)")
+    parser.add_argument("--cliente", metavar="DOCUMENTO", help="Documento del cliente (con --buscar)")
+    parser.add_argument("--desde", metavar="AAAA-MM-DD", help="Fecha de emisión mínima (con --buscar)")
+    parser.add_argument("--hasta", metavar="AAAA-MM-DD", help="Fecha de emisión máxima (con --buscar)")
+    parser.add_argument("--limite", type=int, default=100, help="Máximo de comprobantes a listar (con --buscar)")
+    parser.add_argument("-q", "--silencioso", action="store_true",
+                        help="Mostrar solo advertencias y errores de cada ticket")
+    args = parser.parse_args(argv)
+    if args.bundle and args.formato != 'pdf':
+        parser.error("--bundle genera siempre PDF; no se puede combinar con --formato")
+
+    # En modo trabajador por stdin/stdout, stdout es solo para las respuestas
+    logging.basicConfig(level=logging.WARNING if args.silencioso else logging.INFO,
+                        format="%(message)s", stream=sys.stderr if args.trabajador == "" else sys.stdout)
+    if args.metricas_log:
+        configurar_log_json(args.metricas_log)
+    if args.perfilar:
+        os.makedirs(args.perfilar, exist_ok=True)
+    perfilado = (args.perfilar, args.tracemalloc) if args.perfilar or args.tracemalloc else None
 
-def main():
     # Configurar rutas
     input_dir = "input"
     output_dir = "output"
@@ -517,29 +1557,110 @@ def main():
     # Crear directorios si no existen
     os.makedirs(input_dir, exist_ok=True)
     os.makedirs(output_dir, exist_ok=True)
+
+    indice = None
+    if args.indice is not None or args.buscar or args.reimprimir:
+        from indice import Indice, RUTA_INDICE
+        indice = Indice(args.indice or RUTA_INDICE)
+    if args.buscar:
+        buscar_en_indice(indice, args)
+        return
+    if args.reimprimir:
+        reimprimir_desde_indice(indice, args.reimprimir, output_dir, args.formato)
+        return
+
+    if args.trabajador is not None:
+        from trabajador import ejecutar
+        ejecutar(args.trabajador or None)
+        return
+
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    vigilante = None
+    if args.watch:
+        from vigilancia import Vigilante
+        vigilante = Vigilante(input_dir, output_dir, workers, args.intervalo, args.formato,
+                              args.metricas_prom, indice, args.reintentos, args.cuarentena)
+    if args.servidor:
+        from servidor import servir
+        # Sin --workers explícito el servidor usa todos los núcleos
+        servir(args.host, args.servidor, workers if args.workers != 1 else None, vigilante)
+        return
+    if vigilante:
+        vigilante.ejecutar()
+        return
     
-    # Procesar todos los archivos XML en el directorio de entrada
-    xml_files = [f for f in os.listdir(input_dir) if f.endswith('.xml')]
+    # Procesar todos los archivos XML del directorio de entrada, sueltos o
+    # dentro de ZIP (ordenados para que la salida sea la misma en cada ejecución)
+    entradas = listar_entradas(input_dir)
     
-    if not xml_files:
+    if not entradas:
         print("No se encontraron archivos XML en la carpeta 'input'")
         print("Por favor, coloca los archivos XML en la carpeta 'input'")
         return
-    
-    for filename in xml_files:
-        xml_path = os.path.join(input_dir, filename)
-        pdf_filename = filename.replace('.xml', '.pdf')
-        output_path = os.path.join(output_dir, pdf_filename)
-        
-        print(f"\nProcesando: {filename}")
-        
-        # Crear instancia y procesar
-        factura = FacturaXMLtoPDF(xml_path, output_path)
-        if factura.parse_xml():
-            factura.generate_pdf()
-            print(f"✓ Datos extraídos correctamente")
+    entradas, duplicadas = separar_duplicados(entradas)
+    for resultado in duplicadas:
+        print(f"✗ {resultado.nombre}: {resultado.mensaje}")
+    registrar_resultados(duplicadas)
+
+    if args.bundle:
+        from paquete import generar_paquete
+        print(f"Generando paquete '{args.bundle}' con {len(entradas)} tickets...")
+        inicio = time.perf_counter()
+        resultados = generar_paquete(entradas, output_dir, args.bundle, args.bundle_tamano, workers)
+        imprimir_resumen(duplicadas + resultados, time.perf_counter() - inicio)
+    else:
+        extension = EXTENSIONES[args.formato]
+        zip_salida = None
+        if args.zip_salida:
+            zip_salida = os.path.join(output_dir, args.zip_salida.removesuffix('.zip') + '.zip')
+        # Con --zip-salida los bytes vuelven en el Resultado en lugar de escribirse
+        trabajos = [(fuente, None if zip_salida else
+                     os.path.join(output_dir, nombre_fuente(fuente).replace('.xml', extension)))
+                    for fuente in entradas]
+
+        ruta_indice = indice.ruta if indice else None
+
+        def secuencial():
+            for fuente, output_path in trabajos:
+                print(f"\nProcesando: {nombre_fuente(fuente)}")
+                resultado = convertir_archivo(fuente, output_path, args.formato, perfilado, ruta_indice)
+                registrar_resultados([resultado])
+                if resultado.ok:
+                    print(f"✓ Datos extraídos correctamente")
+                else:
+                    print(f"✗ Error al procesar {resultado.nombre}")
+                    if args.cuarentena:
+                        from planificador import poner_en_cuarentena
+                        poner_en_cuarentena(fuente, resultado.mensaje, args.cuarentena)
+                yield resultado
+
+        inicio = time.perf_counter()
+        planificador = None
+        if workers > 1:
+            from planificador import Planificador, iterar_planificado
+            print(f"Procesando {len(trabajos)} archivos con {workers} procesos...")
+            # Sin trabajos interactivos, el lote puede usar todos los procesos
+            planificador = Planificador(workers, max_lote=workers)
+            resultados = iterar_planificado(trabajos, planificador, args.formato, perfilado, ruta_indice,
+                                            args.reintentos, args.cuarentena)
         else:
-            print(f"✗ Error al procesar {filename}")
+            resultados = secuencial()
+
+        if zip_salida:
+            from comprimidos import escribir_zip
+            resultados = escribir_zip(zip_salida, resultados, extension)
+            print(f"\nArchivo generado: {zip_salida}")
+        if indice:
+            # Después del ZIP, para registrar la ubicación final de cada ticket
+            resultados = indice.registrar(resultados)
+        resultados = duplicadas + list(resultados)
+        if planificador:
+            planificador.cerrar()
+        if workers > 1:
+            imprimir_resumen(resultados, time.perf_counter() - inicio)
+
+    if args.metricas_prom:
+        REGISTRO.escribir_prometheus(args.metricas_prom)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
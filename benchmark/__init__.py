@@ -0,0 +1,6 @@
+"""Benchmarks de conversión con facturas UBL sintéticas
+
+    python -m benchmark                      # escenarios por defecto
+    python -m benchmark --rapido             # menos documentos por escenario
+    python -m benchmark --comparar base.json # comparar con una corrida anterior
+"""
@@ -0,0 +1,3 @@
+from benchmark.ejecutar import main
+
+main()
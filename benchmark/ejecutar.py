@@ -0,0 +1,183 @@
+"""Ejecutar los escenarios del benchmark y guardar los resultados en JSON"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+
+from benchmark.generador import emisores, generar_factura, nombre_archivo
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASE = {'lineas': 10, 'largo_descripcion': 40, 'notas': 2, 'tamano_firma': 4096, 'emisores': 5}
+ESCENARIOS = [
+    ('base', {}),
+    ('1-linea', {'lineas': 1}),
+    ('100-lineas', {'lineas': 100}),
+    ('1000-lineas', {'lineas': 1000}),
+    ('5000-lineas', {'lineas': 5000}),
+    ('descripcion-larga', {'largo_descripcion': 200}),
+    ('20-notas', {'notas': 20}),
+    ('firma-256k', {'tamano_firma': 256 * 1024}),
+    ('50-emisores', {'emisores': 50}),
+]
+ETAPAS = ('parse_xml', 'calculate_total_height', 'generate_pdf')
+
+
+def documentos_para(parametros, rapido):
+    """Cantidad de documentos del escenario: menos cuanto más líneas tiene cada uno"""
+    cantidad = max(3, min(200, 4000 // parametros['lineas']))
+    return max(3, cantidad // 10) if rapido else cantidad
+
+
+def resumen_tiempos(tiempos):
+    ordenados = sorted(tiempos)
+    return {
+        'total_s': round(sum(tiempos), 6),
+        'media_ms': round(statistics.fmean(tiempos) * 1000, 3),
+        'p50_ms': round(ordenados[len(ordenados) // 2] * 1000, 3),
+        'p95_ms': round(ordenados[min(len(ordenados) - 1, int(len(ordenados) * 0.95))] * 1000, 3),
+    }
+
+
+def medir_escenario(nombre, parametros, documentos):
+    """Generar los XML del escenario y medir cada etapa (corre en un proceso nuevo)"""
+    import app
+
+    app.LOG.setLevel(logging.CRITICAL)
+    lista_emisores = emisores(parametros['emisores'])
+    tiempos = {etapa: [] for etapa in ETAPAS}
+    detalle = {}  # Etapas internas medidas por la propia clase (metricas.py)
+    bytes_xml = 0
+    bytes_pdf = 0
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as carpeta:
+        rutas = []
+        for numero in range(1, documentos + 1):
+            emisor = lista_emisores[numero % len(lista_emisores)]
+            tipo = "01" if numero % 2 else "03"
+            xml = generar_factura(numero, parametros['lineas'], parametros['largo_descripcion'],
+                                  parametros['notas'], parametros['tamano_firma'], emisor, tipo)
+            ruta = os.path.join(carpeta, nombre_archivo(emisor, tipo, numero))
+            with open(ruta, 'wb') as f:
+                f.write(xml)
+            bytes_xml += len(xml)
+            rutas.append(ruta)
+
+        inicio = time.perf_counter()
+        for ruta in rutas:
+            salida = ruta.replace('.xml', '.pdf')
+            factura = app.FacturaXMLtoPDF(ruta, salida)
+            t0 = time.perf_counter()
+            if not factura.parse_xml():
+                raise RuntimeError(f"No se pudo parsear {ruta}")
+            t1 = time.perf_counter()
+            factura.calculate_total_height()
+            t2 = time.perf_counter()
+            factura.generate_pdf()
+            t3 = time.perf_counter()
+            tiempos['parse_xml'].append(t1 - t0)
+            tiempos['calculate_total_height'].append(t2 - t1)
+            tiempos['generate_pdf'].append(t3 - t2)
+            for etapa, (pared, _) in factura.metricas.etapas.items():
+                detalle.setdefault(etapa, []).append(pared)
+            bytes_pdf += os.path.getsize(salida)
+        duracion = time.perf_counter() - inicio
+
+    return {
+        'escenario': nombre,
+        'parametros': parametros,
+        'documentos': documentos,
+        'duracion_s': round(duracion, 6),
+        'documentos_por_s': round(documentos / duracion, 3),
+        'lineas_por_s': round(documentos * parametros['lineas'] / duracion, 3),
+        'etapas': {etapa: resumen_tiempos(valores) for etapa, valores in tiempos.items()},
+        'etapas_detalle': {etapa: resumen_tiempos(valores) for etapa, valores in sorted(detalle.items())},
+        'bytes_xml': bytes_xml,
+        'bytes_pdf': bytes_pdf,
+        # En Linux ru_maxrss está en KB
+        'rss_pico_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'caches': app.estadisticas_cache(),
+    }
+
+
+def metadatos():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        from fpdf import __version__ as version_fpdf
+    except ImportError:
+        version_fpdf = None
+    return {
+        'fecha': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'fpdf2': version_fpdf,
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def comparar(actual, anterior):
+    """Mostrar la variación de cada escenario respecto a una corrida anterior"""
+    previos = {r['escenario']: r for r in anterior['resultados']}
+    print(f"\nComparación con {anterior['metadatos'].get('commit')} ({anterior['metadatos'].get('fecha')}):")
+    for resultado in actual['resultados']:
+        previo = previos.get(resultado['escenario'])
+        if previo is None:
+            continue
+        cambio = (resultado['documentos_por_s'] / previo['documentos_por_s'] - 1) * 100
+        etapas = ", ".join(
+            f"{etapa} {(resultado['etapas'][etapa]['media_ms'] / previo['etapas'][etapa]['media_ms'] - 1) * 100:+.1f}%"
+            for etapa in ETAPAS if previo['etapas'].get(etapa, {}).get('media_ms'))
+        print(f"  {resultado['escenario']:<20} {cambio:+7.1f}% docs/s  ({etapas})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description=__doc__)
+    parser.add_argument("--rapido", action="store_true", help="Menos documentos por escenario")
+    parser.add_argument("--escenario", action="append", choices=[nombre for nombre, _ in ESCENARIOS],
+                        help="Ejecutar solo este escenario (se puede repetir)")
+    parser.add_argument("--salida", default="benchmark.json", help="Archivo JSON de resultados")
+    parser.add_argument("--comparar", metavar="JSON", help="Resultados anteriores para comparar")
+    args = parser.parse_args(argv)
+
+    salida = os.path.abspath(args.salida)
+    anterior = os.path.abspath(args.comparar) if args.comparar else None
+    # Las rutas de imágenes de app.py son relativas a la raíz del repositorio
+    os.chdir(RAIZ)
+    contexto = multiprocessing.get_context("spawn")
+
+    resultados = []
+    for nombre, cambios in ESCENARIOS:
+        if args.escenario and nombre not in args.escenario:
+            continue
+        parametros = {**BASE, **cambios}
+        documentos = documentos_para(parametros, args.rapido)
+        # Un proceso nuevo por escenario: caches frías y RSS pico propio
+        with contexto.Pool(1) as pool:
+            resultado = pool.apply(medir_escenario, (nombre, parametros, documentos))
+        resultados.append(resultado)
+        etapas = "  ".join(f"{etapa} {resultado['etapas'][etapa]['media_ms']:.2f}ms" for etapa in ETAPAS)
+        print(f"{nombre:<20} {documentos:>4} docs  {resultado['documentos_por_s']:>8.1f} docs/s  "
+              f"{etapas}  RSS {resultado['rss_pico_mb']}MB")
+
+    actual = {'metadatos': metadatos(), 'resultados': resultados}
+    with open(salida, 'w', encoding='utf-8') as f:
+        json.dump(actual, f, ensure_ascii=False, indent=1)
+    print(f"\nResultados guardados en {salida}")
+
+    if anterior:
+        with open(anterior, encoding='utf-8') as f:
+            comparar(actual, json.load(f))
+
@@ -0,0 +1,171 @@
+"""Generador de facturas y boletas UBL 2.1 sintéticas con la estructura de SUNAT
+
+Los documentos siguen la forma de los XML reales de `input/` (firma en
+ext:UBLExtensions, cac:Signature, emisor, cliente, totales e items), pero con
+tamaños controlables: cantidad de líneas, largo de las descripciones, cantidad
+de notas, tamaño de la firma y cantidad de emisores distintos.
+"""
+import base64
+from decimal import Decimal, ROUND_HALF_UP
+from xml.sax.saxutils import escape
+import random
+
+NAMESPACES = (
+    'xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2" '
+    'xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2" '
+    'xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2" '
+    'xmlns:ext="urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2"'
+)
+
+PRODUCTOS = ("TEJIDO", "DRILL", "GABARDINA", "DENIM", "POPELINA", "FRANELA", "JERSEY",
+             "OXFORD", "LINO", "CHALIS", "SUITING", "STRETCH", "PIMA", "RIB", "FRENCH TERRY")
+COLORES = ("AZUL", "NEGRO", "BLANCO", "BEIGE", "ROJO", "VERDE", "GRIS", "MELANGE", "CRUDO")
+UNIDADES = ("MTS", "KG", "UND", "ROL")
+DISTRITOS = ("LA VICTORIA", "LIMA", "SAN LUIS", "ATE", "SURQUILLO", "SAN MIGUEL", "BREÑA")
+NOMBRES = ("MARCO ANTONIO", "ROSA ELENA", "JUAN CARLOS", "MARIA DEL PILAR", "LUIS ALBERTO")
+APELLIDOS = ("GUEVARA", "QUISPE", "MAMANI", "FLORES", "RAMIREZ", "TORRES", "CASTILLO")
+UNIDADES_NUMERO = ("CERO", "UNO", "DOS", "TRES", "CUATRO", "CINCO", "SEIS", "SIETE", "OCHO", "NUEVE")
+
+CENTIMO = Decimal("0.01")
+
+
+def emisores(cantidad, semilla=0):
+    """Lista de `cantidad` emisores distintos (RUC, razón social, dirección, correo)"""
+    rnd = random.Random(semilla)
+    lista = []
+    for i in range(cantidad):
+        lista.append({
+            'ruc': f"20{rnd.randrange(10 ** 9):09d}",
+            'nombre': f"TEXTILES {rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)} {i} S.A.C.",
+            'direccion': f"JR MARISCAL AGUSTIN GAMARRA {rnd.randrange(100, 999)} INTERIOR {rnd.randrange(1, 400)}",
+            'distrito': rnd.choice(DISTRITOS),
+            'departamento': "LIMA",
+            'correo': f"ventas{i}@textiles.pe",
+        })
+    return lista
+
+
+def texto_base64(rnd, tamano):
+    """Bloque base64 de ~`tamano` bytes partido en líneas de 76 caracteres como en los XML reales"""
+    crudo = base64.b64encode(rnd.randbytes(max(3, tamano * 3 // 4))).decode()
+    return "&#13;\n".join(crudo[i:i + 76] for i in range(0, len(crudo), 76))
+
+
+def descripcion(rnd, largo):
+    palabras = []
+    while sum(len(p) + 1 for p in palabras) < largo:
+        palabras.append(rnd.choice(PRODUCTOS + COLORES))
+    return " ".join(palabras) or rnd.choice(PRODUCTOS)
+
+
+def monto(valor):
+    return valor.quantize(CENTIMO, rounding=ROUND_HALF_UP)
+
+
+def generar_factura(numero=1, lineas=10, largo_descripcion=40, notas=2, tamano_firma=4096,
+                    emisor=None, tipo="01", semilla=None):
+    """Devolver los bytes de una factura (tipo "01") o boleta (tipo "03") UBL 2.1"""
+    rnd = random.Random(semilla if semilla is not None else numero)
+    emisor = emisor or emisores(1)[0]
+    serie = "F001" if tipo == "01" else "B001"
+
+    if tipo == "01":
+        cliente_id, esquema = f"20{rnd.randrange(10 ** 9):09d}", "6"
+        cliente_nombre = f"{rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)} E.I.R.L."
+    else:
+        cliente_id, esquema = f"{rnd.randrange(10 ** 8):08d}", "1"
+        cliente_nombre = f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}"
+
+    items = []
+    for i in range(1, lineas + 1):
+        cantidad = Decimal(rnd.randrange(1, 5000)) / 100
+        precio = Decimal(rnd.randrange(100, 5000)) / 100
+        valor = monto(cantidad * precio)
+        igv = monto(valor * Decimal("0.18"))
+        items.append((i, cantidad, precio, valor, igv))
+    gravada = sum((item[3] for item in items), Decimal("0.00"))
+    igv_total = sum((item[4] for item in items), Decimal("0.00"))
+    total = gravada + igv_total
+
+    partes = [
+        f'<?xml version="1.0" encoding="UTF-8"?><Invoice {NAMESPACES}>',
+        '<ext:UBLExtensions><ext:UBLExtension><ext:ExtensionContent>',
+        '<ds:Signature xmlns:ds="http://www.w3.org/2000/09/xmldsig#" Id="IdSingEfact"><ds:SignedInfo>',
+        '<ds:CanonicalizationMethod Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315"/>',
+        '<ds:SignatureMethod Algorithm="http://www.w3.org/2000/09/xmldsig#rsa-sha1"/>',
+        '<ds:Reference URI=""><ds:DigestMethod Algorithm="http://www.w3.org/2000/09/xmldsig#sha1"/>',
+        f'<ds:DigestValue>{base64.b64encode(rnd.randbytes(20)).decode()}</ds:DigestValue></ds:Reference></ds:SignedInfo>',
+        f'<ds:SignatureValue>{texto_base64(rnd, 256)}</ds:SignatureValue>',
+        f'<ds:KeyInfo><ds:X509Data><ds:X509Certificate>{texto_base64(rnd, tamano_firma)}</ds:X509Certificate>',
+        '</ds:X509Data></ds:KeyInfo></ds:Signature></ext:ExtensionContent></ext:UBLExtension></ext:UBLExtensions>\n',
+        '   <cbc:UBLVersionID>2.1</cbc:UBLVersionID>\n',
+        '   <cbc:CustomizationID schemeAgencyName="PE:SUNAT">2.0</cbc:CustomizationID>\n',
+        f'   <cbc:ID>{serie}-{numero:08d}</cbc:ID>\n',
+        f'   <cbc:IssueDate>2025-{rnd.randrange(1, 13):02d}-{rnd.randrange(1, 29):02d}</cbc:IssueDate>\n',
+        f'   <cbc:IssueTime>{rnd.randrange(8, 21):02d}:{rnd.randrange(60):02d}:{rnd.randrange(60):02d}</cbc:IssueTime>\n',
+        f'   <cbc:InvoiceTypeCode listAgencyName="PE:SUNAT" listID="0101">{tipo}</cbc:InvoiceTypeCode>\n',
+        f'   <cbc:Note languageLocaleID="1000">{monto_en_letras(total)}</cbc:Note>\n',
+        '   <cbc:Note languageID="L">EFECTIVO</cbc:Note>\n',
+    ]
+    for i in range(max(0, notas - 2)):
+        partes.append(f'   <cbc:Note>OBSERVACION {i + 1}: {descripcion(rnd, 30)}</cbc:Note>\n')
+    partes += [
+        '   <cbc:DocumentCurrencyCode listID="ISO 4217 Alpha">PEN</cbc:DocumentCurrencyCode>\n',
+        f'   <cbc:LineCountNumeric>{lineas}</cbc:LineCountNumeric>\n',
+        '   <cac:Signature><cbc:ID>IDSignature</cbc:ID><cac:SignatoryParty><cac:PartyIdentification>',
+        f'<cbc:ID>{emisor["ruc"]}</cbc:ID></cac:PartyIdentification><cac:PartyName><cbc:Name>{escape(emisor["nombre"])}</cbc:Name>',
+        '</cac:PartyName></cac:SignatoryParty><cac:DigitalSignatureAttachment><cac:ExternalReference>',
+        '<cbc:URI>IDSignature</cbc:URI></cac:ExternalReference></cac:DigitalSignatureAttachment></cac:Signature>\n',
+        '   <cac:AccountingSupplierParty><cac:Party>',
+        f'<cac:PartyIdentification><cbc:ID schemeID="6">{emisor["ruc"]}</cbc:ID></cac:PartyIdentification>',
+        f'<cac:PartyName><cbc:Name>{escape(emisor["nombre"])}</cbc:Name></cac:PartyName>',
+        f'<cac:PartyLegalEntity><cbc:RegistrationName>{escape(emisor["nombre"])}</cbc:RegistrationName>',
+        f'<cac:RegistrationAddress><cbc:ID schemeName="Ubigeos">150115</cbc:ID><cbc:CityName>{emisor["departamento"]}</cbc:CityName>',
+        f'<cbc:District>{emisor["distrito"]}</cbc:District><cac:AddressLine><cbc:Line>{escape(emisor["direccion"])}</cbc:Line>',
+        '</cac:AddressLine></cac:RegistrationAddress></cac:PartyLegalEntity>',
+        f'<cac:Contact><cbc:ElectronicMail>{emisor["correo"]}</cbc:ElectronicMail></cac:Contact>',
+        '</cac:Party></cac:AccountingSupplierParty>\n',
+        '   <cac:AccountingCustomerParty><cac:Party>',
+        f'<cac:PartyIdentification><cbc:ID schemeID="{esquema}">{cliente_id}</cbc:ID></cac:PartyIdentification>',
+        f'<cac:PartyLegalEntity><cbc:RegistrationName>{cliente_nombre}</cbc:RegistrationName>',
+        f'<cac:RegistrationAddress><cbc:CityName>LIMA</cbc:CityName><cbc:District>{rnd.choice(DISTRITOS)}</cbc:District>',
+        f'<cac:AddressLine><cbc:Line>AV. {rnd.choice(APELLIDOS)} {rnd.randrange(100, 3000)}</cbc:Line></cac:AddressLine>',
+        '</cac:RegistrationAddress></cac:PartyLegalEntity></cac:Party></cac:AccountingCustomerParty>\n',
+        f'   <cac:TaxTotal><cbc:TaxAmount currencyID="PEN">{igv_total}</cbc:TaxAmount><cac:TaxSubtotal>',
+        f'<cbc:TaxableAmount currencyID="PEN">{gravada}</cbc:TaxableAmount><cbc:TaxAmount currencyID="PEN">{igv_total}</cbc:TaxAmount>',
+        '<cac:TaxCategory><cac:TaxScheme><cbc:ID>1000</cbc:ID><cbc:Name>IGV</cbc:Name><cbc:TaxTypeCode>VAT</cbc:TaxTypeCode>',
+        '</cac:TaxScheme></cac:TaxCategory></cac:TaxSubtotal></cac:TaxTotal>\n',
+        f'   <cac:LegalMonetaryTotal><cbc:LineExtensionAmount currencyID="PEN">{gravada}</cbc:LineExtensionAmount>',
+        f'<cbc:TaxInclusiveAmount currencyID="PEN">{total}</cbc:TaxInclusiveAmount>',
+        f'<cbc:PayableAmount currencyID="PEN">{total}</cbc:PayableAmount></cac:LegalMonetaryTotal>\n',
+    ]
+    for i, cantidad, precio, valor, igv in items:
+        partes += [
+            f'   <cac:InvoiceLine><cbc:ID>{i}</cbc:ID><cbc:Note>{rnd.choice(UNIDADES)}</cbc:Note>',
+            f'<cbc:InvoicedQuantity unitCode="ZZ">{cantidad}</cbc:InvoicedQuantity>',
+            f'<cbc:LineExtensionAmount currencyID="PEN">{valor}</cbc:LineExtensionAmount>',
+            f'<cac:PricingReference><cac:AlternativeConditionPrice><cbc:PriceAmount currencyID="PEN">{monto(precio * Decimal("1.18"))}</cbc:PriceAmount>',
+            '<cbc:PriceTypeCode>01</cbc:PriceTypeCode></cac:AlternativeConditionPrice></cac:PricingReference>',
+            f'<cac:TaxTotal><cbc:TaxAmount currencyID="PEN">{igv}</cbc:TaxAmount><cac:TaxSubtotal>',
+            f'<cbc:TaxableAmount currencyID="PEN">{valor}</cbc:TaxableAmount><cbc:TaxAmount currencyID="PEN">{igv}</cbc:TaxAmount>',
+            '<cac:TaxCategory><cbc:Percent>18</cbc:Percent><cac:TaxScheme><cbc:ID>1000</cbc:ID></cac:TaxScheme></cac:TaxCategory>',
+            '</cac:TaxSubtotal></cac:TaxTotal>',
+            f'<cac:Item><cbc:Description>{descripcion(rnd, largo_descripcion)}</cbc:Description>',
+            f'<cac:SellersItemIdentification><cbc:ID>{i}</cbc:ID></cac:SellersItemIdentification></cac:Item>',
+            f'<cac:Price><cbc:PriceAmount currencyID="PEN">{precio}</cbc:PriceAmount></cac:Price></cac:InvoiceLine>\n',
+        ]
+    partes.append('</Invoice>')
+    return "".join(partes).encode("utf-8")
+
+
+def monto_en_letras(total):
+    """Texto aproximado del monto en letras (solo importa el largo para el benchmark)"""
+    entero, centimos = divmod(int(total * 100), 100)
+    cifras = " ".join(UNIDADES_NUMERO[int(c)] for c in str(entero))
+    return f"{cifras} Y {centimos:02d}/100 SOLES"
+
+
+def nombre_archivo(emisor, tipo, numero):
+    """Nombre con el formato RUC-TIPO-SERIE-NUMERO.xml de SUNAT"""
+    serie = "F001" if tipo == "01" else "B001"
+    return f"{emisor['ruc']}-{tipo}-{serie}-{numero:08d}.xml"
@@ -0,0 +1,66 @@
+"""Entrada y salida en archivos ZIP sin extraer a disco
+
+El OSE entrega los comprobantes como ZIP con el XML adentro (mismo nombre
+RUC-TIPO-SERIE-NUMERO que en 'input'). Cada XML de un ZIP se representa
+con un MiembroZip, que el parser lee directamente del archivo comprimido,
+y los PDF generados se escriben en memoria dentro de un ZIP de salida.
+"""
+import os
+import zipfile
+
+# ZipFile abiertos por este proceso: {ruta: ZipFile}. Se reabren después de
+# un fork para no compartir la posición del archivo con el proceso padre.
+_abiertos = {}
+_pid = None
+
+
+class MiembroZip:
+    """Un XML dentro de un ZIP (se puede enviar a los procesos del pool)"""
+
+    def __init__(self, ruta_zip, miembro, tamano):
+        self.ruta_zip = ruta_zip
+        self.miembro = miembro
+        self.nombre = os.path.basename(miembro)
+        self.tamano = tamano  # Tamaño descomprimido
+
+    def abrir(self):
+        """Archivo binario con el XML descomprimido a medida que se lee"""
+        global _pid
+        if _pid != os.getpid():
+            _abiertos.clear()
+            _pid = os.getpid()
+        archivo = _abiertos.get(self.ruta_zip)
+        if archivo is None:
+            archivo = _abiertos[self.ruta_zip] = zipfile.ZipFile(self.ruta_zip)
+        return archivo.open(self.miembro)
+
+    def __repr__(self):
+        return f"{self.ruta_zip}:{self.miembro}"
+
+
+def miembros_zip(ruta_zip):
+    """Los XML de un ZIP, ordenados por nombre"""
+    with zipfile.ZipFile(ruta_zip) as archivo:
+        return sorted((MiembroZip(ruta_zip, info.filename, info.file_size)
+                       for info in archivo.infolist()
+                       if not info.is_dir() and info.filename.lower().endswith('.xml')),
+                      key=lambda miembro: miembro.nombre)
+
+
+def escribir_zip(ruta_zip, resultados, extension):
+    """Guardar en `ruta_zip` los bytes de cada Resultado a medida que llegan
+
+    Devuelve la lista de resultados sin los bytes, para no retenerlos en
+    memoria. El ZIP se arma en un temporal y reemplaza al anterior al final.
+    """
+    temporal = ruta_zip + ".tmp"
+    salida = []
+    with zipfile.ZipFile(temporal, 'w', zipfile.ZIP_DEFLATED) as archivo:
+        for resultado in resultados:
+            if resultado.ok:
+                nombre = resultado.nombre.replace('.xml', extension)
+                archivo.writestr(nombre, resultado.datos)
+                resultado = resultado._replace(mensaje=f"{os.path.basename(ruta_zip)}:{nombre}")
+            salida.append(resultado._replace(datos=None))
+    os.replace(temporal, ruta_zip)
+    return salida
@@ -0,0 +1 @@
+"""Configuración de pytest: la raíz del proyecto queda en sys.path para importar los módulos"""
@@ -0,0 +1,195 @@
+"""Salida ESC/POS directa para impresoras térmicas de 80mm
+
+Recorre la misma lista de dibujo que genera FacturaXMLtoPDF.layout() y la
+convierte en líneas de texto nativas de la impresora (fuente A, 48 columnas),
+imágenes y códigos QR en modo bit y el corte de papel, sin pasar por un PDF.
+"""
+import functools
+
+from PIL import Image
+
+from app import IMAGENES, MARGEN, PUNTOS_POR_MM
+from qr import matriz_qr
+
+COLUMNAS = 48            # Caracteres por línea con la fuente A en papel de 80mm
+ANCHO_IMPRESION = 576    # Puntos imprimibles por línea (72mm)
+
+ESC = b"\x1b"
+GS = b"\x1d"
+INICIALIZAR = ESC + b"@"
+CODIGO_WPC1252 = ESC + b"t\x10"
+CENTRAR = ESC + b"a\x01"
+IZQUIERDA = ESC + b"a\x00"
+AVANZAR_Y_CORTAR = GS + b"V\x42\x03"
+
+
+def modo_texto(estilo, tamano):
+    """Comandos para negrita y doble alto según la fuente del PDF"""
+    negrita = ESC + (b"E\x01" if 'B' in estilo else b"E\x00")
+    doble_alto = ESC + (b"!\x10" if tamano >= 10 else b"!\x00")
+    return negrita + doble_alto
+
+
+@functools.lru_cache(maxsize=64)
+def imagen_1bit(ruta, mtime, ancho_puntos):
+    """(alto en puntos, filas de la imagen en 1 bit con 1 = punto negro)
+
+    Se convierte una vez por versión del archivo; la usan esta salida y el
+    PDF compacto (app.imagen_compacta).
+    """
+    with Image.open(ruta) as original:
+        imagen = original.convert("RGBA")
+    # Las zonas transparentes se imprimen como papel en blanco
+    fondo = Image.new("RGBA", imagen.size, "white")
+    fondo.alpha_composite(imagen)
+    alto_puntos = max(1, round(imagen.height * ancho_puntos / imagen.width))
+    imagen = fondo.convert("L").resize((ancho_puntos, alto_puntos)).point(lambda p: 255 if p < 128 else 0, "1")
+    # En modo "1" de PIL el bit 1 es blanco; invertido arriba para que 1 = punto negro
+    return alto_puntos, imagen.tobytes()
+
+
+def imagen_bits(ruta, mtime, ancho_puntos):
+    """Imagen convertida a 1 bit en formato GS v 0"""
+    alto_puntos, bits = imagen_1bit(ruta, mtime, ancho_puntos)
+    bytes_por_fila = (ancho_puntos + 7) // 8
+    cabecera = GS + b"v0\x00" + bytes((bytes_por_fila % 256, bytes_por_fila // 256,
+                                       alto_puntos % 256, alto_puntos // 256))
+    return cabecera + bits
+
+
+@functools.lru_cache(maxsize=256)
+def qr_bits(texto, lado_puntos):
+    """QR de `texto` en formato GS v 0, con un número entero de puntos por módulo
+
+    Los módulos no se reescalan con PIL: cada uno ocupa exactamente los
+    mismos puntos, así el lector no encuentra módulos de ancho desparejo. Se
+    redondea hacia arriba (sin pasar del ancho imprimible) para que el QR no
+    quede más chico que en el PDF.
+    """
+    tamano, filas = matriz_qr(texto)
+    puntos = max(1, min(-(-lado_puntos // tamano), ANCHO_IMPRESION // tamano))
+    ancho_puntos = tamano * puntos
+    bytes_por_fila = (ancho_puntos + 7) // 8
+    relleno = bytes_por_fila * 8 - ancho_puntos
+    raster = bytearray()
+    for fila in filas:
+        ancha = 0
+        for x in range(tamano - 1, -1, -1):
+            # Bit x de la fila es la columna x; en el raster el bit más alto va a la izquierda
+            ancha = ancha << puntos | ((1 << puntos) - 1 if fila >> x & 1 else 0)
+        linea = (ancha << relleno).to_bytes(bytes_por_fila, "big")
+        raster += linea * puntos
+    alto_puntos = ancho_puntos
+    cabecera = GS + b"v0\x00" + bytes((bytes_por_fila % 256, bytes_por_fila // 256,
+                                       alto_puntos % 256, alto_puntos // 256))
+    return cabecera + bytes(raster)
+
+
+def columna(x_mm, ancho_pagina):
+    """Columna de texto que corresponde a una posición horizontal en mm"""
+    return round((x_mm - MARGEN) * COLUMNAS / (ancho_pagina - 2 * MARGEN))
+
+
+def partir(texto, ancho):
+    """Partir el texto por palabras en trozos de `ancho` caracteres como máximo"""
+    if ancho <= 0:
+        return []
+    lineas = []
+    actual = ""
+    for palabra in texto.split():
+        while len(palabra) > ancho:
+            if actual:
+                lineas.append(actual)
+                actual = ""
+            lineas.append(palabra[:ancho])
+            palabra = palabra[ancho:]
+        prueba = f"{actual} {palabra}" if actual else palabra
+        if len(prueba) <= ancho:
+            actual = prueba
+        else:
+            lineas.append(actual)
+            actual = palabra
+    if actual or not lineas:
+        lineas.append(actual)
+    return lineas
+
+
+def alinear(texto, ancho, align):
+    if align == 'C':
+        return texto.center(ancho)
+    if align == 'R':
+        return texto.rjust(ancho)
+    return texto.ljust(ancho)
+
+
+def generar_escpos(maquetacion, ancho_pagina=80):
+    """Convertir una maquetación en los bytes ESC/POS del ticket"""
+    salida = bytearray(INICIALIZAR + CODIGO_WPC1252)
+    # En el rollo las páginas van una detrás de otra
+    for pagina in maquetacion.paginas:
+        salida += filas_escpos(pagina.comandos, ancho_pagina)
+    salida += modo_texto('', 8) + AVANZAR_Y_CORTAR
+    return bytes(salida)
+
+
+def filas_escpos(comandos, ancho_pagina):
+    """Bytes ESC/POS de la lista de dibujo de una página"""
+    # Agrupar las celdas con texto por fila (misma posición vertical)
+    filas = {}
+    fuente = ('Arial', '', 8)
+    for orden, comando in enumerate(comandos):
+        tipo = comando[0]
+        if tipo == 'fuente':
+            fuente = comando[1:]
+        elif tipo == 'celda':
+            _, x, y, w, h, texto, borde, align = comando
+            if texto:
+                filas.setdefault(round(y, 2), []).append((x, orden, w, texto, align, fuente))
+            elif borde == 'T':
+                filas.setdefault(round(y, 2), []).append((x, orden, w, None, align, fuente))
+        elif tipo == 'imagen':
+            filas.setdefault(round(comando[3], 2), []).append((comando[2], orden, comando[4], comando[1], 'imagen', fuente))
+        elif tipo == 'qr':
+            filas.setdefault(round(comando[3], 2), []).append((comando[2], orden, comando[4], comando[1], 'qr', fuente))
+
+    salida = bytearray()
+    for y in sorted(filas):
+        celdas = sorted(filas[y])
+
+        imagenes = [celda for celda in celdas if celda[4] in ('imagen', 'qr')]
+        for _, _, w, contenido, tipo, _ in imagenes:
+            ancho_puntos = min(ANCHO_IMPRESION, round(w * PUNTOS_POR_MM))
+            if tipo == 'qr':
+                salida += CENTRAR + qr_bits(contenido, ancho_puntos) + b"\n" + IZQUIERDA
+                continue
+            mtime = IMAGENES.entrada(contenido)[0]
+            if mtime is None:
+                continue
+            salida += CENTRAR + imagen_bits(contenido, mtime, ancho_puntos) + b"\n" + IZQUIERDA
+
+        textos = [celda for celda in celdas if celda[4] not in ('imagen', 'qr')]
+        if not textos:
+            continue
+        if all(celda[3] is None for celda in textos):
+            salida += modo_texto('', 8) + b"-" * COLUMNAS + b"\n"
+            continue
+
+        # Cada celda ocupa sus columnas; si el texto no entra, la fila crece hacia abajo
+        bloques = []
+        for x, _, w, texto, align, _ in textos:
+            if texto is None:
+                continue
+            inicio = max(0, min(COLUMNAS - 1, columna(x, ancho_pagina)))
+            fin = max(inicio + 1, min(COLUMNAS, columna(x + w, ancho_pagina)))
+            ancho = fin - inicio
+            bloques.append((inicio, ancho, [alinear(linea, ancho, align) for linea in partir(texto, ancho)]))
+
+        _, _, _, _, _, (_, estilo, tamano) = textos[0]
+        salida += modo_texto(estilo, tamano)
+        for i in range(max(len(lineas) for _, _, lineas in bloques)):
+            linea = [" "] * COLUMNAS
+            for inicio, ancho, lineas in bloques:
+                if i < len(lineas):
+                    linea[inicio:inicio + ancho] = lineas[i][:ancho]
+            salida += "".join(linea).rstrip().encode("cp1252", errors="replace") + b"\n"
+    return salida
@@ -0,0 +1,219 @@
+"""Índice SQLite de los comprobantes convertidos, para búsquedas y reimpresiones
+
+Con --indice, cada conversión guarda el número, emisor, cliente, fechas y
+totales del comprobante, el hash del XML, la ruta del ticket generado y el
+modelo parseado (la Factura serializada con pickle y comprimida). Así:
+
+- un XML cuyo contenido ya está en el índice no se vuelve a parsear: los
+  procesos del pool toman el modelo guardado y solo maquetan y dibujan;
+- las búsquedas por número, emisor, cliente o fecha usan los índices de
+  SQLite y tardan milisegundos aunque haya millones de tickets;
+- un ticket se reimprime desde el modelo guardado, sin el XML.
+
+La base usa WAL para que los procesos del pool lean modelos mientras el
+proceso principal (el único que escribe) registra los resultados. El
+modelo se guarda con pickle: el índice es un caché local y solo debe
+abrirse si lo generó esta misma aplicación.
+"""
+import os
+import pathlib
+import pickle
+import sqlite3
+import time
+import zlib
+
+from app import FacturaXMLtoPDF
+
+RUTA_INDICE = os.path.join("output", "indice.sqlite")
+FILAS_POR_TRANSACCION = 500
+# Se incrementa cuando cambian los campos de Factura o Parte: los modelos
+# guardados con otra versión se descartan (quedan con modelo_descartado = 1)
+# y se vuelven a parsear del XML
+VERSION_MODELO = 2
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS comprobantes (
+    emisor_ruc TEXT NOT NULL,
+    numero TEXT NOT NULL,
+    tipo_documento TEXT,
+    cliente_id TEXT,
+    cliente_nombre TEXT,
+    fecha_emision TEXT,
+    hora_emision TEXT,
+    total_venta INTEGER,
+    total_igv INTEGER,
+    total_pagar INTEGER,
+    huella TEXT NOT NULL,
+    archivo TEXT,
+    modelo BLOB,
+    salida TEXT,
+    actualizado REAL,
+    modelo_descartado INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (emisor_ruc, numero)
+);
+CREATE INDEX IF NOT EXISTS comprobantes_huella ON comprobantes (huella);
+CREATE INDEX IF NOT EXISTS comprobantes_numero ON comprobantes (numero);
+CREATE INDEX IF NOT EXISTS comprobantes_cliente ON comprobantes (cliente_id, fecha_emision);
+CREATE INDEX IF NOT EXISTS comprobantes_fecha ON comprobantes (fecha_emision);
+"""
+
+COLUMNAS = ('emisor_ruc', 'numero', 'tipo_documento', 'cliente_id', 'cliente_nombre',
+            'fecha_emision', 'hora_emision', 'total_venta', 'total_igv', 'total_pagar',
+            'huella', 'archivo', 'modelo', 'salida', 'actualizado')
+
+# Si el XML cambió, el modelo anterior se descarta aunque la nueva conversión
+# no traiga uno (streaming); si es el mismo XML se conserva el ya guardado.
+# Después de convertirlo de nuevo, el modelo ya no está descartado por versión.
+REGISTRAR = f"""
+INSERT INTO comprobantes ({', '.join(COLUMNAS)}) VALUES ({', '.join('?' * len(COLUMNAS))})
+ON CONFLICT (emisor_ruc, numero) DO UPDATE SET
+    {', '.join(f'{c} = excluded.{c}' for c in COLUMNAS if c != 'modelo')},
+    modelo_descartado = 0,
+    modelo = CASE WHEN excluded.huella = comprobantes.huella
+                  THEN coalesce(excluded.modelo, comprobantes.modelo)
+                  ELSE excluded.modelo END
+"""
+
+# Lectores de solo lectura de este proceso: {ruta: Connection}. Se reabren
+# después de un fork (una conexión SQLite no se puede compartir entre procesos).
+_lectores = {}
+_pid = None
+
+
+def serializar_modelo(factura):
+    return zlib.compress(pickle.dumps(factura, pickle.HIGHEST_PROTOCOL), 1)
+
+
+def deserializar_modelo(datos):
+    return pickle.loads(zlib.decompress(datos))
+
+
+def fila_indice(factura, huella, archivo, con_modelo=True):
+    """Valores de una fila del índice hasta el modelo (se arma en el proceso que convirtió el XML)
+
+    La salida y la fecha de actualización las agrega Indice.registrar. Con
+    `con_modelo` False la fila no trae modelo: el XML ya estaba en el
+    índice, o se convirtió en streaming y la Factura quedó sin items.
+    """
+    emisor = factura.emisor
+    cliente = factura.cliente
+    return (emisor.id if emisor else 'N/A', factura.numero, factura.tipo_documento,
+            cliente.id if cliente else None, cliente.nombre if cliente else None,
+            factura.fecha_emision, factura.hora_emision,
+            factura.total_venta, factura.total_igv, factura.total_pagar,
+            huella, archivo, serializar_modelo(factura) if con_modelo else None)
+
+
+def modelo_guardado(ruta, huella):
+    """Factura guardada para el XML de hash `huella`, o None si no está en el índice"""
+    global _pid
+    if _pid != os.getpid():
+        _lectores.clear()
+        _pid = os.getpid()
+    conexion = _lectores.get(ruta)
+    if conexion is None:
+        if not os.path.exists(ruta):
+            return None  # Todavía no hay índice: se abre cuando exista
+        uri = pathlib.Path(ruta).absolute().as_uri() + "?mode=ro"
+        conexion = _lectores[ruta] = sqlite3.connect(uri, uri=True)
+    fila = conexion.execute("SELECT modelo FROM comprobantes WHERE huella = ? AND modelo IS NOT NULL LIMIT 1",
+                            (huella,)).fetchone()
+    return deserializar_modelo(fila[0]) if fila else None
+
+
+class Indice:
+    """Índice de comprobantes en un archivo SQLite"""
+
+    def __init__(self, ruta=RUTA_INDICE):
+        self.ruta = ruta
+        self.conexion = sqlite3.connect(ruta)
+        self.conexion.row_factory = sqlite3.Row
+        self.conexion.execute("PRAGMA journal_mode = WAL")
+        self.conexion.execute("PRAGMA synchronous = NORMAL")
+        self.conexion.executescript(ESQUEMA)
+        columnas = {fila['name'] for fila in self.conexion.execute("PRAGMA table_info(comprobantes)")}
+        if 'modelo_descartado' not in columnas:
+            # Índices creados antes de que existiera la columna
+            with self.conexion:
+                self.conexion.execute("ALTER TABLE comprobantes "
+                                      "ADD COLUMN modelo_descartado INTEGER NOT NULL DEFAULT 0")
+        if self.conexion.execute("PRAGMA user_version").fetchone()[0] != VERSION_MODELO:
+            with self.conexion:
+                self.conexion.execute("UPDATE comprobantes SET modelo = NULL, modelo_descartado = 1 "
+                                      "WHERE modelo IS NOT NULL")
+                self.conexion.execute(f"PRAGMA user_version = {VERSION_MODELO}")
+
+    def registrar(self, resultados):
+        """Guardar la fila de cada Resultado convertido y devolverlo sin ella
+
+        Es un generador que deja pasar los resultados a medida que llegan;
+        la salida registrada es Resultado.mensaje (la ruta del ticket o su
+        lugar dentro del ZIP) y las filas se confirman en transacciones de
+        FILAS_POR_TRANSACCION.
+        """
+        pendientes = 0
+        try:
+            for resultado in resultados:
+                if resultado.ok and resultado.indice is not None:
+                    self.conexion.execute(REGISTRAR, (*resultado.indice, resultado.mensaje, time.time()))
+                    pendientes += 1
+                    if pendientes >= FILAS_POR_TRANSACCION:
+                        self.conexion.commit()
+                        pendientes = 0
+                yield resultado._replace(indice=None)
+        finally:
+            self.conexion.commit()
+
+    def buscar(self, numero=None, emisor=None, cliente=None, desde=None, hasta=None, limite=100):
+        """Comprobantes que cumplen todos los filtros, por fecha y hora de emisión
+
+        `desde` y `hasta` son fechas AAAA-MM-DD (inclusive). Devuelve una
+        lista de diccionarios con las columnas del índice, sin el modelo.
+        """
+        condiciones = []
+        parametros = []
+        for columna, operador, valor in (('numero', '=', numero), ('emisor_ruc', '=', emisor),
+                                         ('cliente_id', '=', cliente), ('fecha_emision', '>=', desde),
+                                         ('fecha_emision', '<=', hasta)):
+            if valor is not None:
+                condiciones.append(f"{columna} {operador} ?")
+                parametros.append(valor)
+        donde = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        columnas = ', '.join(c for c in COLUMNAS if c != 'modelo')
+        filas = self.conexion.execute(
+            f"SELECT {columnas} FROM comprobantes {donde} "
+            f"ORDER BY fecha_emision, hora_emision, emisor_ruc, numero LIMIT ?",
+            (*parametros, limite))
+        return [dict(fila) for fila in filas]
+
+    def modelo(self, emisor, numero):
+        """(Factura, nombre del XML) guardados de un comprobante
+
+        Lanza LookupError si el comprobante no está en el índice o no tiene
+        el modelo guardado: porque se convirtió en streaming o porque se
+        descartó al cambiar VERSION_MODELO.
+        """
+        fila = self.conexion.execute("SELECT modelo, archivo, modelo_descartado FROM comprobantes "
+                                     "WHERE emisor_ruc = ? AND numero = ?", (emisor, numero)).fetchone()
+        if fila is None:
+            raise LookupError(f"El comprobante {emisor}-{numero} no está en el índice")
+        if fila['modelo'] is None and fila['modelo_descartado']:
+            raise LookupError(f"El modelo guardado del comprobante {emisor}-{numero} se descartó al cambiar "
+                              f"la versión del modelo; vuelva a convertir {fila['archivo']}")
+        if fila['modelo'] is None:
+            raise LookupError(f"El comprobante {emisor}-{numero} se convirtió en streaming y no tiene "
+                              f"el modelo guardado; vuelva a convertir {fila['archivo']}")
+        return deserializar_modelo(fila['modelo']), fila['archivo']
+
+    def reimprimir(self, emisor, numero, output_path=None, formato='pdf'):
+        """Generar de nuevo el ticket desde el modelo guardado, sin leer el XML
+
+        Devuelve los bytes generados, que además se escriben en
+        `output_path` si se pasa.
+        """
+        factura = FacturaXMLtoPDF(None, output_path)
+        factura.factura, _ = self.modelo(emisor, numero)
+        return factura.renderizar(formato=formato)
+
+    def close(self):
+        self.conexion.close()
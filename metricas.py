@@ -0,0 +1,153 @@
+"""Tiempos por etapa y contadores de cada ticket
+
+Cada FacturaXMLtoPDF lleva un MetricasTicket donde se registra el tiempo de
+pared y de CPU de cada etapa (lectura del XML, parseo, maquetación, tabla de
+items, imágenes, dibujo y serialización) y contadores como cantidad de items,
+aciertos de cache o bytes generados. Al terminar un ticket, registrar_ticket()
+escribe una línea JSON en el log "tickets.metricas" y acumula los valores en
+REGISTRO, que se puede exportar en formato de texto de Prometheus.
+
+Las etapas pueden anidarse: "tabla" es parte de "maquetacion", e "imagenes"
+y "qr" son parte de "dibujo".
+"""
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+# Las líneas JSON solo se emiten si se configuró un archivo (configurar_log_json)
+LOG_METRICAS = logging.getLogger("tickets.metricas")
+LOG_METRICAS.propagate = False
+LOG_METRICAS.setLevel(logging.WARNING)
+PREFIJO = "tickets"
+
+
+class MetricasTicket:
+    """Tiempos por etapa y contadores de un solo ticket"""
+
+    def __init__(self):
+        self.etapas = {}       # nombre -> [segundos de pared, segundos de CPU]
+        self.contadores = {}
+
+    @contextlib.contextmanager
+    def etapa(self, nombre):
+        pared = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.sumar(nombre, time.perf_counter() - pared, time.process_time() - cpu)
+
+    def sumar(self, nombre, pared, cpu=0.0):
+        acumulado = self.etapas.setdefault(nombre, [0.0, 0.0])
+        acumulado[0] += pared
+        acumulado[1] += cpu
+
+    def contar(self, nombre, valor=1):
+        self.contadores[nombre] = self.contadores.get(nombre, 0) + valor
+
+    def como_dict(self):
+        return {
+            'etapas': {nombre: {'pared_ms': round(pared * 1000, 3), 'cpu_ms': round(cpu * 1000, 3)}
+                       for nombre, (pared, cpu) in self.etapas.items()},
+            'contadores': dict(self.contadores),
+        }
+
+
+class Registro:
+    """Acumulado de las métricas de muchos tickets, exportable para Prometheus
+
+    Lo actualizan a la vez el hilo de la vigilancia, el event loop del
+    servidor y los callbacks del planificador: todo acceso pasa por el lock.
+    """
+
+    def __init__(self):
+        self.tickets = {}      # resultado ("ok"/"error") -> cantidad
+        self.etapas = {}       # nombre -> [cantidad, pared_s, cpu_s]
+        self.contadores = {}
+        self.lock = threading.Lock()
+
+    def acumular(self, metricas, ok=True):
+        resultado = "ok" if ok else "error"
+        with self.lock:
+            self.tickets[resultado] = self.tickets.get(resultado, 0) + 1
+            if not metricas:
+                return
+            for nombre, valores in metricas['etapas'].items():
+                acumulado = self.etapas.setdefault(nombre, [0, 0.0, 0.0])
+                acumulado[0] += 1
+                acumulado[1] += valores['pared_ms'] / 1000
+                acumulado[2] += valores['cpu_ms'] / 1000
+            for nombre, valor in metricas['contadores'].items():
+                self.contadores[nombre] = self.contadores.get(nombre, 0) + valor
+
+    def prometheus(self):
+        """Texto en el formato de exposición de Prometheus"""
+        with self.lock:
+            return self._prometheus()
+
+    def _prometheus(self):
+        lineas = [f"# TYPE {PREFIJO}_procesados_total counter"]
+        for resultado, cantidad in sorted(self.tickets.items()):
+            lineas.append(f'{PREFIJO}_procesados_total{{resultado="{resultado}"}} {cantidad}')
+
+        for metrica, indice in (("etapa_segundos", 1), ("etapa_cpu_segundos", 2)):
+            lineas.append(f"# TYPE {PREFIJO}_{metrica} summary")
+            for nombre, acumulado in sorted(self.etapas.items()):
+                lineas.append(f'{PREFIJO}_{metrica}_sum{{etapa="{nombre}"}} {acumulado[indice]:.6f}')
+                lineas.append(f'{PREFIJO}_{metrica}_count{{etapa="{nombre}"}} {acumulado[0]}')
+
+        for nombre, valor in sorted(self.contadores.items()):
+            lineas.append(f"# TYPE {PREFIJO}_{nombre}_total counter")
+            lineas.append(f"{PREFIJO}_{nombre}_total {valor}")
+        return "\n".join(lineas) + "\n"
+
+    def escribir_prometheus(self, ruta):
+        """Escribir el archivo para el textfile collector (reemplazo atómico)"""
+        temporal = ruta + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(temporal, ruta)
+
+
+REGISTRO = Registro()
+
+
+def configurar_log_json(ruta):
+    """Enviar una línea JSON por ticket a `ruta`"""
+    manejador = logging.FileHandler(ruta, encoding="utf-8")
+    manejador.setFormatter(logging.Formatter("%(message)s"))
+    LOG_METRICAS.addHandler(manejador)
+    LOG_METRICAS.setLevel(logging.INFO)
+
+
+def registrar_ticket(metricas, ok=True, **campos):
+    """Acumular las métricas de un ticket y escribirlas en el log JSON"""
+    REGISTRO.acumular(metricas, ok)
+    if LOG_METRICAS.isEnabledFor(logging.INFO):
+        registro = {'ts': round(time.time(), 3), 'ok': ok, **campos, **(metricas or {})}
+        LOG_METRICAS.info(json.dumps(registro, ensure_ascii=False))
+
+
+@contextlib.contextmanager
+def perfilar(metricas, archivo_perfil=None, memoria=False):
+    """Perfilar un ticket con cProfile (a `archivo_perfil`) y/o medir su pico de memoria"""
+    perfil = cProfile.Profile() if archivo_perfil else None
+    if memoria:
+        tracemalloc.start()
+    if perfil:
+        perfil.enable()
+    try:
+        yield
+    finally:
+        if perfil:
+            perfil.disable()
+            perfil.dump_stats(archivo_perfil)
+        if memoria:
+            _, pico = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            metricas.contar('memoria_pico_bytes', pico)
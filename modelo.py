@@ -0,0 +1,200 @@
+"""Modelo tipado de la factura que produce el parser y usan los renderizadores
+
+Los montos se guardan como enteros: céntimos para los importes y
+millonésimas para cantidades y precios unitarios, así no hay que convertir
+texto a número en cada dibujo ni arrastrar errores de float. Los items se
+guardan por columnas (arrays de enteros y listas de textos) en lugar de un
+diccionario por línea, para que las facturas de miles de líneas que quedan
+en memoria en lotes y paquetes ocupen poco.
+"""
+from array import array
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import sys
+from typing import NamedTuple
+
+ESCALA_MONTO = 100         # Importes en céntimos
+ESCALA_CANTIDAD = 10 ** 6  # Cantidades y precios unitarios en millonésimas
+MAXIMO_ENTERO = 2 ** 63 - 1  # Lo que cabe en las columnas array('q') de Items
+
+
+class NumeroInvalido(ValueError):
+    """Un número del XML es infinito, NaN o no cabe en un entero de 64 bits"""
+
+
+def a_entero(texto, escala):
+    """Convertir un número en texto a entero escalado (0 si no es un número)
+
+    Lanza NumeroInvalido si el número no es finito o es demasiado grande.
+    La magnitud se revisa antes de escalar, así un "1E+999999999" no llega
+    a armar un entero enorme.
+    """
+    if not texto:
+        return 0
+    try:
+        numero = Decimal(texto.strip())
+    except (InvalidOperation, ValueError):
+        return 0
+    if not numero.is_finite():
+        raise NumeroInvalido(f"número no finito: {texto.strip()!r}")
+    # Desde 10 ** 19 ya no cabe en 64 bits, aun sin escalar
+    if numero.adjusted() >= 19:
+        raise NumeroInvalido(f"número fuera de rango: {texto.strip()!r}")
+    valor = int((numero * escala).to_integral_value(ROUND_HALF_UP))
+    if abs(valor) > MAXIMO_ENTERO:
+        raise NumeroInvalido(f"número fuera de rango: {texto.strip()!r}")
+    return valor
+
+
+def texto_monto(valor, escala=ESCALA_MONTO):
+    """Entero escalado como texto con dos decimales: 123456 -> '1234.56'"""
+    centimos = valor if escala == ESCALA_MONTO else \
+        int((Decimal(valor) * ESCALA_MONTO / escala).to_integral_value(ROUND_HALF_UP))
+    signo = '-' if centimos < 0 else ''
+    enteros, resto = divmod(abs(centimos), ESCALA_MONTO)
+    return f"{signo}{enteros}.{resto:02d}"
+
+
+def texto_cantidad(valor):
+    """Cantidad sin ceros sobrantes: 2000000 -> '2', 1666667000 -> '1666.667'"""
+    signo = '-' if valor < 0 else ''
+    enteros, resto = divmod(abs(valor), ESCALA_CANTIDAD)
+    if not resto:
+        return f"{signo}{enteros}"
+    return f"{signo}{enteros}.{resto:06d}".rstrip('0')
+
+
+@dataclass(slots=True)
+class Parte:
+    """Emisor o cliente del comprobante"""
+    id: str = 'N/A'
+    nombre: str = 'N/A'
+    direccion: str = 'N/A'
+    distrito: str = 'N/A'
+    departamento: str = 'N/A'
+    correo: str = 'N/A'
+    tipo_documento: str = ''  # schemeID del documento (catálogo 06 de SUNAT: 1 DNI, 6 RUC, ...)
+
+
+@dataclass(slots=True)
+class Nota:
+    """cbc:Note que no es el monto en letras ni la forma de pago"""
+    texto: str
+    language_locale: str | None = None
+    language_id: str | None = None
+
+
+class Item(NamedTuple):
+    """Una línea de la factura (vista de Items, o la que entrega el parser al_item)"""
+    codigo: str
+    unidad: str
+    descripcion: str
+    cantidad: int   # millonésimas
+    precio: int     # millonésimas
+    total: int      # céntimos
+
+
+def crear_item(codigo, unidad, descripcion, cantidad, precio, total):
+    """Item a partir de los textos del XML"""
+    # Códigos y unidades se repiten mucho entre líneas y facturas
+    return Item(sys.intern(codigo), sys.intern(unidad), descripcion, a_entero(cantidad, ESCALA_CANTIDAD),
+                a_entero(precio, ESCALA_CANTIDAD), a_entero(total, ESCALA_MONTO))
+
+
+class Items:
+    """Líneas de la factura guardadas por columnas"""
+
+    __slots__ = ('codigos', 'unidades', 'descripciones', 'cantidades', 'precios', 'totales')
+
+    def __init__(self):
+        self.codigos = []
+        self.unidades = []
+        self.descripciones = []
+        self.cantidades = array('q')
+        self.precios = array('q')
+        self.totales = array('q')
+
+    def agregar(self, codigo, unidad, descripcion, cantidad, precio, total):
+        """Agregar una línea con los textos del XML"""
+        item = crear_item(codigo, unidad, descripcion, cantidad, precio, total)
+        self.codigos.append(item.codigo)
+        self.unidades.append(item.unidad)
+        self.descripciones.append(item.descripcion)
+        self.cantidades.append(item.cantidad)
+        self.precios.append(item.precio)
+        self.totales.append(item.total)
+
+    def __len__(self):
+        return len(self.codigos)
+
+    def __getitem__(self, i):
+        return Item(self.codigos[i], self.unidades[i], self.descripciones[i],
+                    self.cantidades[i], self.precios[i], self.totales[i])
+
+    def __iter__(self):
+        return map(Item, self.codigos, self.unidades, self.descripciones,
+                   self.cantidades, self.precios, self.totales)
+
+
+@dataclass(slots=True)
+class Factura:
+    """Datos del comprobante necesarios para imprimir el ticket"""
+    numero: str = 'N/A'
+    fecha_emision: str = 'N/A'
+    hora_emision: str = 'N/A'
+    tipo_documento: str = 'BOLETA DE VENTA'
+    codigo_tipo: str = ''     # cbc:InvoiceTypeCode (catálogo 01: 01 factura, 03 boleta)
+    emisor: Parte | None = None
+    cliente: Parte | None = None
+    guia: str = 'N/A'
+    total_venta: int = 0   # céntimos
+    total_igv: int = 0
+    total_pagar: int = 0
+    monto_letras: str = ''
+    forma_pago: str = ''
+    otras_notas: list = field(default_factory=list)
+    items: Items = field(default_factory=Items)
+    valor_resumen: str = ''   # ds:DigestValue de la firma (el "hash" del comprobante)
+
+    def texto_qr(self):
+        """Contenido del QR de la representación impresa, en el formato de SUNAT
+
+        RUC|tipo|serie|número|IGV|total|fecha|tipo doc. cliente|doc. cliente|valor resumen|
+        """
+        serie, _, correlativo = self.numero.partition('-')
+        tipo = self.codigo_tipo or ('01' if serie[:1].upper() == 'F' else '03')
+        emisor = self.emisor or Parte(id='')
+        cliente = self.cliente or Parte(id='')
+        campos = (emisor.id, tipo, serie, correlativo, texto_monto(self.total_igv),
+                  texto_monto(self.total_pagar), self.fecha_emision, cliente.tipo_documento,
+                  cliente.id, self.valor_resumen)
+        return "|".join(campo or '' for campo in campos) + "|"
+
+    def como_dict(self):
+        """Diccionario con las claves y textos del formato anterior (self.data)"""
+        data = {
+            'monto_letras': self.monto_letras,
+            'forma_pago': self.forma_pago,
+            'otras_notes': [{'texto': n.texto, 'languageLocaleID': n.language_locale,
+                             'languageID': n.language_id} for n in self.otras_notas],
+            'numero_factura': self.numero,
+            'fecha_emision': self.fecha_emision,
+            'hora_emision': self.hora_emision,
+            'tipo_documento': self.tipo_documento,
+        }
+        if self.emisor is not None:
+            e = self.emisor
+            data.update(emisor_nombre=e.nombre, emisor_ruc=e.id, emisor_direccion=e.direccion,
+                        emisor_distrito=e.distrito, emisor_departamento=e.departamento,
+                        correo_emisor=e.correo)
+        if self.cliente is not None:
+            c = self.cliente
+            data.update(cliente_nombre=c.nombre, cliente_ID=c.id, cliente_direccion=c.direccion,
+                        cliente_distrito=c.distrito, cliente_departamento=c.departamento)
+        data.update(cliente_guia=self.guia, total_venta=texto_monto(self.total_venta),
+                    total_igv=texto_monto(self.total_igv), total_pagar=texto_monto(self.total_pagar))
+        data['items'] = [{'id': i.codigo, 'unidad': i.unidad, 'descripcion': i.descripcion,
+                          'cantidad': texto_cantidad(i.cantidad),
+                          'precio_unitario': texto_cantidad(i.precio),
+                          'total': texto_monto(i.total)} for i in self.items]
+        return data
@@ -0,0 +1,119 @@
+"""Paquetes de tickets: muchas facturas como páginas de un mismo PDF
+
+Para archivo mensual y reimpresiones masivas. Cada factura es una página con
+su propio alto; el logo y las fuentes se guardan una sola vez por volumen
+(el QR de cada factura son vectores dentro de su página). Los paquetes se
+escriben en volúmenes de `tamano_volumen` tickets (así la memoria no crece
+con el lote) y se genera un índice JSON factura -> volúmenes y páginas, además
+de un marcador por factura.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import contextlib
+import json
+import logging
+import os
+
+from app import FacturaXMLtoPDF, Resultado, crear_pdf, nombre_fuente, silenciar_logs
+from metricas import registrar_ticket
+from planificador import VENTANA_POR_PROCESO
+
+LOG = logging.getLogger("tickets")
+
+TAMANO_VOLUMEN = 1000
+
+
+def maquetar_archivo(xml_path):
+    """Parsear y maquetar un XML (se ejecuta dentro de los procesos del pool)
+
+    Devuelve (nombre, factura o None, mensaje de error). La factura viaja ya
+    maquetada (con sus métricas), así el proceso principal solo tiene que
+    dibujarla.
+    """
+    nombre = nombre_fuente(xml_path)
+    try:
+        factura = FacturaXMLtoPDF(xml_path, None)
+        if not factura.parse_xml():
+            return nombre, None, factura.error
+        factura.layout()
+        return nombre, factura, ''
+    except Exception as e:
+        return nombre, None, f"{type(e).__name__}: {e}"
+
+
+def maquetar_en_pool(xml_paths, pool, limite):
+    """Como map(maquetar_archivo, xml_paths) en `pool`, con a lo sumo `limite` archivos enviados a la vez
+
+    Así los tickets maquetados que esperan a ser dibujados no crecen con el
+    tamaño del lote.
+    """
+    ventana = collections.deque()
+    for xml_path in xml_paths:
+        ventana.append(pool.submit(maquetar_archivo, xml_path))
+        if len(ventana) >= limite:
+            yield ventana.popleft().result()
+    while ventana:
+        yield ventana.popleft().result()
+
+
+def generar_paquete(xml_paths, output_dir, nombre, tamano_volumen=TAMANO_VOLUMEN, workers=1):
+    """Generar los volúmenes `nombre-0001.pdf`, ... y el índice `nombre.json`
+
+    `xml_paths` puede incluir XML dentro de ZIP (comprimidos.MiembroZip).
+    En el índice cada RUC-número tiene la lista de sus tickets: un
+    comprobante repetido en la entrada aparece más de una vez, con un
+    aviso. Devuelve la lista de Resultado en el orden de `xml_paths`.
+    """
+    indice = {'volumenes': [], 'facturas': {}}
+    resultados = []
+    pdf = None
+    tickets = 0  # Tickets del volumen actual (un ticket largo ocupa varias páginas)
+
+    def cerrar_volumen():
+        archivo = f"{nombre}-{len(indice['volumenes']) + 1:04d}.pdf"
+        pdf.output(os.path.join(output_dir, archivo))
+        indice['volumenes'].append({'archivo': archivo, 'paginas': pdf.page, 'tickets': tickets})
+        LOG.info("Volumen generado: %s (%d tickets)", archivo, tickets)
+
+    with contextlib.ExitStack() as pila:
+        if workers > 1:
+            pool = pila.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=silenciar_logs))
+            maquetadas = maquetar_en_pool(xml_paths, pool, workers * VENTANA_POR_PROCESO)
+        else:
+            maquetadas = map(maquetar_archivo, xml_paths)
+
+        for nombre_xml, factura, mensaje in maquetadas:
+            if factura is None:
+                registrar_ticket(None, False, archivo=nombre_xml)
+                resultados.append(Resultado(nombre_xml, False, mensaje))
+                continue
+
+            emisor = factura.factura.emisor
+            clave = f"{emisor.id if emisor else 'N/A'}-{factura.factura.numero}"
+            if pdf is None:
+                pdf = crear_pdf(factura.page_width, factura.maquetacion.paginas[0].alto)
+                tickets = 0
+            ubicaciones = indice['facturas'].setdefault(clave, [])
+            if ubicaciones:
+                LOG.warning("El comprobante %s se repite: %s y %s", clave, ubicaciones[0]['xml'], nombre_xml)
+            ubicaciones.append({
+                'archivo': f"{nombre}-{len(indice['volumenes']) + 1:04d}.pdf",
+                'pagina': pdf.page + 1,  # Primera página del ticket
+                'xml': nombre_xml,
+            })
+            factura.render_page(pdf, marcador=clave)
+            tickets += 1
+            metricas = factura.resumen_metricas()
+            registrar_ticket(metricas, True, archivo=nombre_xml)
+            resultados.append(Resultado(nombre_xml, True, clave, metricas))
+
+            if tickets >= tamano_volumen:
+                cerrar_volumen()
+                pdf = None
+
+    if pdf is not None:
+        cerrar_volumen()
+
+    with open(os.path.join(output_dir, f"{nombre}.json"), 'w', encoding='utf-8') as f:
+        json.dump(indice, f, ensure_ascii=False, indent=1)
+    return resultados
@@ -0,0 +1,279 @@
+"""Planificador con prioridades delante del pool de procesos
+
+Hay dos clases de trabajo. Los interactivos (el ticket que alguien espera en
+el mostrador, pedido al servidor) pasan delante de los de lote (carpeta de
+entrada, vigilancia, reimpresiones masivas). Los trabajos se entregan al
+pool solo cuando hay un proceso libre, así un interactivo nunca queda en la
+cola interna del pool detrás de miles de archivos; además los lotes no
+pueden ocupar más de `max_lote` procesos, de modo que siempre queda al menos
+uno para los interactivos.
+
+Un trabajo de lote que falla por un error transitorio se reintenta con
+espera exponencial (un disco de red que no responde, un proceso del pool
+que murió); un XML inválido no se reintenta, volvería a fallar igual. Si
+sigue fallando, el XML se aparta a la carpeta de cuarentena junto con un
+NOMBRE.error.txt con el motivo, para que no se vuelva a intentar en cada
+pasada. Si un proceso del pool muere, el pool se recrea y los trabajos que
+tenía en curso cuentan un intento fallido.
+"""
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import threading
+import time
+
+from app import Resultado, convertir_archivo, nombre_fuente, registrar_resultados, silenciar_logs
+
+LOG = logging.getLogger("tickets")
+
+INTERACTIVO = 0
+LOTE = 1
+CLASES = {INTERACTIVO: "interactivo", LOTE: "lote"}
+
+REINTENTOS_LOTE = 2     # Intentos adicionales de un archivo de lote que falla
+ESPERA_INICIAL = 0.5    # Segundos antes del primer reintento; se duplica en cada uno
+ESPERA_MAXIMA = 30.0
+# Archivos de lote entregados al planificador a la vez por cada proceso (el
+# resto espera en el iterador, así la memoria no crece con el tamaño del lote)
+VENTANA_POR_PROCESO = 64
+
+
+class ConversionFallida(Exception):
+    """Un archivo de lote no se pudo convertir; lleva el Resultado con el error"""
+
+    def __init__(self, resultado):
+        super().__init__(resultado)
+        self.resultado = resultado
+
+
+def convertir_o_fallar(xml_path, output_path, formato='pdf', perfilado=None, indice=None):
+    """convertir_archivo que lanza ConversionFallida si falla, para poder reintentarlo"""
+    resultado = convertir_archivo(xml_path, output_path, formato, perfilado, indice)
+    if not resultado.ok:
+        raise ConversionFallida(resultado)
+    return resultado
+
+
+def es_transitorio(error):
+    """True si vale la pena reintentar un trabajo que falló con `error`"""
+    if isinstance(error, ConversionFallida):
+        return error.resultado.transitorio
+    return isinstance(error, (OSError, BrokenProcessPool))
+
+
+class Trabajo:
+    """Una llamada pendiente en el planificador"""
+
+    __slots__ = ('prioridad', 'funcion', 'args', 'reintentos', 'intentos', 'futuro')
+
+    def __init__(self, prioridad, funcion, args, reintentos):
+        self.prioridad = prioridad
+        self.funcion = funcion
+        self.args = args
+        self.reintentos = reintentos
+        self.intentos = 0
+        self.futuro = Future()
+
+
+class Planificador:
+    """Pool de procesos con colas por prioridad, reintentos y concurrencia acotada para los lotes"""
+
+    def __init__(self, workers, max_lote=None, espera_inicial=ESPERA_INICIAL, initializer=silenciar_logs):
+        self.workers = max(1, workers)
+        # Con un solo proceso el lote lo usa, y un interactivo espera a lo sumo un ticket
+        self.max_lote = max_lote or max(1, self.workers - 1)
+        self.espera_inicial = espera_inicial
+        self.initializer = initializer
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=initializer)
+        self.colas = {INTERACTIVO: [], LOTE: []}   # heaps de (listo_en, secuencia, Trabajo)
+        self.en_curso = {INTERACTIVO: 0, LOTE: 0}
+        self.secuencia = itertools.count()
+        self.contadores = collections.Counter()    # reintentos, fallidos, pools_reiniciados
+        self.condicion = threading.Condition()
+        self.cerrado = False
+        self.hilo = threading.Thread(target=self._despachar, name="planificador", daemon=True)
+        self.hilo.start()
+
+    def enviar(self, funcion, *args, prioridad=INTERACTIVO, reintentos=0):
+        """Encolar funcion(*args) para un proceso del pool; devuelve un Future
+
+        Si la llamada lanza un error transitorio (ver es_transitorio) se
+        reintenta hasta `reintentos` veces con espera exponencial; después,
+        o ante cualquier otro error, el Future termina con esa excepción.
+        """
+        trabajo = Trabajo(prioridad, funcion, args, reintentos)
+        with self.condicion:
+            if self.cerrado:
+                raise RuntimeError("el planificador está cerrado")
+            self._encolar(trabajo, time.monotonic())
+        return trabajo.futuro
+
+    def calentar(self):
+        """Arrancar todos los procesos ahora y no con los primeros trabajos"""
+        futuros = [self.enviar(os.getpid) for _ in range(self.workers)]
+        for futuro in futuros:
+            futuro.result()
+
+    def estado(self):
+        """Trabajos en cola y en curso por clase, y contadores de fallas"""
+        with self.condicion:
+            return {
+                'en_cola': {CLASES[p]: len(cola) for p, cola in self.colas.items()},
+                'en_curso': {CLASES[p]: n for p, n in self.en_curso.items()},
+                **self.contadores,
+            }
+
+    def cerrar(self):
+        """Cancelar lo que sigue en cola y terminar el pool (espera a los trabajos en curso)"""
+        with self.condicion:
+            self.cerrado = True
+            en_cola = [trabajo for cola in self.colas.values() for _, _, trabajo in cola]
+            for cola in self.colas.values():
+                cola.clear()
+            self.condicion.notify()
+        for trabajo in en_cola:
+            # Un reintento en espera ya está en curso y no se puede cancelar
+            if not trabajo.futuro.cancel():
+                trabajo.futuro.set_exception(RuntimeError("el planificador se cerró"))
+        self.hilo.join()
+        self.pool.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excepcion):
+        self.cerrar()
+
+    def _encolar(self, trabajo, listo_en):
+        heapq.heappush(self.colas[trabajo.prioridad], (listo_en, next(self.secuencia), trabajo))
+        self.condicion.notify()
+
+    def _siguiente(self):
+        """(Trabajo que puede empezar ya o None, segundos hasta que haya uno listo o None)"""
+        ahora = time.monotonic()
+        espera = None
+        if sum(self.en_curso.values()) >= self.workers:
+            return None, None
+        for prioridad in (INTERACTIVO, LOTE):
+            cola = self.colas[prioridad]
+            if not cola or (prioridad == LOTE and self.en_curso[LOTE] >= self.max_lote):
+                continue
+            listo_en = cola[0][0]
+            if listo_en <= ahora:
+                return heapq.heappop(cola)[2], None
+            # Un reintento que todavía no debe empezar no frena a los demás de su clase
+            # porque el heap está ordenado por listo_en
+            espera = listo_en - ahora if espera is None else min(espera, listo_en - ahora)
+        return None, espera
+
+    def _despachar(self):
+        """Hilo que pasa los trabajos al pool a medida que se liberan procesos
+
+        El pool se usa sin tener tomado self.condicion: sus hilos internos
+        pueden completar futuros (y llamar a _terminado) con sus propios
+        locks tomados.
+        """
+        while True:
+            with self.condicion:
+                trabajo = None
+                while trabajo is None and not self.cerrado:
+                    trabajo, espera = self._siguiente()
+                    if trabajo is None:
+                        self.condicion.wait(espera)
+                    elif trabajo.intentos == 0 and not trabajo.futuro.set_running_or_notify_cancel():
+                        trabajo = None  # Cancelado mientras esperaba
+                if self.cerrado:
+                    return
+                trabajo.intentos += 1
+                self.en_curso[trabajo.prioridad] += 1
+                pool = self.pool
+            try:
+                futuro = pool.submit(trabajo.funcion, *trabajo.args)
+            except BrokenProcessPool as e:
+                futuro = Future()
+                futuro.set_exception(e)
+            futuro.add_done_callback(lambda f, trabajo=trabajo, pool=pool: self._terminado(trabajo, f, pool))
+
+    def _terminado(self, trabajo, futuro, pool):
+        error = futuro.exception()
+        roto = None
+        with self.condicion:
+            self.en_curso[trabajo.prioridad] -= 1
+            if isinstance(error, BrokenProcessPool) and pool is self.pool and not self.cerrado:
+                # Un proceso murió (p. ej. sin memoria): todos los trabajos de
+                # este pool fallan con el mismo error, pero se recrea una sola vez
+                self.contadores['pools_reiniciados'] += 1
+                roto = self.pool
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=self.initializer)
+            reintentar = (error is not None and es_transitorio(error) and trabajo.intentos <= trabajo.reintentos
+                          and not self.cerrado)
+            if reintentar:
+                self.contadores['reintentos'] += 1
+                espera = min(ESPERA_MAXIMA, self.espera_inicial * 2 ** (trabajo.intentos - 1))
+                self._encolar(trabajo, time.monotonic() + espera)
+            elif error is not None:
+                self.contadores['fallidos'] += 1
+            self.condicion.notify()
+
+        if roto is not None:
+            LOG.warning("Un proceso del pool terminó de forma inesperada; se reinició el pool")
+            roto.shutdown(wait=False)
+        if error is None:
+            trabajo.futuro.set_result(futuro.result())
+        elif not reintentar:
+            trabajo.futuro.set_exception(error)
+
+
+def poner_en_cuarentena(fuente, motivo, carpeta):
+    """Apartar un XML que no se pudo convertir y dejar el motivo en NOMBRE.error.txt
+
+    Los XML dentro de un ZIP no se mueven: solo se escribe el motivo.
+    """
+    os.makedirs(carpeta, exist_ok=True)
+    nombre = nombre_fuente(fuente)
+    if isinstance(fuente, (str, os.PathLike)) and os.path.exists(fuente):
+        shutil.move(fuente, os.path.join(carpeta, nombre))
+    with open(os.path.join(carpeta, nombre + ".error.txt"), "w", encoding="utf-8") as f:
+        f.write(f"{fuente}\n{motivo}\n")
+    LOG.warning("En cuarentena: %s (%s)", nombre, motivo)
+
+
+def iterar_planificado(trabajos, planificador, formato='pdf', perfilado=None, indice=None,
+                       reintentos=REINTENTOS_LOTE, cuarentena=None):
+    """Convertir una lista de (xml_path, output_path) como trabajos de lote del planificador
+
+    Cada archivo que falla por un error transitorio se reintenta hasta
+    `reintentos` veces; los que fallan, si se pasa la carpeta `cuarentena`,
+    se apartan ahí. Entrega los Resultado en el orden de `trabajos` apenas
+    están listos.
+    """
+    ventana = collections.deque()
+    pendientes = iter(trabajos)
+    limite = planificador.workers * VENTANA_POR_PROCESO
+
+    def siguiente_resultado():
+        xml_path, futuro = ventana.popleft()
+        try:
+            resultado = futuro.result()
+        except ConversionFallida as e:
+            resultado = e.resultado
+        except Exception as e:
+            resultado = Resultado(nombre_fuente(xml_path), False, f"{type(e).__name__}: {e}")
+        if not resultado.ok and cuarentena:
+            poner_en_cuarentena(xml_path, resultado.mensaje, cuarentena)
+        registrar_resultados([resultado])
+        return resultado
+
+    for xml_path, output_path in pendientes:
+        ventana.append((xml_path, planificador.enviar(convertir_o_fallar, xml_path, output_path, formato,
+                                                      perfilado, indice, prioridad=LOTE,
+                                                      reintentos=reintentos)))
+        if len(ventana) >= limite:
+            yield siguiente_resultado()
+    while ventana:
+        yield siguiente_resultado()
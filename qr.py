@@ -0,0 +1,387 @@
+"""Códigos QR (ISO/IEC 18004) en Python puro, para dibujarlos como vectores
+
+Solo se implementa lo que usa el ticket: modo byte (UTF-8), cualquier
+versión de 1 a 40 y los cuatro niveles de corrección. La matriz se arma con
+enteros (un entero por fila, bit x = columna x) para que probar las ocho
+máscaras sea barato: los patrones fijos, el orden de colocación de los bits
+y las máscaras dependen solo de la versión y se calculan una vez.
+"""
+import functools
+
+NIVELES = {'L': 1, 'M': 0, 'Q': 3, 'H': 2}  # Bits de formato de cada nivel
+INDICE_NIVEL = {'L': 0, 'M': 1, 'Q': 2, 'H': 3}
+
+# Codewords de corrección por bloque y cantidad de bloques, por nivel (L, M, Q, H) y versión
+ECC_POR_BLOQUE = (
+    (None, 7, 10, 15, 20, 26, 18, 20, 24, 30, 18, 20, 24, 26, 30, 22, 24, 28, 30, 28, 28,
+     28, 28, 30, 30, 26, 28, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30),
+    (None, 10, 16, 26, 18, 24, 16, 18, 22, 22, 26, 30, 22, 22, 24, 24, 28, 28, 26, 26, 26,
+     26, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28),
+    (None, 13, 22, 18, 26, 18, 24, 18, 22, 20, 24, 28, 26, 24, 20, 30, 24, 28, 28, 26, 30,
+     28, 30, 30, 30, 30, 28, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30),
+    (None, 17, 28, 22, 16, 22, 28, 26, 26, 24, 28, 24, 28, 22, 24, 24, 30, 28, 28, 26, 28,
+     30, 24, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30),
+)
+BLOQUES = (
+    (None, 1, 1, 1, 1, 1, 2, 2, 2, 2, 4, 4, 4, 4, 4, 6, 6, 6, 6, 7, 8,
+     8, 9, 9, 10, 12, 12, 12, 13, 14, 15, 16, 17, 18, 19, 19, 20, 21, 22, 24, 25),
+    (None, 1, 1, 1, 2, 2, 4, 4, 4, 5, 5, 5, 8, 9, 9, 10, 10, 11, 13, 14, 16,
+     17, 17, 18, 20, 21, 23, 25, 26, 28, 29, 31, 33, 35, 37, 38, 40, 43, 45, 47, 49),
+    (None, 1, 1, 2, 2, 4, 4, 6, 6, 8, 8, 8, 10, 12, 16, 12, 17, 16, 18, 21, 20,
+     23, 23, 25, 27, 29, 34, 34, 35, 38, 40, 43, 45, 48, 51, 53, 56, 59, 62, 65, 68),
+    (None, 1, 1, 2, 4, 4, 4, 5, 6, 8, 8, 11, 11, 16, 16, 18, 16, 19, 21, 25, 25,
+     25, 34, 30, 32, 35, 37, 40, 42, 45, 48, 51, 54, 57, 60, 63, 66, 70, 74, 77, 81),
+)
+
+# Aritmética en GF(256) con el polinomio 0x11D
+EXP = [0] * 512
+LOG = [0] * 256
+_valor = 1
+for _i in range(255):
+    EXP[_i] = _valor
+    LOG[_valor] = _i
+    _valor <<= 1
+    if _valor & 0x100:
+        _valor ^= 0x11D
+for _i in range(255, 512):
+    EXP[_i] = EXP[_i - 255]
+
+# Parecidos a un patrón de posición (regla 3 de la sección 7.8.3), en cualquier sentido
+PATRONES_FINDER = ("10111010000", "00001011101")
+
+
+def modulos_crudos(version):
+    """Módulos disponibles para datos y corrección en una versión"""
+    resultado = (16 * version + 128) * version + 64
+    if version >= 2:
+        alineaciones = version // 7 + 2
+        resultado -= (25 * alineaciones - 10) * alineaciones - 55
+        if version >= 7:
+            resultado -= 36
+    return resultado
+
+
+def codewords_datos(version, nivel):
+    i = INDICE_NIVEL[nivel]
+    return modulos_crudos(version) // 8 - ECC_POR_BLOQUE[i][version] * BLOQUES[i][version]
+
+
+@functools.lru_cache(maxsize=None)
+def divisor_rs(grado):
+    """Polinomio generador de Reed-Solomon de `grado` (sin el coeficiente principal)"""
+    resultado = [0] * (grado - 1) + [1]
+    raiz = 1
+    for _ in range(grado):
+        for j in range(grado):
+            resultado[j] = EXP[LOG[resultado[j]] + LOG[raiz]] if resultado[j] else 0
+            if j + 1 < grado:
+                resultado[j] ^= resultado[j + 1]
+        raiz = EXP[LOG[raiz] + 1]
+    return tuple(LOG[c] if c else None for c in resultado)
+
+
+def resto_rs(datos, grado):
+    """Codewords de corrección de un bloque"""
+    divisor = divisor_rs(grado)
+    resto = [0] * grado
+    for byte in datos:
+        factor = byte ^ resto.pop(0)
+        resto.append(0)
+        if factor:
+            log_factor = LOG[factor]
+            for i, log_coef in enumerate(divisor):
+                if log_coef is not None:
+                    resto[i] ^= EXP[log_coef + log_factor]
+    return resto
+
+
+def posiciones_alineacion(version):
+    if version == 1:
+        return []
+    cantidad = version // 7 + 2
+    paso = (version * 8 + cantidad * 3 + 5) // (cantidad * 4 - 4) * 2
+    tamano = version * 4 + 17
+    return [6] + sorted(tamano - 7 - i * paso for i in range(cantidad - 1))
+
+
+@functools.lru_cache(maxsize=None)
+def plantilla(version):
+    """Patrones fijos de una versión (sin formato): (filas oscuras, filas de función, orden de los bits)
+
+    Las filas son enteros; el orden es la lista de (fila, columna) donde va
+    cada bit de datos, recorriendo las columnas de a dos en zigzag.
+    """
+    tamano = version * 4 + 17
+    oscuros = [[False] * tamano for _ in range(tamano)]
+    funcion = [[False] * tamano for _ in range(tamano)]
+
+    def fijar(x, y, oscuro):
+        oscuros[y][x] = oscuro
+        funcion[y][x] = True
+
+    for i in range(tamano):
+        fijar(6, i, i % 2 == 0)
+        fijar(i, 6, i % 2 == 0)
+    for cx, cy in ((3, 3), (tamano - 4, 3), (3, tamano - 4)):
+        for dy in range(-4, 5):
+            for dx in range(-4, 5):
+                if 0 <= cx + dx < tamano and 0 <= cy + dy < tamano:
+                    fijar(cx + dx, cy + dy, max(abs(dx), abs(dy)) not in (2, 4))
+    alineaciones = posiciones_alineacion(version)
+    ultima = len(alineaciones) - 1
+    for i, cx in enumerate(alineaciones):
+        for j, cy in enumerate(alineaciones):
+            if (i, j) in ((0, 0), (0, ultima), (ultima, 0)):
+                continue  # Se superponen con los patrones de posición
+            for dy in range(-2, 3):
+                for dx in range(-2, 3):
+                    fijar(cx + dx, cy + dy, max(abs(dx), abs(dy)) != 1)
+    # Zonas de formato (se escriben al final) y módulo siempre oscuro
+    for i in range(9):
+        funcion[8][i] = funcion[i][8] = True
+    for i in range(8):
+        funcion[8][tamano - 1 - i] = funcion[tamano - 1 - i][8] = True
+    fijar(8, tamano - 8, True)
+    if version >= 7:
+        resto = version
+        for _ in range(12):
+            resto = (resto << 1) ^ ((resto >> 11) * 0x1F25)
+        bits = version << 12 | resto
+        for i in range(18):
+            oscuro = (bits >> i) & 1 == 1
+            a, b = tamano - 11 + i % 3, i // 3
+            fijar(a, b, oscuro)
+            fijar(b, a, oscuro)
+
+    orden = []
+    derecha = tamano - 1
+    while derecha >= 1:
+        if derecha == 6:
+            derecha = 5
+        subiendo = (derecha + 1) & 2 == 0
+        for vertical in range(tamano):
+            y = tamano - 1 - vertical if subiendo else vertical
+            for x in (derecha, derecha - 1):
+                if not funcion[y][x]:
+                    orden.append((y, x))
+        derecha -= 2
+
+    def enteros(matriz):
+        return tuple(sum(1 << x for x, valor in enumerate(fila) if valor) for fila in matriz)
+
+    return enteros(oscuros), enteros(funcion), tuple(orden)
+
+
+MASCARAS = (
+    lambda x, y: (x + y) % 2 == 0,
+    lambda x, y: y % 2 == 0,
+    lambda x, y: x % 3 == 0,
+    lambda x, y: (x + y) % 3 == 0,
+    lambda x, y: (x // 3 + y // 2) % 2 == 0,
+    lambda x, y: x * y % 2 + x * y % 3 == 0,
+    lambda x, y: (x * y % 2 + x * y % 3) % 2 == 0,
+    lambda x, y: ((x + y) % 2 + x * y % 3) % 2 == 0,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def mascaras(version):
+    """Las ocho máscaras de una versión como filas de enteros, ya sin los módulos de función"""
+    tamano = version * 4 + 17
+    _, funcion, _ = plantilla(version)
+    return tuple(tuple(sum(1 << x for x in range(tamano) if mascara(x, y)) & ~funcion[y]
+                       for y in range(tamano))
+                 for mascara in MASCARAS)
+
+
+def preparar_versiones(hasta_version=10):
+    """Calcular de antemano plantillas y máscaras (para calentar un proceso)
+
+    El contenido de SUNAT (unos 100 bytes) usa las versiones 5 a 8 en nivel M.
+    """
+    for version in range(1, hasta_version + 1):
+        mascaras(version)
+
+
+def bits_formato(nivel, mascara):
+    datos = NIVELES[nivel] << 3 | mascara
+    resto = datos
+    for _ in range(10):
+        resto = (resto << 1) ^ ((resto >> 9) * 0x537)
+    return (datos << 10 | resto) ^ 0x5412
+
+
+def escribir_formato(filas, tamano, nivel, mascara):
+    bits = bits_formato(nivel, mascara)
+    filas = list(filas)
+
+    def fijar(x, y, oscuro):
+        if oscuro:
+            filas[y] |= 1 << x
+        else:
+            filas[y] &= ~(1 << x)
+
+    for i in range(6):
+        fijar(8, i, (bits >> i) & 1)
+    fijar(8, 7, (bits >> 6) & 1)
+    fijar(8, 8, (bits >> 7) & 1)
+    fijar(7, 8, (bits >> 8) & 1)
+    for i in range(9, 15):
+        fijar(14 - i, 8, (bits >> i) & 1)
+    for i in range(8):
+        fijar(tamano - 1 - i, 8, (bits >> i) & 1)
+    for i in range(8, 15):
+        fijar(8, tamano - 15 + i, (bits >> i) & 1)
+    return filas
+
+
+@functools.lru_cache(maxsize=None)
+def empaquetado(tamano):
+    """Máscaras para evaluar todas las filas y columnas de una vez (ver penalizacion)
+
+    Cada línea ocupa `tamano` + 1 bits; el bit de separación queda en 0 y
+    las máscaras solo marcan los lugares donde una ventana entra entera en
+    su línea, así ningún patrón cruza de una línea a la siguiente.
+    """
+    hueco = tamano + 1
+
+    def repetir(bits, lineas):
+        return sum(bits << i * hueco for i in range(lineas))
+
+    # Bit x de una fila -> bit x * hueco: de a 8 bits para transponer con sumas
+    repartir = tuple(sum((v >> i & 1) << i * hueco for i in range(8)) for v in range(256))
+    return (hueco, repartir,
+            repetir((1 << tamano - 1) - 1, 2 * tamano),    # Pares de módulos vecinos
+            repetir((1 << tamano - 10) - 1, 2 * tamano),   # Ventanas de 11 módulos
+            repetir((1 << tamano - 1) - 1, tamano - 1),    # Bloques de 2x2 (solo filas)
+            (1 << hueco * tamano) - 1)                     # Las filas
+
+
+def penalizacion(filas, tamano):
+    """Puntaje de la máscara según las cuatro reglas de la norma (menor es mejor)
+
+    Las filas y las columnas se empaquetan en un solo entero y cada regla
+    se evalúa con unas pocas operaciones sobre él.
+    """
+    hueco, repartir, pares, ventanas11, bloques, solo_filas = empaquetado(tamano)
+    lineas = 0
+    columnas = 0
+    for y in range(tamano - 1, -1, -1):
+        fila = filas[y]
+        lineas = lineas << hueco | fila
+        # Transponer: el bit x de la fila y pasa a la columna x, bit y
+        corrimiento = y
+        while fila:
+            columnas |= repartir[fila & 255] << corrimiento
+            fila >>= 8
+            corrimiento += 8 * hueco
+    lineas |= columnas << hueco * tamano
+
+    # Rachas de 5 o más módulos iguales: 3 puntos + 1 por cada módulo extra.
+    # En `ventanas` queda un bit por cada grupo de 5 iguales consecutivos.
+    iguales = ~(lineas ^ (lineas >> 1)) & pares
+    ventanas = iguales & (iguales >> 1) & (iguales >> 2) & (iguales >> 3)
+    puntaje = ventanas.bit_count() + 2 * (ventanas & ~(ventanas << 1)).bit_count()
+
+    # Bloques de 2x2 del mismo color que empiezan en cada columna x
+    filas_juntas = lineas & solo_filas
+    iguales = ~(filas_juntas ^ (filas_juntas >> hueco))
+    puntaje += 3 * (iguales & (iguales >> 1) & ~(filas_juntas ^ (filas_juntas >> 1)) & bloques).bit_count()
+
+    for patron in PATRONES_FINDER:
+        coincide = ventanas11
+        for k, bit in enumerate(reversed(patron)):
+            coincide &= (lineas >> k) if bit == "1" else ~(lineas >> k)
+        puntaje += 40 * coincide.bit_count()
+
+    oscuros = filas_juntas.bit_count()
+    total = tamano * tamano
+    puntaje += 10 * ((abs(oscuros * 20 - total * 10) + total - 1) // total - 1)
+    return puntaje
+
+
+@functools.lru_cache(maxsize=4096)
+def matriz_qr(texto, nivel='M'):
+    """Módulos del QR de `texto`: (tamaño, tupla de filas) con el bit x de cada fila = columna x oscura"""
+    datos = texto.encode("utf-8")
+    for version in range(1, 41):
+        bits_conteo = 8 if version <= 9 else 16
+        capacidad = codewords_datos(version, nivel) * 8
+        if 4 + bits_conteo + len(datos) * 8 <= capacidad:
+            break
+    else:
+        raise ValueError(f"El texto no entra en un QR de nivel {nivel} ({len(datos)} bytes)")
+
+    # Modo byte: indicador, cantidad de bytes y datos; terminador y relleno
+    flujo = (0b0100 << bits_conteo | len(datos)) << len(datos) * 8 | int.from_bytes(datos, "big")
+    largo = 4 + bits_conteo + len(datos) * 8
+    terminador = min(4, capacidad - largo)
+    flujo <<= terminador
+    largo += terminador
+    flujo <<= -largo % 8
+    largo += -largo % 8
+    codewords = list(flujo.to_bytes(largo // 8, "big"))
+    for relleno in range(capacidad // 8 - len(codewords)):
+        codewords.append(0xEC if relleno % 2 == 0 else 0x11)
+
+    # Bloques con su corrección, intercalados
+    i = INDICE_NIVEL[nivel]
+    cantidad_bloques = BLOQUES[i][version]
+    ecc = ECC_POR_BLOQUE[i][version]
+    crudos = modulos_crudos(version) // 8
+    cortos = cantidad_bloques - crudos % cantidad_bloques
+    largo_corto = crudos // cantidad_bloques
+    bloques = []
+    posicion = 0
+    for b in range(cantidad_bloques):
+        largo_datos = largo_corto - ecc + (0 if b < cortos else 1)
+        bloque = codewords[posicion:posicion + largo_datos]
+        posicion += largo_datos
+        correccion = resto_rs(bloque, ecc)
+        if b < cortos:
+            bloque.append(None)  # Los bloques cortos tienen un codeword menos
+        bloques.append(bloque + correccion)
+    final = [bloque[j] for j in range(len(bloques[0])) for bloque in bloques if bloque[j] is not None]
+
+    tamano = version * 4 + 17
+    fijos, _, orden = plantilla(version)
+    filas = list(fijos)
+    for k, (y, x) in enumerate(orden[:len(final) * 8]):
+        if (final[k >> 3] >> (7 - (k & 7))) & 1:
+            filas[y] |= 1 << x
+
+    mejor = None
+    for numero, mascara in enumerate(mascaras(version)):
+        candidata = escribir_formato([fila ^ m for fila, m in zip(filas, mascara)], tamano, nivel, numero)
+        puntaje = penalizacion(candidata, tamano)
+        if mejor is None or puntaje < mejor[0]:
+            mejor = (puntaje, candidata)
+    return tamano, tuple(mejor[1])
+
+
+def rectangulos(filas):
+    """Rectángulos oscuros que cubren el QR: (columna, fila, ancho, alto)
+
+    Cada tramo oscuro de una fila es un rectángulo; si la fila siguiente
+    tiene un tramo en las mismas columnas, se alarga el mismo rectángulo.
+    """
+    resultado = []
+    anteriores = {}  # (columna, ancho) -> rectángulo que llega a la fila anterior
+    for y, fila in enumerate(filas):
+        actuales = {}
+        x = 0
+        while fila:
+            ceros = (fila & -fila).bit_length() - 1
+            fila >>= ceros
+            x += ceros
+            unos = (~fila & (fila + 1)).bit_length() - 1
+            rectangulo = anteriores.get((x, unos))
+            if rectangulo is None:
+                rectangulo = [x, y, unos, 0]
+                resultado.append(rectangulo)
+            rectangulo[3] += 1
+            actuales[x, unos] = rectangulo
+            fila >>= unos
+            x += unos
+        anteriores = actuales
+    return [tuple(rectangulo) for rectangulo in resultado]
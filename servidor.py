@@ -0,0 +1,220 @@
+"""Servicio HTTP local de renderizado de tickets
+
+Recibe el XML UBL en el cuerpo de un POST y responde con el PDF (o los bytes
+ESC/POS). El parseo y el dibujo corren en un pool de procesos que se calienta
+al arrancar (imports, fuentes, imágenes), y cada proceso conserva sus caches
+de medición e imágenes entre peticiones. Las peticiones en curso están
+acotadas: cuando la cola se llena se responde 503 para que el cliente
+reintente, en lugar de acumular trabajo sin límite.
+
+El pool está detrás del planificador (planificador.py): las peticiones son
+interactivas y pasan delante de los trabajos de lote, que llegan con
+?prioridad=lote o desde la vigilancia de la carpeta de entrada cuando el
+servidor se levanta con --watch.
+
+    POST /render[?formato=escpos][&prioridad=lote]   cuerpo: XML   ->  200 application/pdf
+    GET  /salud                                    ->  200 JSON con el estado
+    GET  /metricas                                 ->  200 texto para Prometheus
+"""
+import asyncio
+import contextlib
+import json
+import os
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+from app import EXTENSIONES, FacturaXMLtoPDF, XMLInvalido, calentar
+from metricas import REGISTRO, PREFIJO, registrar_ticket
+from planificador import CLASES, INTERACTIVO, LOTE, Planificador
+
+TAMANO_MAXIMO_XML = 10 * 1024 * 1024
+TIEMPO_ESPERA_LECTURA = 30  # segundos
+RAZONES = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           411: "Length Required", 413: "Payload Too Large", 422: "Unprocessable Entity",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+TIPOS = {'pdf': "application/pdf", 'compacto': "application/pdf", 'escpos': "application/octet-stream"}
+TIPO_PROMETHEUS = "text/plain; version=0.0.4"
+PRIORIDADES = {nombre: prioridad for prioridad, nombre in CLASES.items()}
+
+
+def renderizar(xml, formato='pdf'):
+    """Convertir el XML recibido en bytes (se ejecuta dentro de los procesos del pool)
+
+    Devuelve (bytes, resumen de métricas del ticket).
+    """
+    factura = FacturaXMLtoPDF(xml, None)
+    return factura.renderizar(formato=formato), factura.resumen_metricas()
+
+
+class Servidor:
+    """Servidor HTTP/1.1 mínimo sobre asyncio con un pool de procesos precalentado"""
+
+    def __init__(self, host="127.0.0.1", puerto=8080, workers=None, max_cola=None, vigilante=None):
+        self.host = host
+        self.puerto = puerto
+        self.workers = workers or os.cpu_count() or 1
+        # Peticiones de cada prioridad que se aceptan a la vez (en proceso + esperando un proceso libre)
+        self.max_cola = max_cola or self.workers * 4
+        self.en_curso = {INTERACTIVO: 0, LOTE: 0}
+        self.atendidas = 0
+        self.rechazadas = 0
+        self.planificador = None
+        # vigilancia.Vigilante que convierte la carpeta de entrada como trabajos de lote
+        self.vigilante = vigilante
+
+    async def iniciar(self):
+        self.planificador = Planificador(self.workers, initializer=calentar)
+        # Arrancar todos los procesos ahora y no con las primeras peticiones
+        await asyncio.to_thread(self.planificador.calentar)
+        if self.vigilante is not None:
+            self.vigilante.planificador = self.planificador
+            threading.Thread(target=self.vigilante.ejecutar, name="vigilancia", daemon=True).start()
+        return await asyncio.start_server(self.atender, self.host, self.puerto)
+
+    async def ejecutar(self):
+        servidor = await self.iniciar()
+        print(f"Escuchando en http://{self.host}:{self.puerto} ({self.workers} procesos, cola máxima {self.max_cola})")
+        try:
+            async with servidor:
+                await servidor.serve_forever()
+        finally:
+            self.planificador.cerrar()
+
+    async def atender(self, reader, writer):
+        """Atender las peticiones de una conexión (con keep-alive)"""
+        try:
+            while True:
+                try:
+                    peticion = await asyncio.wait_for(self.leer_peticion(reader), TIEMPO_ESPERA_LECTURA)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if peticion is None:
+                    break
+                if isinstance(peticion, int):
+                    await self.responder(writer, peticion, b"", cerrar=True)
+                    break
+
+                metodo, ruta, cabeceras, cuerpo = peticion
+                estado, tipo, datos = await self.despachar(metodo, ruta, cuerpo)
+                cerrar = cabeceras.get("connection", "").lower() == "close"
+                await self.responder(writer, estado, datos, tipo, cerrar)
+                if cerrar:
+                    break
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def leer_peticion(self, reader):
+        """Leer una petición; devuelve None si se cerró la conexión o un código de error"""
+        linea = await reader.readline()
+        if not linea:
+            return None
+        try:
+            metodo, ruta, _ = linea.decode("latin-1").split()
+        except ValueError:
+            return 400
+
+        cabeceras = {}
+        while True:
+            linea = await reader.readline()
+            if linea in (b"\r\n", b"\n", b""):
+                break
+            nombre, _, valor = linea.decode("latin-1").partition(":")
+            cabeceras[nombre.strip().lower()] = valor.strip()
+
+        cuerpo = b""
+        if "content-length" in cabeceras:
+            # El cuerpo se lee con cualquier método: si quedara en el stream se
+            # leería como la petición siguiente de la conexión
+            try:
+                largo = int(cabeceras["content-length"])
+            except ValueError:
+                return 400
+            if largo < 0:
+                return 400
+            if largo > TAMANO_MAXIMO_XML:
+                return 413
+            cuerpo = await reader.readexactly(largo)
+        elif metodo == "POST":
+            return 411
+        return metodo, ruta, cabeceras, cuerpo
+
+    async def despachar(self, metodo, ruta, cuerpo):
+        partes = urlsplit(ruta)
+        if partes.path == "/salud":
+            estado = {'en_curso': sum(self.en_curso.values()), 'max_cola': self.max_cola, 'workers': self.workers,
+                      'atendidas': self.atendidas, 'rechazadas': self.rechazadas,
+                      'planificador': self.planificador.estado()}
+            return 200, "application/json", json.dumps(estado).encode()
+        if partes.path == "/metricas":
+            return 200, TIPO_PROMETHEUS, self.metricas().encode()
+        if partes.path != "/render":
+            return 404, "text/plain", b"no encontrado"
+        if metodo != "POST":
+            return 405, "text/plain", b"use POST"
+
+        consulta = parse_qs(partes.query)
+        formato = consulta.get("formato", ["pdf"])[0]
+        if formato not in EXTENSIONES:
+            return 400, "text/plain", f"formato desconocido: {formato}".encode()
+        prioridad = PRIORIDADES.get(consulta.get("prioridad", ["interactivo"])[0])
+        if prioridad is None:
+            return 400, "text/plain", b"prioridad desconocida (interactivo o lote)"
+
+        # Contrapresión: si ya hay demasiado trabajo aceptado, rechazar de inmediato
+        if self.en_curso[prioridad] >= self.max_cola:
+            self.rechazadas += 1
+            return 503, "text/plain", b"servidor ocupado, reintente"
+
+        self.en_curso[prioridad] += 1
+        try:
+            datos, metricas = await asyncio.wrap_future(
+                self.planificador.enviar(renderizar, cuerpo, formato, prioridad=prioridad))
+            self.atendidas += 1
+            registrar_ticket(metricas, True, formato=formato)
+            return 200, TIPOS[formato], datos
+        except XMLInvalido as e:
+            registrar_ticket(None, False, formato=formato)
+            return 422, "text/plain", str(e).encode()
+        except Exception as e:
+            registrar_ticket(None, False, formato=formato)
+            return 500, "text/plain", f"{type(e).__name__}: {e}".encode()
+        finally:
+            self.en_curso[prioridad] -= 1
+
+    def metricas(self):
+        """Métricas de los tickets atendidos más el estado de la cola y del planificador"""
+        estado = self.planificador.estado()
+        lineas = [f"# TYPE {PREFIJO}_servidor_en_curso gauge\n",
+                  f"{PREFIJO}_servidor_en_curso {sum(self.en_curso.values())}\n",
+                  f"# TYPE {PREFIJO}_servidor_rechazadas_total counter\n",
+                  f"{PREFIJO}_servidor_rechazadas_total {self.rechazadas}\n"]
+        for metrica in ('en_cola', 'en_curso'):
+            lineas.append(f"# TYPE {PREFIJO}_planificador_{metrica} gauge\n")
+            for clase, valor in sorted(estado[metrica].items()):
+                lineas.append(f'{PREFIJO}_planificador_{metrica}{{clase="{clase}"}} {valor}\n')
+        for contador in ('reintentos', 'fallidos', 'pools_reiniciados'):
+            lineas.append(f"# TYPE {PREFIJO}_planificador_{contador}_total counter\n")
+            lineas.append(f"{PREFIJO}_planificador_{contador}_total {estado.get(contador, 0)}\n")
+        return REGISTRO.prometheus() + "".join(lineas)
+
+    async def responder(self, writer, estado, datos, tipo="text/plain", cerrar=False):
+        cabeceras = [f"HTTP/1.1 {estado} {RAZONES.get(estado, '')}",
+                     f"Content-Type: {tipo}",
+                     f"Content-Length: {len(datos)}"]
+        if estado == 503:
+            cabeceras.append("Retry-After: 1")
+        if cerrar:
+            cabeceras.append("Connection: close")
+        writer.write(("\r\n".join(cabeceras) + "\r\n\r\n").encode("latin-1"))
+        writer.write(datos)
+        with contextlib.suppress(ConnectionError):
+            await writer.drain()
+
+
+def servir(host="127.0.0.1", puerto=8080, workers=None, vigilante=None):
+    try:
+        asyncio.run(Servidor(host, puerto, workers, vigilante=vigilante).ejecutar())
+    except KeyboardInterrupt:
+        print("\nServidor detenido")
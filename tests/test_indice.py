@@ -0,0 +1,37 @@
+"""Pruebas del motivo por el que un comprobante del índice no tiene modelo"""
+import pathlib
+import sqlite3
+
+import pytest
+
+from app import Resultado, parsear_ubl
+from indice import Indice, fila_indice
+
+ENTRADA = pathlib.Path(__file__).resolve().parent.parent / "input"
+
+
+def registrar(ruta, con_modelo):
+    xml = sorted(ENTRADA.glob("*.xml"))[0]
+    factura = parsear_ubl(str(xml))
+    indice = Indice(str(ruta))
+    list(indice.registrar([Resultado(xml.name, True, "ticket.pdf",
+                                     indice=fila_indice(factura, "huella", xml.name, con_modelo))]))
+    return indice, factura
+
+
+def test_sin_modelo_por_streaming(tmp_path):
+    indice, factura = registrar(tmp_path / "indice.sqlite", con_modelo=False)
+    with pytest.raises(LookupError, match="streaming"):
+        indice.modelo(factura.emisor.id, factura.numero)
+
+
+def test_modelo_descartado_por_version(tmp_path):
+    ruta = tmp_path / "indice.sqlite"
+    indice, factura = registrar(ruta, con_modelo=True)
+    assert indice.modelo(factura.emisor.id, factura.numero)[0].numero == factura.numero
+    indice.close()
+    with sqlite3.connect(ruta) as conexion:
+        conexion.execute("PRAGMA user_version = 1")
+    indice = Indice(str(ruta))
+    with pytest.raises(LookupError, match="versión del modelo"):
+        indice.modelo(factura.emisor.id, factura.numero)
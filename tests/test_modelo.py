@@ -0,0 +1,49 @@
+"""Pruebas de los números del XML (modelo.a_entero) y de cómo se informan al renderizar"""
+import pathlib
+import re
+import time
+
+import pytest
+
+from app import XMLInvalido, renderizar
+from modelo import ESCALA_CANTIDAD, ESCALA_MONTO, NumeroInvalido, a_entero
+
+ENTRADA = pathlib.Path(__file__).resolve().parent.parent / "input"
+NO_VALIDOS = ['Infinity', '-Infinity', 'NaN', 'sNaN', '1e30', '9.3e18', '1E+999999999']
+
+
+def xml_de_ejemplo():
+    return sorted(ENTRADA.glob("*.xml"))[0].read_bytes()
+
+
+@pytest.mark.parametrize("texto, escala, esperado", [
+    ('12.345', ESCALA_MONTO, 1235),
+    ('1666.667', ESCALA_CANTIDAD, 1666667000),
+    ('-0.5', ESCALA_MONTO, -50),
+    ('', ESCALA_MONTO, 0),
+    ('abc', ESCALA_MONTO, 0),
+    ('1E-999999999', ESCALA_MONTO, 0),
+])
+def test_a_entero(texto, escala, esperado):
+    assert a_entero(texto, escala) == esperado
+
+
+@pytest.mark.parametrize("texto", NO_VALIDOS)
+def test_a_entero_rechaza_no_finitos_y_enormes(texto):
+    inicio = time.perf_counter()
+    with pytest.raises(NumeroInvalido):
+        a_entero(texto, ESCALA_CANTIDAD)
+    # El exponente se revisa antes de armar el entero
+    assert time.perf_counter() - inicio < 0.1
+
+
+@pytest.mark.parametrize("texto", NO_VALIDOS)
+@pytest.mark.parametrize("campo", [
+    rb"<cbc:PayableAmount[^>]*>",                # Total del documento
+    rb"<cac:Price>\s*<cbc:PriceAmount[^>]*>",    # Precio de la primera línea
+    rb"<cbc:InvoicedQuantity[^>]*>",             # Cantidad de la primera línea
+])
+def test_renderizar_informa_xml_invalido(campo, texto):
+    xml = re.sub(rb"(%s)[^<]*" % campo, rb"\g<1>" + texto.encode(), xml_de_ejemplo(), count=1)
+    with pytest.raises(XMLInvalido, match="número"):
+        renderizar(xml)
@@ -0,0 +1,25 @@
+"""Pruebas de qué fallos reintenta el planificador"""
+from concurrent.futures.process import BrokenProcessPool
+
+from app import convertir_archivo
+from planificador import ConversionFallida, es_transitorio
+
+
+def test_xml_invalido_no_se_reintenta(tmp_path):
+    xml = tmp_path / "roto.xml"
+    xml.write_bytes(b"<Invoice><sin cerrar>")
+    resultado = convertir_archivo(str(xml), None)
+    assert not resultado.ok and not resultado.transitorio
+    assert not es_transitorio(ConversionFallida(resultado))
+
+
+def test_error_de_lectura_se_reintenta(tmp_path):
+    resultado = convertir_archivo(str(tmp_path / "no-existe.xml"), None)
+    assert not resultado.ok and resultado.transitorio
+    assert es_transitorio(ConversionFallida(resultado))
+
+
+def test_errores_del_pool():
+    assert es_transitorio(BrokenProcessPool())
+    assert es_transitorio(OSError())
+    assert not es_transitorio(ValueError())
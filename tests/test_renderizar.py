@@ -0,0 +1,37 @@
+"""Pruebas de la API en memoria (app.renderizar)"""
+import pathlib
+
+import pytest
+
+from app import EXTENSIONES, XMLInvalido, renderizar
+
+ENTRADA = pathlib.Path(__file__).resolve().parent.parent / "input"
+
+
+def xml_de_ejemplo():
+    return sorted(ENTRADA.glob("*.xml"))[0].read_bytes()
+
+
+@pytest.mark.parametrize("formato", ['docx', 'escpo', 'PDF', ''])
+def test_formato_desconocido(formato):
+    with pytest.raises(ValueError, match="formato desconocido"):
+        renderizar(xml_de_ejemplo(), formato=formato)
+
+
+def test_formato_desconocido_antes_de_parsear():
+    # El formato se revisa antes de leer el XML: no es un XMLInvalido
+    with pytest.raises(ValueError, match="formato desconocido"):
+        renderizar(b"no es XML", formato='docx')
+
+
+@pytest.mark.parametrize("formato", sorted(EXTENSIONES))
+def test_formatos_conocidos(formato):
+    datos = renderizar(xml_de_ejemplo(), formato=formato)
+    assert len(datos) > 0
+    if formato != 'escpos':
+        assert bytes(datos[:5]) == b"%PDF-"
+
+
+def test_ruta_inexistente(tmp_path):
+    with pytest.raises(XMLInvalido):
+        renderizar(str(tmp_path / "no-existe.xml"))
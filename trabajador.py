@@ -0,0 +1,166 @@
+"""Modo trabajador persistente para el POS: trabajos por stdin/stdout o por socket Unix
+
+El POS que lanzaba `python app.py` en cada venta pagaba en cada ticket el
+arranque del intérprete, el import de fpdf2 y la carga de fuentes, logo y
+tablas del QR: cientos de milisegundos antes de empezar. Con --trabajador el
+proceso queda vivo, se calienta una sola vez (app.calentar) y atiende los
+trabajos uno tras otro, así cada ticket cuesta solo su renderizado.
+
+Cada mensaje, en los dos sentidos, es un entero de 4 bytes big-endian con
+el largo seguido del contenido. Un trabajo empieza con una línea de
+cabecera con los campos separados por tabuladores; si no trae la ruta del
+XML, el XML viene a continuación de la cabecera:
+
+    pdf\\n<XML>                                   ->  ok\\n<bytes del PDF>
+    escpos\\n<XML>                                ->  ok\\n<bytes ESC/POS>
+    pdf\\tinput/F001-1.xml\\n                      ->  ok\\n<bytes del PDF>
+    pdf\\tinput/F001-1.xml\\toutput/F001-1.pdf\\n   ->  ok\\noutput/F001-1.pdf
+    ping\\n                                       ->  ok\\n    (ya está caliente)
+    metricas\\n                                   ->  ok\\n<texto para Prometheus>
+
+Si un trabajo falla, la respuesta es "error\\t<motivo>\\n" y el trabajador
+sigue atendiendo. Por stdin/stdout hay un solo cliente; por el socket
+pueden conectarse varios a la vez, pero los tickets se dibujan de a uno
+(para repartirlos entre varios procesos está el servidor HTTP).
+"""
+import gc
+import os
+import socketserver
+import stat
+import struct
+import sys
+import threading
+
+from app import EXTENSIONES, FacturaXMLtoPDF, XMLInvalido, calentar
+from metricas import REGISTRO, registrar_ticket
+
+LARGO = struct.Struct(">I")
+TAMANO_MAXIMO_MENSAJE = 64 * 1024 * 1024
+
+
+class MensajeInvalido(ValueError):
+    """Lo recibido no respeta el protocolo (no se puede seguir leyendo la conexión)"""
+
+
+def leer_mensaje(entrada):
+    """Contenido del siguiente mensaje de `entrada` (archivo binario), o None si se cerró"""
+    cabecera = entrada.read(LARGO.size)
+    if not cabecera:
+        return None
+    if len(cabecera) < LARGO.size:
+        raise MensajeInvalido("la conexión se cerró en medio del largo de un mensaje")
+    largo, = LARGO.unpack(cabecera)
+    if largo > TAMANO_MAXIMO_MENSAJE:
+        raise MensajeInvalido(f"mensaje de {largo} bytes (máximo {TAMANO_MAXIMO_MENSAJE})")
+    contenido = entrada.read(largo)
+    if len(contenido) < largo:
+        raise MensajeInvalido(f"se esperaban {largo} bytes y llegaron {len(contenido)}")
+    return contenido
+
+
+def escribir_mensaje(salida, estado, datos=b""):
+    """Enviar una respuesta: `estado` es la línea de cabecera y `datos` el resto"""
+    salida.write(LARGO.pack(len(estado) + len(datos)) + estado)
+    if datos:
+        salida.write(datos)
+    salida.flush()
+
+
+def error(motivo):
+    """Respuesta de error (el motivo va en una sola línea)"""
+    return b"error\t" + " ".join(str(motivo).split()).encode("utf-8") + b"\n", b""
+
+
+def atender(mensaje):
+    """(estado, datos) de la respuesta a un mensaje del protocolo"""
+    cabecera, _, cuerpo = mensaje.partition(b"\n")
+    try:
+        campos = cabecera.decode("utf-8").split("\t")
+    except UnicodeDecodeError:
+        return error("la cabecera no es UTF-8")
+    comando = campos[0]
+    if comando == 'ping':
+        return b"ok\n", b""
+    if comando == 'metricas':
+        return b"ok\n", REGISTRO.prometheus().encode()
+    if comando not in EXTENSIONES:
+        return error(f"comando desconocido: {comando} (pdf, compacto, escpos, ping o metricas)")
+    if len(campos) > 3:
+        return error("la cabecera tiene más de tres campos (formato, XML y salida)")
+
+    # Con la ruta del XML en la cabecera el cuerpo se ignora
+    fuente = campos[1] if len(campos) > 1 else cuerpo
+    salida = campos[2] if len(campos) > 2 else None
+    factura = FacturaXMLtoPDF(fuente, salida)
+    try:
+        datos = factura.renderizar(formato=comando)
+    except XMLInvalido as e:
+        registrar_ticket(factura.resumen_metricas(), False, formato=comando)
+        return error(e)
+    except Exception as e:
+        registrar_ticket(factura.resumen_metricas(), False, formato=comando)
+        return error(f"{type(e).__name__}: {e}")
+    registrar_ticket(factura.resumen_metricas(), True, formato=comando)
+    if salida:
+        return b"ok\n", salida.encode("utf-8")
+    return b"ok\n", datos
+
+
+def atender_conexion(entrada, salida, turno):
+    """Responder los mensajes de `entrada` en `salida` hasta que el cliente cierre
+
+    `turno` es el lock que hace que los tickets se dibujen de a uno. Un
+    mensaje mal formado se contesta con un error y cierra la conexión,
+    porque ya no se sabe dónde empieza el siguiente.
+    """
+    while True:
+        try:
+            mensaje = leer_mensaje(entrada)
+        except MensajeInvalido as e:
+            escribir_mensaje(salida, *error(e))
+            return
+        if mensaje is None:
+            return
+        with turno:
+            respuesta = atender(mensaje)
+        escribir_mensaje(salida, *respuesta)
+
+
+class ManejadorSocket(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            atender_conexion(self.rfile, self.wfile, self.server.turno)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # El POS cerró sin esperar la respuesta
+
+
+def ejecutar(ruta_socket=None):
+    """Calentar el proceso y atender trabajos por stdin/stdout o por el socket Unix `ruta_socket`"""
+    calentar(tuple(EXTENSIONES))
+    # Lo cargado al calentar queda fuera de las recolecciones de basura de cada ticket
+    gc.freeze()
+    turno = threading.Lock()
+
+    if ruta_socket is None:
+        entrada = sys.stdin.buffer
+        salida = sys.stdout.buffer
+        # Por stdout solo pueden salir respuestas del protocolo
+        sys.stdout = sys.stderr
+        print("Trabajador listo en stdin/stdout", file=sys.stderr, flush=True)
+        atender_conexion(entrada, salida, turno)
+        return
+
+    if os.path.exists(ruta_socket):
+        if not stat.S_ISSOCK(os.stat(ruta_socket).st_mode):
+            raise FileExistsError(f"{ruta_socket} existe y no es un socket")
+        os.unlink(ruta_socket)  # Socket de una ejecución anterior
+    with socketserver.ThreadingUnixStreamServer(ruta_socket, ManejadorSocket) as servidor:
+        servidor.daemon_threads = True
+        servidor.turno = turno
+        print(f"Trabajador listo en {ruta_socket}", file=sys.stderr, flush=True)
+        try:
+            servidor.serve_forever()
+        except KeyboardInterrupt:
+            print("\nTrabajador detenido", file=sys.stderr)
+        finally:
+            os.unlink(ruta_socket)
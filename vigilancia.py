@@ -0,0 +1,217 @@
+"""Modo vigilancia: convertir solo los XML nuevos o modificados de la carpeta de entrada
+
+Mantiene en la carpeta de salida un manifiesto con el hash del contenido con
+que se convirtió cada XML (por nombre) y la ruta de su PDF. Los cambios se detectan con
+inotify (Linux) y, si no está disponible, revisando la carpeta cada cierto
+intervalo.
+
+Con varios procesos los archivos se convierten como trabajos de lote del
+planificador (planificador.py): los que fallan se reintentan con espera y,
+si se indicó una carpeta de cuarentena, se apartan ahí.
+"""
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import time
+
+from app import EXTENSIONES, convertir_archivo, huella_fuente, registrar_resultados
+from metricas import REGISTRO
+from planificador import REINTENTOS_LOTE, Planificador, iterar_planificado
+
+ARCHIVO_MANIFIESTO = ".manifiesto.json"
+
+# Constantes de <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o0004000
+IN_CLOEXEC = 0o2000000
+EVENTO_INOTIFY = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class Manifiesto:
+    """Nombre de cada XML convertido -> hash del contenido convertido y ruta del PDF generado"""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        try:
+            with open(ruta, encoding="utf-8") as f:
+                self.datos = json.load(f)
+        except (OSError, ValueError):
+            self.datos = {}
+
+    def pendiente(self, nombre, huella):
+        """True si el XML nunca se convirtió, cambió su contenido desde entonces o su PDF ya no existe"""
+        entrada = self.datos.get(nombre)
+        return entrada is None or entrada['huella'] != huella or not os.path.exists(entrada['salida'])
+
+    def registrar(self, nombre, huella, salida):
+        self.datos[nombre] = {'huella': huella, 'salida': salida}
+
+    def guardar(self):
+        # Escribir a un temporal y reemplazar, para no dejar un manifiesto a medias
+        temporal = self.ruta + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(self.datos, f, indent=1, sort_keys=True)
+        os.replace(temporal, self.ruta)
+
+
+class Inotify:
+    """Nombres de archivos escritos o movidos dentro de una carpeta (inotify vía ctypes)"""
+
+    def __init__(self, carpeta):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 falló")
+        if libc.inotify_add_watch(self.fd, os.fsencode(carpeta), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch falló en {carpeta}")
+
+    def esperar(self, timeout):
+        """Esperar eventos; devuelve un set de nombres o None si la cola se desbordó"""
+        listos, _, _ = select.select([self.fd], [], [], timeout)
+        if not listos:
+            return set()
+
+        nombres = set()
+        try:
+            datos = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return nombres
+        posicion = 0
+        while posicion < len(datos):
+            _, mascara, _, largo = EVENTO_INOTIFY.unpack_from(datos, posicion)
+            posicion += EVENTO_INOTIFY.size
+            if mascara & IN_Q_OVERFLOW:
+                return None
+            nombre = datos[posicion:posicion + largo].rstrip(b"\0")
+            posicion += largo
+            if nombre:
+                nombres.add(os.fsdecode(nombre))
+        return nombres
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Vigilante:
+    """Convierte los XML nuevos o modificados a medida que aparecen"""
+
+    def __init__(self, input_dir, output_dir, workers=1, intervalo=2.0, formato='pdf', archivo_prometheus=None,
+                 indice=None, reintentos=REINTENTOS_LOTE, cuarentena=None):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.workers = workers
+        self.intervalo = intervalo
+        self.formato = formato
+        # Métricas acumuladas que se reescriben después de cada tanda
+        self.archivo_prometheus = archivo_prometheus
+        # Índice de comprobantes (indice.Indice) que se completa con cada conversión
+        self.indice = indice
+        # Un manifiesto por formato, para que convertir a ESC/POS no marque el PDF como hecho
+        nombre_manifiesto = ARCHIVO_MANIFIESTO if formato == 'pdf' else f".manifiesto-{formato}.json"
+        self.manifiesto = Manifiesto(os.path.join(output_dir, nombre_manifiesto))
+        self.vistos = {}  # nombre -> (mtime_ns, tamaño) de la última revisión
+        self.reintentos = reintentos
+        self.cuarentena = cuarentena
+        # Planificador propio (con varios procesos) o el del servidor, si corre dentro de él
+        self.planificador = None
+
+    def escanear(self):
+        """Nombres de XML cuyo mtime o tamaño cambió desde la última revisión"""
+        cambiados = []
+        with os.scandir(self.input_dir) as entradas:
+            for entrada in entradas:
+                if not entrada.name.endswith(".xml"):
+                    continue
+                try:
+                    stat = entrada.stat()
+                except OSError:
+                    continue
+                firma = (stat.st_mtime_ns, stat.st_size)
+                if self.vistos.get(entrada.name) != firma:
+                    self.vistos[entrada.name] = firma
+                    cambiados.append(entrada.name)
+        return sorted(cambiados)
+
+    def procesar(self, nombres):
+        """Convertir los archivos nuevos o cuyo contenido cambió desde que figuran en el manifiesto"""
+        trabajos = []
+        huellas = {}
+        for nombre in nombres:
+            xml_path = os.path.join(self.input_dir, nombre)
+            try:
+                huella = huella_fuente(xml_path)
+            except OSError:
+                continue  # Se borró o movió antes de leerlo
+            if not self.manifiesto.pendiente(nombre, huella):
+                continue
+            output_path = os.path.join(self.output_dir, nombre.replace(".xml", EXTENSIONES[self.formato]))
+            trabajos.append((xml_path, output_path))
+            huellas[nombre] = (huella, output_path)
+
+        if not trabajos:
+            return
+
+        ruta_indice = self.indice.ruta if self.indice else None
+        if self.planificador is not None:
+            resultados = list(iterar_planificado(trabajos, self.planificador, self.formato, indice=ruta_indice,
+                                                 reintentos=self.reintentos, cuarentena=self.cuarentena))
+        else:
+            resultados = [convertir_archivo(xml, salida, self.formato, indice=ruta_indice) for xml, salida in trabajos]
+            registrar_resultados(resultados)
+        if self.indice:
+            resultados = list(self.indice.registrar(resultados))
+
+        for resultado in resultados:
+            if resultado.ok:
+                self.manifiesto.registrar(resultado.nombre, *huellas[resultado.nombre])
+                print(f"✓ {resultado.nombre}")
+            else:
+                print(f"✗ {resultado.nombre}: {resultado.mensaje}")
+        self.manifiesto.guardar()
+        if self.archivo_prometheus:
+            REGISTRO.escribir_prometheus(self.archivo_prometheus)
+
+    def ejecutar(self):
+        """Bucle principal (termina con Ctrl+C)"""
+        propio = self.planificador is None and self.workers > 1
+        if propio:
+            # Todos los procesos para el lote: no hay trabajos interactivos
+            self.planificador = Planificador(self.workers, max_lote=self.workers)
+        inotify = None
+        try:
+            # La vigilancia empieza antes de ponerse al día, así los XML que
+            # llegan mientras se convierte lo atrasado generan su evento
+            try:
+                inotify = Inotify(self.input_dir)
+            except (OSError, AttributeError) as e:
+                print(f"inotify no disponible ({e}), revisando la carpeta cada {self.intervalo}s")
+            # Ponerse al día con lo que llegó mientras no se estaba vigilando
+            self.procesar(self.escanear())
+
+            print(f"Vigilando '{self.input_dir}' (Ctrl+C para salir)")
+            while True:
+                if inotify is None:
+                    time.sleep(self.intervalo)
+                    self.procesar(self.escanear())
+                    continue
+
+                nombres = inotify.esperar(self.intervalo)
+                if nombres is None:
+                    # Se perdieron eventos: revisar toda la carpeta
+                    self.procesar(self.escanear())
+                elif nombres:
+                    self.procesar(sorted(n for n in nombres if n.endswith(".xml")))
+        except KeyboardInterrupt:
+            print("\nVigilancia detenida")
+        finally:
+            if inotify is not None:
+                inotify.close()
+            if propio:
+                self.planificador.cerrar()